@@ -1,4 +1,4 @@
-from flask import Flask, url_for, render_template, request, redirect, session, jsonify, send_from_directory, flash
+from flask import Flask, url_for, render_template, request, redirect, session, jsonify, send_from_directory, flash, Response
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime, timedelta
 import numpy as np
@@ -6,6 +6,7 @@ import pandas as pd
 import random
 import os
 import json
+import queue
 from werkzeug.security import generate_password_hash, check_password_hash
 import joblib
 from sklearn.ensemble import RandomForestRegressor
@@ -13,6 +14,20 @@ import matplotlib
 matplotlib.use('Agg')  # Set the backend before importing pyplot
 import matplotlib.pyplot as plt
 from route_model import RouteOptimizer
+import geodesy
+from cache import cached_geocode, geocode_cache, route_cache
+from http_client import GeopyAdapter, DEFAULT_TIMEOUT, gather, get_session
+import map_cache
+from route_export import ROUTE_FORMATS, route_payload
+from route_geometry import level_geometry, MAP_ZOOM
+from retention import RetentionManager, RetentionPolicy, touch
+import telemetry
+from write_behind import WriteBehindQueue
+from telemetry_store import TelemetryStore, downsample, summarize
+import rollups
+from fleet_stream import FleetStream, KEEPALIVE_INTERVAL
+import change_tracking
+from query_budget import QueryBudget
 import traceback
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import letter
@@ -20,7 +35,8 @@ from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph,
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from openpyxl import Workbook
 from openpyxl.styles import Font, PatternFill, Alignment
-from sqlalchemy import func
+from sqlalchemy import func, event
+from sqlalchemy.orm import joinedload
 import math
 from geopy.geocoders import Nominatim
 from geopy.exc import GeocoderTimedOut
@@ -33,7 +49,7 @@ app.secret_key = 'your_secret_key_here'  # Required for session management
 # Ensure the route_maps directory exists
 os.makedirs(os.path.join(app.root_path, 'static', 'route_maps'), exist_ok=True)
 
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///users.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///users.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False  # Suppress warnings
 
 db = SQLAlchemy(app)
@@ -55,6 +71,7 @@ class Vehicle(db.Model):
     battery_status = db.Column(db.Integer, nullable=False)
     location = db.Column(db.String(200), nullable=False)
     speed = db.Column(db.Float, nullable=False)
+    version = db.Column(db.Integer, nullable=False, default=0, index=True)  # Set by change_tracking triggers
 
 # Driver Behavior model
 class DriverBehavior(db.Model):
@@ -66,6 +83,8 @@ class DriverBehavior(db.Model):
     rapid_acceleration = db.Column(db.Boolean, default=False)
     idle_time = db.Column(db.Integer, default=0)  # in minutes
     score = db.Column(db.Integer, nullable=False)
+    version = db.Column(db.Integer, nullable=False, default=0, index=True)  # Set by change_tracking triggers
+    vehicle = db.relationship('Vehicle', backref='driver_behaviors')
 
 # Maintenance Alert model
 class MaintenanceAlert(db.Model):
@@ -76,6 +95,8 @@ class MaintenanceAlert(db.Model):
     timestamp = db.Column(db.DateTime, nullable=False)
     priority = db.Column(db.String(20), nullable=False)  # High, Medium, Low
     status = db.Column(db.String(20), nullable=False)  # Open, Closed
+    version = db.Column(db.Integer, nullable=False, default=0, index=True)  # Set by change_tracking triggers
+    vehicle = db.relationship('Vehicle', backref='maintenance_alerts')
 
 # Report model
 class Report(db.Model):
@@ -84,6 +105,105 @@ class Report(db.Model):
     filename = db.Column(db.String(200), nullable=False)
     generated_at = db.Column(db.DateTime, nullable=False)
 
+# Tables whose changes are versioned for delta sync
+VERSIONED_TABLES = ['vehicle', 'maintenance_alert', 'driver_behavior']
+SYNC_PAGE_SIZE = 1000  # Rows returned by one ?since= request
+
+def ensure_change_tracking():
+    """Add change versions and their triggers to the versioned tables"""
+    with app.app_context():
+        try:
+            with db.engine.begin() as connection:
+                change_tracking.install(connection, VERSIONED_TABLES)
+        except Exception as e:
+            print(f"Error installing change tracking: {str(e)}")
+
+ensure_change_tracking()
+
+def parse_since():
+    """The ?since= version of a delta sync request, or None for a full listing"""
+    since = request.args.get('since')
+    return None if since in (None, '') else max(int(since), 0)
+
+def versioned_response(table_names, build):
+    """Answer 304 if the client's ETag is current, otherwise jsonify(build()) tagged with the table versions.
+
+    The first table is the one being listed; the others supply fields of its rows.
+    """
+    versions = change_tracking.current_versions(db.session, table_names)
+    etag = change_tracking.make_etag(versions, request.query_string)
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(build(versions[0]))
+    response.set_etag(etag, weak=True)
+    response.headers['X-Change-Version'] = str(versions[0])
+    return response
+
+def delta_page(model, since, serialize, current_version, options=()):
+    """Rows of model changed after version since, oldest change first, plus ids deleted since"""
+    rows = model.query.options(*options).filter(model.version > since).order_by(model.version).limit(SYNC_PAGE_SIZE + 1).all()
+    has_more = len(rows) > SYNC_PAGE_SIZE
+    rows = rows[:SYNC_PAGE_SIZE]
+    return {
+        # Ask again with since=version; when has_more is set there are further pages
+        'version': rows[-1].version if has_more else max(current_version, rows[-1].version if rows else since),
+        'has_more': has_more,
+        'changed': [dict(serialize(row), version=row.version) for row in rows],
+        'deleted': [] if has_more else change_tracking.deleted_since(db.session, model.__tablename__, since)
+    }
+
+def forget_evicted_reports(filenames):
+    """Delete the Report rows of report files removed by the retention manager"""
+    with app.app_context():
+        try:
+            Report.query.filter(Report.filename.in_(filenames)).delete(synchronize_session=False)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error removing evicted reports: {str(e)}")
+
+# Generated files are kept within these budgets by a background sweep
+REPORTS_DIR = os.path.join(app.root_path, 'static', 'reports')
+retention_manager = RetentionManager([
+    RetentionPolicy(map_cache.ROUTE_MAPS_DIR, max_age=7 * 24 * 3600, max_bytes=256 * 1024 * 1024,
+                    suffixes=['.html']),
+    RetentionPolicy(REPORTS_DIR, max_age=90 * 24 * 3600, max_bytes=512 * 1024 * 1024,
+                    suffixes=['.pdf'], on_evict=forget_evicted_reports)
+], interval=600, lock_path=os.path.join(app.instance_path, 'retention.lock'))
+retention_manager.start()
+
+# Request handlers hand their writes to one background writer that commits them in groups
+write_behind = WriteBehindQueue(app, db)
+
+# Every accepted telemetry reading is kept in an append-only columnar history
+telemetry_history = TelemetryStore()
+
+# Most SQL queries one request to these endpoints may run, whatever the number of rows listed
+QUERY_BUDGETS = {
+    'index': 12,
+    'consumption_metrics': 4,
+    'get_driver_behavior': 4,
+    'get_maintenance_alerts': 4
+}
+query_budget = QueryBudget(app, db, QUERY_BUDGETS)
+
+def load_fleet_changes(since):
+    """Vehicle version, (id, name, battery_status, speed, location) rows changed after since and ids deleted since"""
+    with app.app_context():
+        version = change_tracking.current_versions(db.session, ['vehicle'])[0]
+        if version == since:
+            return version, [], []
+        query = db.session.query(Vehicle.id, Vehicle.vehicle_name, Vehicle.battery_status,
+                                 Vehicle.speed, Vehicle.location)
+        if not since:
+            return version, query.all(), []
+        return (version, query.filter(Vehicle.version > since).all(),
+                change_tracking.deleted_since(db.session, 'vehicle', since))
+
+# Dashboards subscribe to vehicle changes instead of reloading the page
+fleet_stream = FleetStream(load_fleet_changes)
+
 # ConsumptionMetric model
 class ConsumptionMetric(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -95,11 +215,88 @@ class ConsumptionMetric(db.Model):
     efficiency = db.Column(db.Float)  # kWh/km
     vehicle = db.relationship('Vehicle', backref='consumption_metrics')
 
+# Hourly and daily consumption totals per vehicle
+class ConsumptionRollup(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    vehicle_id = db.Column(db.Integer, db.ForeignKey('vehicle.id'), nullable=False)
+    granularity = db.Column(db.String(10), nullable=False)  # hour, day
+    bucket_start = db.Column(db.DateTime, nullable=False)
+    energy_used = db.Column(db.Float, nullable=False, default=0)  # in kWh
+    cost = db.Column(db.Float, nullable=False, default=0)  # in INR
+    distance = db.Column(db.Float, nullable=False, default=0)  # in km
+    efficiency_sum = db.Column(db.Float, nullable=False, default=0)  # kWh/km, over metrics with an efficiency
+    metric_count = db.Column(db.Integer, nullable=False, default=0)
+    efficiency_count = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (
+        db.UniqueConstraint('vehicle_id', 'granularity', 'bucket_start', name='uq_consumption_rollup_bucket'),
+        db.Index('ix_consumption_rollup_range', 'granularity', 'bucket_start')
+    )
+
+@event.listens_for(db.session, 'after_flush')
+def roll_up_new_metrics(session, flush_context):
+    """Add newly inserted consumption metrics to the rollups, in the same transaction"""
+    metrics = [(m.vehicle_id, m.timestamp, m.energy_used, m.cost, m.distance, m.efficiency)
+               for m in session.new if isinstance(m, ConsumptionMetric)]
+    if metrics:
+        rollups.apply_deltas(session.connection(), ConsumptionRollup.__table__, rollups.rollup_deltas(metrics))
+
+def ensure_consumption_rollups():
+    """Create the rollup table, filling it from existing metrics the first time"""
+    with app.app_context():
+        try:
+            if not db.inspect(db.engine).has_table(ConsumptionRollup.__tablename__):
+                with db.engine.begin() as connection:
+                    ConsumptionRollup.__table__.create(connection)
+                    if db.inspect(connection).has_table(ConsumptionMetric.__tablename__):
+                        rollups.rebuild(connection, ConsumptionRollup.__table__, ConsumptionMetric.__table__)
+        except Exception as e:
+            print(f"Error creating consumption rollups: {str(e)}")
+
+ensure_consumption_rollups()
+
+def consumption_totals(start, end, vehicle_id=None):
+    """Per-vehicle consumption sums over [start, end), read from the coarsest rollups covering the range"""
+    totals = {}
+    for source, piece_start, piece_end in rollups.plan_range(start, end):
+        if source == 'raw':
+            query = db.session.query(
+                ConsumptionMetric.vehicle_id,
+                func.sum(ConsumptionMetric.energy_used), func.sum(ConsumptionMetric.cost),
+                func.sum(ConsumptionMetric.distance), func.coalesce(func.sum(ConsumptionMetric.efficiency), 0),
+                func.count(), func.count(ConsumptionMetric.efficiency)
+            ).filter(ConsumptionMetric.timestamp >= piece_start, ConsumptionMetric.timestamp < piece_end)
+            if vehicle_id is not None:
+                query = query.filter(ConsumptionMetric.vehicle_id == vehicle_id)
+            rows = query.group_by(ConsumptionMetric.vehicle_id).all()
+        else:
+            query = db.session.query(
+                ConsumptionRollup.vehicle_id,
+                *[func.sum(getattr(ConsumptionRollup, name)) for name in rollups.SUMMED]
+            ).filter(
+                ConsumptionRollup.granularity == source,
+                ConsumptionRollup.bucket_start >= piece_start,
+                ConsumptionRollup.bucket_start < piece_end
+            )
+            if vehicle_id is not None:
+                query = query.filter(ConsumptionRollup.vehicle_id == vehicle_id)
+            rows = query.group_by(ConsumptionRollup.vehicle_id).all()
+
+        for row in rows:
+            total = totals.setdefault(row[0], dict.fromkeys(rollups.SUMMED, 0))
+            for name, value in zip(rollups.SUMMED, row[1:]):
+                total[name] += value or 0
+    return totals
+
 # Initialize the geocoder
-geolocator = Nominatim(user_agent="ev_fleet_monitoring")
+geolocator = Nominatim(user_agent="ev_fleet_monitoring", adapter_factory=GeopyAdapter, timeout=DEFAULT_TIMEOUT)
 
 def get_coordinates(address):
-    """Get coordinates (latitude, longitude) for a given address"""
+    """Get coordinates (latitude, longitude) for a given address, served from the geocode cache when possible"""
+    result = cached_geocode('geopy', address, lambda: fetch_coordinates(address))
+    return tuple(result) if result else None
+
+def fetch_coordinates(address):
+    """Get coordinates (latitude, longitude) for a given address from Nominatim"""
     try:
         # Add 'India' to the address if not present to improve geocoding accuracy
         if 'india' not in address.lower():
@@ -135,15 +332,22 @@ def get_vehicle(id):
 def update_vehicle(id):
     if not session.get('logged_in'):
         return jsonify({'error': 'Not logged in'}), 401
-    vehicle = Vehicle.query.get_or_404(id)
+    Vehicle.query.get_or_404(id)
     data = request.get_json()
-    
-    vehicle.vehicle_name = data.get('vehicle_name', vehicle.vehicle_name)
-    vehicle.vehicle_number = data.get('vehicle_number', vehicle.vehicle_number)
-    vehicle.owner_name = data.get('owner_name', vehicle.owner_name)
-    vehicle.location = data.get('location', vehicle.location)
-    
-    db.session.commit()
+    changes = {field: data[field] for field in ('vehicle_name', 'vehicle_number', 'owner_name', 'location')
+               if field in data}
+
+    def apply_update():
+        Vehicle.query.filter_by(id=id).update(changes)
+
+    # Answered only after the group commit holding the update, so a failed write is reported
+    try:
+        write_behind.submit(apply_update, durable=True)
+        fleet_stream.poke()
+    except queue.Full:
+        return jsonify({'error': 'Too many pending writes, try again shortly'}), 503, {'Retry-After': '1'}
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
     return jsonify({'message': 'Vehicle updated successfully'})
 
 @app.route('/api/vehicle/<int:id>', methods=['DELETE'])
@@ -155,8 +359,95 @@ def delete_vehicle(id):
     db.session.commit()
     return jsonify({'message': 'Vehicle deleted successfully'})
 
+@app.route('/api/telemetry', methods=['POST'])
+def ingest_telemetry():
+    """Apply a batch of telemetry frames sent as NDJSON or packed binary records"""
+    if not session.get('logged_in'):
+        return jsonify({'error': 'Not logged in'}), 401
+
+    content_type = request.mimetype
+    try:
+        if content_type == 'application/octet-stream':
+            batch, malformed = telemetry.parse_binary(request.get_data()), []
+        elif content_type in ('application/x-ndjson', 'application/jsonlines', 'text/plain'):
+            batch, malformed = telemetry.parse_ndjson(request.get_data(as_text=True))
+        else:
+            return jsonify({'error': 'Send application/x-ndjson or application/octet-stream'}), 415
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if len(batch['vehicle_id']) > telemetry.MAX_TELEMETRY_FRAMES:
+        return jsonify({'error': f'At most {telemetry.MAX_TELEMETRY_FRAMES} frames per batch'}), 413
+
+    try:
+        known_ids = [row[0] for row in db.session.query(Vehicle.id)]
+        accepted, report = telemetry.ingest(db.session, batch, known_ids, malformed)
+        db.session.commit()
+        fleet_stream.poke()
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error ingesting telemetry: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+    # Only readings whose update is committed go into the history
+    try:
+        telemetry.append_history(telemetry_history, accepted)
+    except Exception as e:
+        print(f"Error storing telemetry history: {str(e)}")
+        return jsonify({'error': f'Vehicles updated but history not stored: {e}'}), 500
+    return jsonify(report)
+
+MAX_HISTORY_POINTS = 20000
+
+def parse_time(value):
+    """Unix seconds from a query parameter given as seconds or an ISO 8601 datetime, or None"""
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+@app.route('/api/telemetry/history/<int:vehicle_id>', methods=['GET'])
+def get_telemetry_history(vehicle_id):
+    """A vehicle's telemetry readings between start and end, evenly thinned to max_points"""
+    if not session.get('logged_in'):
+        return jsonify({'error': 'Not logged in'}), 401
+    try:
+        end = parse_time(request.args.get('end'))
+        start = parse_time(request.args.get('start'))
+        if start is None:
+            start = (end if end is not None else datetime.now().timestamp()) - 24 * 3600
+        max_points = min(int(request.args.get('max_points', 2000)), MAX_HISTORY_POINTS)
+    except ValueError as e:
+        return jsonify({'error': f'Invalid parameter: {e}'}), 400
+
+    data = telemetry_history.scan(vehicle_id, start, end)
+    summary = summarize(data)
+    data = downsample(data, max_points)
+    battery = data['battery_status'].astype(np.float64)
+    battery[data['battery_status'] == telemetry.MISSING_BATTERY] = np.nan
+    data['battery_status'] = battery
+    return jsonify({
+        'vehicle_id': vehicle_id,
+        'start': start,
+        'end': end,
+        'summary': summary,
+        # NaN marks missing values on disk; JSON has no NaN, so send null
+        'readings': {name: np.where(np.isnan(values), None, np.round(values.astype(np.float64), 6)).tolist()
+                     for name, values in data.items()}
+    })
+
+def wants_durable_write(data=None):
+    """Whether the caller asked to be answered only after its write is committed (?durable=1)"""
+    value = request.args.get('durable', (data or {}).get('durable', False))
+    return str(value).lower() in ('1', 'true', 'yes')
+
 # Function to generate maintenance alerts based on vehicle conditions
-def generate_maintenance_alerts():
+def generate_maintenance_alerts(durable=False):
+    """Queue a maintenance check of every vehicle on the write-behind writer"""
+    return write_behind.submit(check_vehicle_maintenance, durable=durable)
+
+def check_vehicle_maintenance():
     vehicles = Vehicle.query.all()
     current_time = datetime.now()
     
@@ -219,11 +510,13 @@ def generate_maintenance_alerts():
                     status='Open'
                 )
                 db.session.add(new_alert)
-    
-    db.session.commit()
 
 # Function to generate driver behavior data
-def generate_driver_behavior():
+def generate_driver_behavior(durable=False):
+    """Queue a driver behavior sample for every vehicle on the write-behind writer"""
+    return write_behind.submit(record_driver_behavior, durable=durable)
+
+def record_driver_behavior():
     vehicles = Vehicle.query.all()
     current_time = datetime.now()
     
@@ -258,8 +551,27 @@ def generate_driver_behavior():
             score=final_score
         )
         db.session.add(behavior)
-    
-    db.session.commit()
+
+@app.route('/api/fleet/stream')
+def stream_fleet():
+    """Server-Sent Events: a snapshot of the fleet, then a delta whenever vehicles change"""
+    if not session.get('logged_in'):
+        return jsonify({'error': 'Not logged in'}), 401
+    subscriber, snapshot = fleet_stream.subscribe()
+
+    def events():
+        try:
+            yield 'retry: 5000\n\n' + snapshot
+            while True:
+                try:
+                    yield subscriber.get(timeout=KEEPALIVE_INTERVAL)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+        finally:
+            fleet_stream.unsubscribe(subscriber)
+
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 # Home route
 @app.route('/')
@@ -312,6 +624,7 @@ def index():
                 status = 'Active' if vehicle.speed > 0 else 'Charging' if vehicle.battery_status < 20 else 'Inactive'
                 status_class = f'status-{status.lower()}'
                 vehicle_list.append({
+                    'id': vehicle.id,
                     'vehicle_name': vehicle.vehicle_name,
                     'battery_status': vehicle.battery_status,
                     'status': status,
@@ -475,10 +788,11 @@ def generate_recent_activities():
     
     try:
         # Recent Maintenance Alerts
-        maintenance_alerts = MaintenanceAlert.query.order_by(MaintenanceAlert.timestamp.desc()).limit(3).all()
+        maintenance_alerts = (MaintenanceAlert.query.options(joinedload(MaintenanceAlert.vehicle))
+                              .order_by(MaintenanceAlert.timestamp.desc()).limit(3).all())
         print(f"Found {len(maintenance_alerts)} maintenance alerts")
         for alert in maintenance_alerts:
-            vehicle = Vehicle.query.get(alert.vehicle_id)
+            vehicle = alert.vehicle
             if vehicle:
                 print(f"Processing alert for vehicle {vehicle.vehicle_name}")
                 activities.append({
@@ -490,10 +804,11 @@ def generate_recent_activities():
                 })
         
         # Recent Driver Behavior Events
-        driver_behaviors = DriverBehavior.query.order_by(DriverBehavior.timestamp.desc()).limit(3).all()
+        driver_behaviors = (DriverBehavior.query.options(joinedload(DriverBehavior.vehicle))
+                            .order_by(DriverBehavior.timestamp.desc()).limit(3).all())
         print(f"Found {len(driver_behaviors)} driver behaviors")
         for behavior in driver_behaviors:
-            vehicle = Vehicle.query.get(behavior.vehicle_id)
+            vehicle = behavior.vehicle
             if vehicle:
                 status = []
                 if behavior.harsh_braking:
@@ -514,10 +829,11 @@ def generate_recent_activities():
                     })
         
         # Recent Consumption Metrics with Unusual Patterns
-        consumption_metrics = ConsumptionMetric.query.order_by(ConsumptionMetric.timestamp.desc()).limit(3).all()
+        consumption_metrics = (ConsumptionMetric.query.options(joinedload(ConsumptionMetric.vehicle))
+                               .order_by(ConsumptionMetric.timestamp.desc()).limit(3).all())
         print(f"Found {len(consumption_metrics)} consumption metrics")
         for metric in consumption_metrics:
-            vehicle = Vehicle.query.get(metric.vehicle_id)
+            vehicle = metric.vehicle
             if vehicle and metric.efficiency > 1.5:  # High energy consumption
                 print(f"Processing consumption metric for vehicle {vehicle.vehicle_name}")
                 activities.append({
@@ -872,18 +1188,20 @@ def optimize_route():
         source = data.get('source', '')
         destination = data.get('destination', '')
         battery_percentage = float(data.get('battery_percentage', 100))
+        route_format = data.get('format') or request.args.get('format', 'html')
+        if route_format not in ROUTE_FORMATS:
+            return jsonify({'error': f'format must be one of {", ".join(ROUTE_FORMATS)}'})
 
-        # Get coordinates for source and destination using RouteOptimizer
-        source_coords = route_optimizer.get_coordinates(source)
+        # Get coordinates for source and destination using RouteOptimizer; the two lookups are independent
+        source_coords, dest_coords = gather(lambda: route_optimizer.get_coordinates(source),
+                                            lambda: route_optimizer.get_coordinates(destination))
         if not source_coords[0]:
             return jsonify({'error': 'Invalid source address'})
-        
-        dest_coords = route_optimizer.get_coordinates(destination)
         if not dest_coords[0]:
             return jsonify({'error': 'Invalid destination address'})
 
-        # Calculate route details using OSRM
-        route_details = route_optimizer.get_route_from_osrm(source_coords[:2], dest_coords[:2])
+        # Calculate route details using OSRM or the offline road graph
+        route_details = route_optimizer.get_route(source_coords[:2], dest_coords[:2])
         if not route_details:
             return jsonify({'error': 'Could not calculate route'})
 
@@ -894,21 +1212,22 @@ def optimize_route():
             'name': source
         }]
 
-        # Find charging stations along the route
-        total_distance = route_details['distance']
-        range_with_current_battery = (battery_percentage / 100) * route_optimizer.AVERAGE_EV_RANGE
-        
-        if total_distance > range_with_current_battery:
-            # Find charging stations near the route
-            for station in route_optimizer.find_nearby_stations(source_coords[0], source_coords[1]):
-                route_points.append({
-                    'lat': station['lat'],
-                    'lon': station['lon'],
-                    'name': station['name'],
-                    'is_charging_station': True,
-                    'charging_speed': station['charging_speed'],
-                    'available_ports': station['available_ports']
-                })
+        # Plan the charging stops along the route; with "reserve" set a port is held at each one
+        plan = route_optimizer.plan_route(source_coords, dest_coords, route_details, battery_percentage,
+                                          reserve=bool(data.get('reserve')))
+        for stop in plan.get('charging_stops', []):
+            route_points.append({
+                'lat': stop['lat'],
+                'lon': stop['lon'],
+                'name': stop['name'],
+                'is_charging_station': True,
+                'charging_speed': stop['charging_speed'],
+                'available_ports': stop['available_ports'],
+                'arrival_battery': stop['arrival_battery'],
+                'target_battery': stop['target_battery'],
+                'charging_time': stop['charging_time'],
+                'reservation_id': stop.get('reservation_id')
+            })
 
         # Add destination
         route_points.append({
@@ -917,26 +1236,135 @@ def optimize_route():
             'name': destination
         })
 
-        # Create route visualization
-        map_file = create_route_map(route_points)
-        
-        # Get the full URL for the map
-        map_url = url_for('static', filename=map_file.replace('static/', ''))
+        if route_format == 'html':
+            # Create route visualization
+            map_file = create_route_map(route_points)
+            
+            # Get the full URL for the map
+            map_url = url_for('static', filename=map_file.replace('static/', ''))
+            route_data = None
+        else:
+            # Send the route as data for route_map.html to draw in the browser
+            markers = [{
+                'lat': point['lat'],
+                'lon': point['lon'],
+                'name': point['name'],
+                'kind': 'station' if point.get('is_charging_station') else
+                        'source' if index == 0 else 'destination',
+                'charging_speed': point.get('charging_speed'),
+                'available_ports': point.get('available_ports')
+            } for index, point in enumerate(route_points)]
+            map_url = url_for('static', filename='route_map.html')
+            route_data = route_payload(level_geometry(route_details, MAP_ZOOM), markers, route_format)
         
         return jsonify({
             'route': map_url,
+            'route_data': route_data,
             'distance': route_details['distance'],
             'duration': route_details['duration'],
             'charging_stations': [point for point in route_points if point.get('is_charging_station', False)],
+            'reservations': plan.get('reservations', []),
             'source_address': source_coords[2] or source,
             'dest_address': dest_coords[2] or destination,
-            'message': f'Route optimized with {len([p for p in route_points if p.get("is_charging_station", False)])} charging stations'
+            'message': plan['message']
         })
 
     except Exception as e:
         print(f"Error in optimize_route: {str(e)}")
         return jsonify({'error': str(e)})
 
+MAX_BATCH_TRIPS = 1000
+
+@app.route('/api/optimize_routes', methods=['POST'])
+def optimize_routes():
+    """Plan routes for many trips in one request; trips with "reserve" set hold a port at each stop"""
+    if not session.get('logged_in'):
+        return jsonify({'error': 'Not logged in'}), 401
+
+    data = request.get_json(silent=True) or {}
+    trips = data.get('trips')
+    if not isinstance(trips, list) or not all(isinstance(trip, dict) for trip in trips):
+        return jsonify({'error': 'trips must be a list of objects'}), 400
+    if len(trips) > MAX_BATCH_TRIPS:
+        return jsonify({'error': f'At most {MAX_BATCH_TRIPS} trips per request'}), 400
+
+    try:
+        results = route_optimizer.optimize_routes(trips)
+    except Exception as e:
+        print(f"Error in optimize_routes: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+    failed = sum(1 for result in results if result['status'] == 'error')
+    return jsonify({
+        'results': results,
+        'total': len(results),
+        'succeeded': len(results) - failed,
+        'failed': failed
+    })
+
+MAX_BULK_POINTS = 10000
+MAX_NEAREST_STATIONS = 20
+
+@app.route('/api/nearest_stations', methods=['POST'])
+def nearest_stations():
+    """Nearest available charging stations for many vehicle positions in one request"""
+    if not session.get('logged_in'):
+        return jsonify({'error': 'Not logged in'}), 401
+
+    data = request.get_json(silent=True) or {}
+    points = data.get('points')
+    if not isinstance(points, list) or not all(isinstance(point, dict) for point in points):
+        return jsonify({'error': 'points must be a list of objects with lat and lon'}), 400
+    if len(points) > MAX_BULK_POINTS:
+        return jsonify({'error': f'At most {MAX_BULK_POINTS} points per request'}), 400
+    try:
+        k = int(data.get('k', 5))
+        coords = np.array([[point['lat'], point['lon']] for point in points], dtype=np.float64).reshape(-1, 2)
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'error': 'Every point needs numeric lat and lon'}), 400
+    if not 1 <= k <= MAX_NEAREST_STATIONS:
+        return jsonify({'error': f'k must be between 1 and {MAX_NEAREST_STATIONS}'}), 400
+    if not (np.isfinite(coords).all() and (np.abs(coords[:, 0]) <= 90).all() and (np.abs(coords[:, 1]) <= 180).all()):
+        return jsonify({'error': 'Coordinates out of range'}), 400
+
+    stations = route_optimizer.find_nearest_stations_bulk(coords[:, 0], coords[:, 1], k)
+    return jsonify({
+        'results': [{'id': point.get('id'), 'stations': nearest} for point, nearest in zip(points, stations)],
+        'total': len(points)
+    })
+
+@app.route('/api/station_occupancy', methods=['GET'])
+def get_station_occupancy():
+    """Live port counts for every charging station"""
+    if not session.get('logged_in'):
+        return jsonify({'error': 'Not logged in'}), 401
+    return jsonify(route_optimizer.occupancy.snapshot())
+
+@app.route('/api/station_occupancy/<station_id>', methods=['POST'])
+def update_station_occupancy(station_id):
+    """Record how many ports are in use at a station"""
+    if not session.get('logged_in'):
+        return jsonify({'error': 'Not logged in'}), 401
+    position = route_optimizer.occupancy.positions.get(station_id)
+    if position is None:
+        return jsonify({'error': 'Station not found'}), 404
+    data = request.get_json(silent=True) or {}
+    try:
+        occupied = int(data['occupied'])
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'error': 'occupied must be an integer'}), 400
+    route_optimizer.occupancy.set_occupied(position, occupied)
+    return jsonify({'station_id': station_id, 'free': route_optimizer.occupancy.free_at(position)})
+
+@app.route('/api/reservations/<reservation_id>', methods=['DELETE'])
+def release_reservation(reservation_id):
+    """Release a charging port held for a planned stop"""
+    if not session.get('logged_in'):
+        return jsonify({'error': 'Not logged in'}), 401
+    if not route_optimizer.occupancy.release(reservation_id):
+        return jsonify({'error': 'Reservation not found'}), 404
+    return jsonify({'status': 'success'})
+
 def is_station_on_route(station_loc, source_coords, dest_coords, max_deviation=0.05):
     """Check if a charging station is close enough to the route"""
     station_lat, station_lon = station_loc['lat'], station_loc['lon']
@@ -951,106 +1379,114 @@ def is_station_on_route(station_loc, source_coords, dest_coords, max_deviation=0
             min_lon <= station_lon <= max_lon)
 
 def create_route_map(route_points):
-    """Create a Folium map with the route and charging stations"""
+    """Create a Folium map with the route and charging stations, reusing an identical earlier map"""
     try:
-        # Calculate center point
-        center_lat = sum(point['lat'] for point in route_points) / len(route_points)
-        center_lon = sum(point['lon'] for point in route_points) / len(route_points)
-        
-        # Create the map with a larger zoom level for better visibility
-        m = folium.Map(location=[center_lat, center_lon], zoom_start=9)
-        
-        # Add markers for source and destination with custom icons
-        folium.Marker(
-            [route_points[0]['lat'], route_points[0]['lon']],
-            popup=f"<b>Start:</b> {route_points[0]['name']}",
-            icon=folium.Icon(color='green', icon='play', prefix='fa')
-        ).add_to(m)
-        
-        folium.Marker(
-            [route_points[-1]['lat'], route_points[-1]['lon']],
-            popup=f"<b>Destination:</b> {route_points[-1]['name']}",
-            icon=folium.Icon(color='red', icon='flag-checkered', prefix='fa')
-        ).add_to(m)
-        
-        # Add markers for charging stations with custom icons and popups
-        for point in route_points[1:-1]:
-            if point.get('is_charging_station'):
-                popup_html = f"""
-                    <div style='font-family: Arial, sans-serif; font-size: 14px;'>
-                        <b>{point['name']}</b><br>
-                        <i class='fa fa-bolt'></i> {point['charging_speed']} kW<br>
-                        <i class='fa fa-plug'></i> {point['available_ports']} ports available
-                    </div>
-                """
-                folium.Marker(
-                    [point['lat'], point['lon']],
-                    popup=folium.Popup(popup_html, max_width=200),
-                    icon=folium.Icon(color='blue', icon='plug', prefix='fa')
-                ).add_to(m)
-        
-        # Create a line connecting all points
-        points = [[point['lat'], point['lon']] for point in route_points]
-        
-        # Draw the route line
-        folium.PolyLine(
-            points,
-            weight=3,
-            color='#3388ff',
-            opacity=0.8,
-            popup='Route'
-        ).add_to(m)
-        
-        # Add arrow indicators along the route
-        line = folium.plugins.AntPath(
-            points,
-            delay=1000,
-            weight=3,
-            color='#3388ff',
-            pulse_color='#FFFFFF'
-        )
-        line.add_to(m)
-        
-        # Add distance circles around charging stations
-        for point in route_points[1:-1]:
-            if point.get('is_charging_station'):
-                folium.Circle(
-                    location=[point['lat'], point['lon']],
-                    radius=5000,  # 5km radius
-                    color='blue',
-                    fill=True,
-                    opacity=0.2
-                ).add_to(m)
-        
-        # Add fullscreen control
-        folium.plugins.Fullscreen().add_to(m)
-        
-        # Add location control
-        folium.plugins.LocateControl().add_to(m)
-        
-        # Add layer control
-        folium.LayerControl().add_to(m)
-        
-        # Save map to a temporary file
-        map_path = os.path.join(app.root_path, 'static', 'route_maps')
-        os.makedirs(map_path, exist_ok=True)
-        map_file = os.path.join(map_path, 'current_route.html')
-        
-        # Save the map with custom HTML
-        m.get_root().html.add_child(folium.Element("""
-            <style>
-                #map {
-                    width: 100% !important;
-                    height: 100% !important;
-                    position: absolute;
-                    top: 0;
-                    left: 0;
-                }
-            </style>
-        """))
-        m.save(map_file)
-        
-        return 'route_maps/current_route.html'
+        style = {
+            'zoom_start': 9, 'line_weight': 3, 'line_color': '#3388ff', 'line_opacity': 0.8,
+            'ant_path_delay': 1000, 'station_radius': 5000,
+            'controls': ['AntPath', 'Fullscreen', 'LocateControl', 'LayerControl']
+        }
+        spec = {
+            'renderer': 'app',
+            'style': style,
+            'points': [[point['lat'], point['lon'], point['name'], bool(point.get('is_charging_station')),
+                        point.get('charging_speed'), point.get('available_ports')] for point in route_points]
+        }
+
+        def render():
+            # Calculate center point
+            center_lat = sum(point['lat'] for point in route_points) / len(route_points)
+            center_lon = sum(point['lon'] for point in route_points) / len(route_points)
+            
+            # Create the map with a larger zoom level for better visibility
+            m = folium.Map(location=[center_lat, center_lon], zoom_start=style['zoom_start'])
+            
+            # Add markers for source and destination with custom icons
+            folium.Marker(
+                [route_points[0]['lat'], route_points[0]['lon']],
+                popup=f"<b>Start:</b> {route_points[0]['name']}",
+                icon=folium.Icon(color='green', icon='play', prefix='fa')
+            ).add_to(m)
+            
+            folium.Marker(
+                [route_points[-1]['lat'], route_points[-1]['lon']],
+                popup=f"<b>Destination:</b> {route_points[-1]['name']}",
+                icon=folium.Icon(color='red', icon='flag-checkered', prefix='fa')
+            ).add_to(m)
+            
+            # Add markers for charging stations with custom icons and popups
+            for point in route_points[1:-1]:
+                if point.get('is_charging_station'):
+                    popup_html = f"""
+                        <div style='font-family: Arial, sans-serif; font-size: 14px;'>
+                            <b>{point['name']}</b><br>
+                            <i class='fa fa-bolt'></i> {point['charging_speed']} kW<br>
+                            <i class='fa fa-plug'></i> {point['available_ports']} ports available
+                        </div>
+                    """
+                    folium.Marker(
+                        [point['lat'], point['lon']],
+                        popup=folium.Popup(popup_html, max_width=200),
+                        icon=folium.Icon(color='blue', icon='plug', prefix='fa')
+                    ).add_to(m)
+            
+            # Create a line connecting all points
+            points = [[point['lat'], point['lon']] for point in route_points]
+            
+            # Draw the route line
+            folium.PolyLine(
+                points,
+                weight=style['line_weight'],
+                color=style['line_color'],
+                opacity=style['line_opacity'],
+                popup='Route'
+            ).add_to(m)
+            
+            # Add arrow indicators along the route
+            line = folium.plugins.AntPath(
+                points,
+                delay=style['ant_path_delay'],
+                weight=style['line_weight'],
+                color=style['line_color'],
+                pulse_color='#FFFFFF'
+            )
+            line.add_to(m)
+            
+            # Add distance circles around charging stations
+            for point in route_points[1:-1]:
+                if point.get('is_charging_station'):
+                    folium.Circle(
+                        location=[point['lat'], point['lon']],
+                        radius=style['station_radius'],  # 5km radius
+                        color='blue',
+                        fill=True,
+                        opacity=0.2
+                    ).add_to(m)
+            
+            # Add fullscreen control
+            folium.plugins.Fullscreen().add_to(m)
+            
+            # Add location control
+            folium.plugins.LocateControl().add_to(m)
+            
+            # Add layer control
+            folium.LayerControl().add_to(m)
+            
+            # Make the map fill its frame
+            m.get_root().html.add_child(folium.Element("""
+                <style>
+                    #map {
+                        width: 100% !important;
+                        height: 100% !important;
+                        position: absolute;
+                        top: 0;
+                        left: 0;
+                    }
+                </style>
+            """))
+            return m
+
+        return f'route_maps/{map_cache.cached_map(spec, render)}'
         
     except Exception as e:
         print(f"Error creating map: {str(e)}")
@@ -1068,6 +1504,28 @@ def serve_route_map(filename):
         print(f"Error serving map file {filename}: {str(e)}")
         return jsonify({"error": "Error serving map file"}), 500
 
+@app.route('/api/cache_stats', methods=['GET'])
+def get_cache_stats():
+    """Hit/miss counters for the lookup caches"""
+    if not session.get('logged_in'):
+        return jsonify({'error': 'Not logged in'}), 401
+    return jsonify({
+        'geocode': geocode_cache.stats(),
+        'route': route_cache.stats(),
+        'route_map': map_cache.stats(),
+        'retention': retention_manager.stats(),
+        'write_behind': write_behind.stats(),
+        'telemetry_history': telemetry_history.stats(),
+        'queries': query_budget.stats()
+    })
+
+@app.route('/api/upstream_stats', methods=['GET'])
+def get_upstream_stats():
+    """Request counts and latencies for each external host this worker has called"""
+    if not session.get('logged_in'):
+        return jsonify({'error': 'Not logged in'}), 401
+    return jsonify(get_session().latency_stats())
+
 @app.route('/driver_behavior')
 def driver_behavior():
     if not session.get('logged_in'):
@@ -1081,22 +1539,32 @@ def get_driver_behavior():
     
     # Generate some behavior data if none exists
     if DriverBehavior.query.count() == 0:
-        generate_driver_behavior()
+        generate_driver_behavior(durable=True)
     
-    behaviors = DriverBehavior.query.order_by(DriverBehavior.timestamp.desc()).limit(100).all()
-    behavior_data = []
-    for behavior in behaviors:
-        vehicle = Vehicle.query.get(behavior.vehicle_id)
-        behavior_data.append({
-            'vehicle_name': vehicle.vehicle_name,
+    try:
+        since = parse_since()
+    except ValueError:
+        return jsonify({'error': 'since must be an integer version'}), 400
+
+    def serialize(behavior):
+        return {
+            'id': behavior.id,
+            'vehicle_name': behavior.vehicle.vehicle_name,
             'timestamp': behavior.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
             'speed': behavior.speed,
             'harsh_braking': behavior.harsh_braking,
             'rapid_acceleration': behavior.rapid_acceleration,
             'idle_time': behavior.idle_time,
             'score': behavior.score
-        })
-    return jsonify(behavior_data)
+        }
+
+    def build(version):
+        if since is not None:
+            return delta_page(DriverBehavior, since, serialize, version, [joinedload(DriverBehavior.vehicle)])
+        behaviors = DriverBehavior.query.options(joinedload(DriverBehavior.vehicle)).order_by(DriverBehavior.timestamp.desc()).limit(100).all()
+        return [serialize(behavior) for behavior in behaviors]
+
+    return versioned_response(['driver_behavior', 'vehicle'], build)
 
 @app.route('/maintenance_alerts')
 def maintenance_alerts():
@@ -1111,22 +1579,31 @@ def get_maintenance_alerts():
     
     # Generate some alerts if none exist
     if MaintenanceAlert.query.count() == 0:
-        generate_maintenance_alerts()
+        generate_maintenance_alerts(durable=True)
     
-    alerts = MaintenanceAlert.query.order_by(MaintenanceAlert.timestamp.desc()).all()
-    alert_data = []
-    for alert in alerts:
-        vehicle = Vehicle.query.get(alert.vehicle_id)
-        alert_data.append({
+    try:
+        since = parse_since()
+    except ValueError:
+        return jsonify({'error': 'since must be an integer version'}), 400
+
+    def serialize(alert):
+        return {
             'id': alert.id,
-            'vehicle_name': vehicle.vehicle_name,
+            'vehicle_name': alert.vehicle.vehicle_name,
             'alert_type': alert.alert_type,
             'description': alert.description,
             'timestamp': alert.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
             'priority': alert.priority,
             'status': alert.status
-        })
-    return jsonify(alert_data)
+        }
+
+    def build(version):
+        if since is not None:
+            return delta_page(MaintenanceAlert, since, serialize, version, [joinedload(MaintenanceAlert.vehicle)])
+        alerts = MaintenanceAlert.query.options(joinedload(MaintenanceAlert.vehicle)).order_by(MaintenanceAlert.timestamp.desc()).all()
+        return [serialize(alert) for alert in alerts]
+
+    return versioned_response(['maintenance_alert', 'vehicle'], build)
 
 @app.route('/api/update_alert_status', methods=['POST'])
 def update_alert_status():
@@ -1212,6 +1689,7 @@ def consumption_metrics():
         
         # Get driver behavior data
         behaviors = DriverBehavior.query.all()
+        vehicle_names = {v.id: v.vehicle_name for v in vehicles}
         total_behaviors = len(behaviors)
         avg_score = sum(b.score for b in behaviors) / total_behaviors if total_behaviors > 0 else 0
         
@@ -1235,7 +1713,7 @@ def consumption_metrics():
         
         behavior_data = [
             {
-                'vehicle': Vehicle.query.get(b.vehicle_id).vehicle_name,
+                'vehicle': vehicle_names[b.vehicle_id],
                 'score': b.score,
                 'date': b.timestamp.strftime('%Y-%m-%d')
             }
@@ -1274,12 +1752,24 @@ def report_generation():
 def get_vehicles():
     if not session.get('logged_in'):
         return jsonify({'error': 'Not logged in'}), 401
-    vehicles = Vehicle.query.all()
-    return jsonify([{
-        'id': v.id,
-        'vehicle_name': v.vehicle_name,
-        'vehicle_number': v.vehicle_number
-    } for v in vehicles])
+    try:
+        since = parse_since()
+    except ValueError:
+        return jsonify({'error': 'since must be an integer version'}), 400
+
+    def serialize(v):
+        return {
+            'id': v.id,
+            'vehicle_name': v.vehicle_name,
+            'vehicle_number': v.vehicle_number
+        }
+
+    def build(version):
+        if since is not None:
+            return delta_page(Vehicle, since, serialize, version)
+        return [serialize(v) for v in Vehicle.query.all()]
+
+    return versioned_response(['vehicle'], build)
 
 @app.route('/api/generate_report', methods=['POST'])
 def generate_report():
@@ -1291,12 +1781,12 @@ def generate_report():
         vehicles = data.get('vehicles', [])
 
         # Create reports directory if it doesn't exist
-        os.makedirs('static/reports', exist_ok=True)
+        os.makedirs(REPORTS_DIR, exist_ok=True)
 
         # Generate report filename
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         filename = f'report_{report_type}_{timestamp}.pdf'
-        filepath = os.path.join('static/reports', filename)
+        filepath = os.path.join(REPORTS_DIR, filename)
 
         # Get data based on report type
         if report_type == 'battery_health':
@@ -1443,8 +1933,9 @@ def get_reports():
 def download_report(report_id):
     """Download a generated report"""
     report = Report.query.get_or_404(report_id)
+    touch(os.path.join(REPORTS_DIR, report.filename))
     return send_from_directory(
-        os.path.join('static', 'reports'),
+        REPORTS_DIR,
         report.filename,
         as_attachment=True
     )
@@ -1454,7 +1945,7 @@ def delete_report(report_id):
     """Delete a generated report"""
     try:
         report = Report.query.get_or_404(report_id)
-        filepath = os.path.join('static', 'reports', report.filename)
+        filepath = os.path.join(REPORTS_DIR, report.filename)
         
         # Delete file if it exists
         if os.path.exists(filepath):
@@ -1548,6 +2039,29 @@ def get_vehicle_consumption(vehicle_id):
             end_date = datetime.now()
             start_date = end_date - timedelta(days=30)
 
+        # ?granularity=hour|day returns rollup buckets instead of every raw row
+        granularity = request.args.get('granularity')
+        if granularity in rollups.GRANULARITIES:
+            query = db.session.query(ConsumptionRollup, Vehicle).join(Vehicle).filter(
+                ConsumptionRollup.granularity == granularity,
+                ConsumptionRollup.bucket_start >= rollups.truncate(start_date, granularity),
+                ConsumptionRollup.bucket_start < end_date
+            )
+            if vehicle_id != 'all':
+                query = query.filter(ConsumptionRollup.vehicle_id == vehicle_id)
+            buckets = query.order_by(ConsumptionRollup.bucket_start.desc()).all()
+            return jsonify([{
+                'vehicle_name': bucket.Vehicle.vehicle_name,
+                'vehicle_number': bucket.Vehicle.vehicle_number,
+                'timestamp': bucket.ConsumptionRollup.bucket_start.isoformat(),
+                'energy_used': bucket.ConsumptionRollup.energy_used,
+                'cost': bucket.ConsumptionRollup.cost,
+                'distance': bucket.ConsumptionRollup.distance,
+                'efficiency': bucket.ConsumptionRollup.efficiency_sum / bucket.ConsumptionRollup.efficiency_count
+                              if bucket.ConsumptionRollup.efficiency_count else 0,
+                'metric_count': bucket.ConsumptionRollup.metric_count
+            } for bucket in buckets])
+
         if vehicle_id == 'all':
             # Query for all vehicles
             metrics = db.session.query(
@@ -1598,26 +2112,18 @@ def get_consumption_summary():
             end_date = datetime.now()
             start_date = end_date - timedelta(days=30)
 
-        # Query for consumption metrics
-        metrics = db.session.query(
-            Vehicle.vehicle_name,
-            Vehicle.vehicle_number,
-            func.sum(ConsumptionMetric.energy_used).label('total_energy'),
-            func.sum(ConsumptionMetric.cost).label('total_cost'),
-            func.sum(ConsumptionMetric.distance).label('total_distance'),
-            func.avg(ConsumptionMetric.efficiency).label('avg_efficiency')
-        ).join(ConsumptionMetric).filter(
-            ConsumptionMetric.timestamp.between(start_date, end_date)
-        ).group_by(Vehicle.id).all()
+        totals = consumption_totals(start_date, end_date)
+        vehicles = Vehicle.query.filter(Vehicle.id.in_(list(totals))).order_by(Vehicle.id).all() if totals else []
 
         return jsonify([{
-            'vehicle_name': metric.vehicle_name,
-            'vehicle_number': metric.vehicle_number,
-            'total_energy': round(metric.total_energy, 2) if metric.total_energy else 0,
-            'total_cost': round(metric.total_cost, 2) if metric.total_cost else 0,
-            'total_distance': round(metric.total_distance, 2) if metric.total_distance else 0,
-            'avg_efficiency': round(metric.avg_efficiency, 2) if metric.avg_efficiency else 0
-        } for metric in metrics])
+            'vehicle_name': vehicle.vehicle_name,
+            'vehicle_number': vehicle.vehicle_number,
+            'total_energy': round(totals[vehicle.id]['energy_used'], 2),
+            'total_cost': round(totals[vehicle.id]['cost'], 2),
+            'total_distance': round(totals[vehicle.id]['distance'], 2),
+            'avg_efficiency': round(totals[vehicle.id]['efficiency_sum'] / totals[vehicle.id]['efficiency_count'], 2)
+                              if totals[vehicle.id]['efficiency_count'] else 0
+        } for vehicle in vehicles])
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -1637,55 +2143,52 @@ def add_consumption_metric():
         # Calculate cost (assuming rate of ₹8 per kWh)
         cost = energy_used * 8
         
-        metric = ConsumptionMetric(
-            vehicle_id=vehicle_id,
-            timestamp=datetime.now(),
-            energy_used=energy_used,
-            cost=cost,
-            distance=distance,
-            efficiency=efficiency
-        )
-        
-        db.session.add(metric)
-        db.session.commit()
-        
+        timestamp = datetime.now()
+
+        def insert_metric():
+            metric = ConsumptionMetric(
+                vehicle_id=vehicle_id,
+                timestamp=timestamp,
+                energy_used=energy_used,
+                cost=cost,
+                distance=distance,
+                efficiency=efficiency
+            )
+            db.session.add(metric)
+            db.session.flush()
+            return metric.id
+
+        # Without ?durable=1 the metric is acknowledged once queued, before it has an id
+        durable = wants_durable_write(data)
+        metric_id = write_behind.submit(insert_metric, durable=durable)
+
         return jsonify({
             'status': 'success',
-            'message': 'Consumption metric added successfully',
+            'message': 'Consumption metric added successfully' if durable else 'Consumption metric queued',
             'data': {
-                'id': metric.id,
-                'timestamp': metric.timestamp.isoformat(),
-                'energy_used': metric.energy_used,
-                'cost': metric.cost,
-                'distance': metric.distance,
-                'efficiency': metric.efficiency
+                'id': metric_id if durable else None,
+                'timestamp': timestamp.isoformat(),
+                'energy_used': energy_used,
+                'cost': cost,
+                'distance': distance,
+                'efficiency': efficiency
             }
-        })
+        }), 200 if durable else 202
 
+    except queue.Full:
+        return jsonify({'error': 'Too many pending writes, try again shortly'}), 503, {'Retry-After': '1'}
     except Exception as e:
-        db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
 def calculate_total_distance(route_points):
     """Calculate total distance of the route in kilometers"""
-    total_distance = 0
-    for i in range(len(route_points) - 1):
-        lat1, lon1 = route_points[i]['lat'], route_points[i]['lon']
-        lat2, lon2 = route_points[i + 1]['lat'], route_points[i + 1]['lon']
-        total_distance += haversine_distance(lat1, lon1, lat2, lon2)
-    return total_distance
+    lats = np.array([point['lat'] for point in route_points], dtype=np.float64)
+    lons = np.array([point['lon'] for point in route_points], dtype=np.float64)
+    return geodesy.path_length(lats, lons)
 
 def haversine_distance(lat1, lon1, lat2, lon2):
     """Calculate the great circle distance between two points on the earth"""
-    R = 6371  # Earth's radius in kilometers
-
-    lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
-    dlat = lat2 - lat1
-    dlon = lon2 - lon1
-
-    a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
-    c = 2 * math.asin(math.sqrt(a))
-    return R * c
+    return float(geodesy.haversine(lat1, lon1, lat2, lon2))
 
 if __name__ == '__main__':
     # Create necessary directories
@@ -1693,6 +2196,7 @@ if __name__ == '__main__':
     
     with app.app_context():
         db.create_all()  # Create tables if they don't exist
+        ensure_change_tracking()
         
         # Add sample data if database is empty
         if Vehicle.query.count() == 0:
@@ -0,0 +1,222 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+CACHE_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'cache.db')
+
+
+def normalize_address(address):
+    """Normalize an address so trivially different spellings share a cache key"""
+    address = re.sub(r'[^\w\s,]', ' ', str(address).lower())
+    parts = [' '.join(part.split()) for part in address.split(',')]
+    return ', '.join(part for part in parts if part)
+
+
+class TieredCache:
+    """Two-tier key/value cache: a bounded in-memory LRU in front of a SQLite table with TTLs.
+
+    Values must be JSON serialisable and are stored zlib-compressed. The SQLite
+    tier is shared by every worker process on the host, so a lookup made by one
+    gunicorn worker is reused by the others and survives restarts. When
+    max_disk_bytes is set, the least recently accessed rows are evicted once the
+    table grows past it.
+    """
+
+    def __init__(self, name, max_entries=1024, ttl=30 * 24 * 3600, max_disk_bytes=None, db_path=CACHE_DB_PATH):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_disk_bytes = max_disk_bytes
+        self.db_path = db_path
+        self.memory = OrderedDict()  # key -> (expires_at, value)
+        self.lock = threading.Lock()
+        self.connection = None
+        self.connection_pid = None
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.fetch_time = 0.0
+
+    def connect(self):
+        """Open (or reopen after a fork) the SQLite connection for this process"""
+        if self.connection is None or self.connection_pid != os.getpid():
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            self.connection = sqlite3.connect(self.db_path, timeout=5, check_same_thread=False)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS cache_entries ('
+                'cache_name TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, '
+                'size INTEGER NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL, '
+                'PRIMARY KEY (cache_name, key))'
+            )
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS ix_cache_entries_accessed ON cache_entries (cache_name, accessed_at)'
+            )
+            self.connection.commit()
+            self.connection_pid = os.getpid()
+        return self.connection
+
+    def remember(self, key, value, expires_at):
+        """Store a value in the memory tier, evicting the least recently used entry if full"""
+        self.memory[key] = (expires_at, value)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def get(self, key):
+        """Return the cached value for key, or None if it is missing or expired"""
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self.memory.move_to_end(key)
+                    self.memory_hits += 1
+                    return entry[1]
+                del self.memory[key]
+
+            try:
+                connection = self.connect()
+                row = connection.execute(
+                    'SELECT value, expires_at FROM cache_entries WHERE cache_name = ? AND key = ?',
+                    (self.name, key)
+                ).fetchone()
+                if row is not None and row[1] > now and self.max_disk_bytes:
+                    # Keep the on-disk eviction order close to LRU
+                    connection.execute(
+                        'UPDATE cache_entries SET accessed_at = ? WHERE cache_name = ? AND key = ?',
+                        (now, self.name, key)
+                    )
+                    connection.commit()
+            except sqlite3.Error as e:
+                print(f"Error reading {self.name} cache: {e}")
+                row = None
+
+            if row is not None and row[1] > now:
+                value = json.loads(zlib.decompress(row[0]))
+                self.remember(key, value, row[1])
+                self.disk_hits += 1
+                return value
+
+            self.misses += 1
+            return None
+
+    def set(self, key, value, ttl=None):
+        """Store a value in both tiers"""
+        now = time.time()
+        expires_at = now + (self.ttl if ttl is None else ttl)
+        blob = zlib.compress(json.dumps(value, separators=(',', ':')).encode('utf-8'))
+        with self.lock:
+            self.remember(key, value, expires_at)
+            try:
+                connection = self.connect()
+                connection.execute(
+                    'INSERT OR REPLACE INTO cache_entries (cache_name, key, value, size, expires_at, accessed_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (self.name, key, blob, len(key) + len(blob), expires_at, now)
+                )
+                if self.max_disk_bytes:
+                    self.evict(connection)
+                connection.commit()
+            except sqlite3.Error as e:
+                print(f"Error writing {self.name} cache: {e}")
+
+    def get_or_fetch(self, key, fetch):
+        """Return the cached value for key, calling fetch() and caching its result on a miss.
+
+        A fetch result of None is treated as a failure and is not cached.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        started = time.perf_counter()
+        value = fetch()
+        with self.lock:
+            self.fetch_time += time.perf_counter() - started
+
+        if value is not None:
+            self.set(key, value)
+        return value
+
+    def evict(self, connection):
+        """Delete the least recently accessed rows until the table fits in max_disk_bytes"""
+        total = connection.execute('SELECT COALESCE(SUM(size), 0) FROM cache_entries WHERE cache_name = ?',
+                                   (self.name,)).fetchone()[0]
+        if total <= self.max_disk_bytes:
+            return
+
+        rows = connection.execute(
+            'SELECT key, size FROM cache_entries WHERE cache_name = ? ORDER BY accessed_at',
+            (self.name,)
+        )
+        stale = []
+        for key, size in rows:
+            if total <= self.max_disk_bytes:
+                break
+            stale.append((self.name, key))
+            total -= size
+        connection.executemany('DELETE FROM cache_entries WHERE cache_name = ? AND key = ?', stale)
+
+    def purge_expired(self):
+        """Delete expired entries from the SQLite tier"""
+        with self.lock:
+            try:
+                connection = self.connect()
+                connection.execute('DELETE FROM cache_entries WHERE cache_name = ? AND expires_at <= ?',
+                                   (self.name, time.time()))
+                connection.commit()
+            except sqlite3.Error as e:
+                print(f"Error purging {self.name} cache: {e}")
+
+    def stats(self):
+        """Hit/miss counters and an estimate of the upstream latency the cache has saved"""
+        with self.lock:
+            hits = self.memory_hits + self.disk_hits
+            avg_fetch = self.fetch_time / self.misses if self.misses else 0.0
+            return {
+                'memory_entries': len(self.memory),
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': round(hits / (hits + self.misses), 4) if hits + self.misses else 0.0,
+                'avg_fetch_seconds': round(avg_fetch, 4),
+                'estimated_seconds_saved': round(hits * avg_fetch, 2)
+            }
+
+
+# Shared by every geocoder in the app; keys are prefixed with the provider name
+geocode_cache = TieredCache('geocode', max_entries=4096)
+
+
+def cached_geocode(provider, address, fetch):
+    """Geocode through the shared cache, keyed on provider and normalized address"""
+    return geocode_cache.get_or_fetch(f"{provider}:{normalize_address(address)}", fetch)
+
+
+# Routes are keyed on endpoints snapped to ROUTE_GRID_PRECISION decimal places
+# (3 places is roughly 110 m), so repeated trips along the same corridor share
+# an entry even when the geocoded points differ slightly.
+ROUTE_GRID_PRECISION = 3
+route_cache = TieredCache('route', max_entries=512, ttl=7 * 24 * 3600, max_disk_bytes=64 * 1024 * 1024)
+
+
+def route_cache_key(provider, profile, coords, options=None, precision=ROUTE_GRID_PRECISION):
+    """Cache key for a route between (lat, lon) points"""
+    snapped = ';'.join(f"{round(lat, precision):.{precision}f},{round(lon, precision):.{precision}f}"
+                       for lat, lon in coords)
+    return f"{provider}:{profile}:{snapped}:{json.dumps(options or {}, sort_keys=True)}"
+
+
+def cached_route(provider, profile, coords, fetch, options=None, precision=ROUTE_GRID_PRECISION):
+    """Fetch a route through the shared route cache.
+
+    fetch() should return a dict with distance, duration and an encoded
+    polyline geometry, or None on failure.
+    """
+    return route_cache.get_or_fetch(route_cache_key(provider, profile, coords, options, precision), fetch)
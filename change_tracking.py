@@ -0,0 +1,75 @@
+"""Monotonic change versions for tables, maintained by SQLite triggers.
+
+Every tracked table gets an integer version column. Each insert or update
+bumps the table's counter in change_counter and stamps the row with it, and
+each delete records the id in deleted_record under a new version. Because the
+triggers live in the database, writes made through the ORM, bulk executemany
+statements, the write-behind queue or another process are all versioned
+alike. A client that last saw version N asks for rows with version > N plus
+the ids deleted since, and the current counter doubles as an ETag.
+"""
+import hashlib
+
+from sqlalchemy import inspect, text
+
+
+def install(connection, table_names):
+    """Add version columns, counters and triggers to existing tables; safe to run on every start-up"""
+    connection.execute(text(
+        'CREATE TABLE IF NOT EXISTS change_counter (name VARCHAR(50) PRIMARY KEY, version INTEGER NOT NULL)'
+    ))
+    connection.execute(text(
+        'CREATE TABLE IF NOT EXISTS deleted_record ('
+        'table_name VARCHAR(50) NOT NULL, record_id INTEGER NOT NULL, version INTEGER NOT NULL, '
+        'PRIMARY KEY (table_name, version))'
+    ))
+    inspector = inspect(connection)
+    for name in table_names:
+        if not inspector.has_table(name):
+            continue
+        if 'version' not in [column['name'] for column in inspector.get_columns(name)]:
+            # Existing rows count as changed once, so a sync from version 0 returns all of them
+            connection.execute(text(f'ALTER TABLE {name} ADD COLUMN version INTEGER NOT NULL DEFAULT 0'))
+            connection.execute(text(f'UPDATE {name} SET version = id'))
+        connection.execute(text(f'CREATE INDEX IF NOT EXISTS ix_{name}_version ON {name} (version)'))
+        connection.execute(text(
+            f"INSERT OR IGNORE INTO change_counter (name, version) "
+            f"SELECT '{name}', COALESCE(MAX(version), 0) FROM {name}"
+        ))
+
+        bump = f"UPDATE change_counter SET version = version + 1 WHERE name = '{name}';"
+        stamp = f"UPDATE {name} SET version = (SELECT version FROM change_counter WHERE name = '{name}') WHERE id = NEW.id;"
+        connection.execute(text(
+            f'CREATE TRIGGER IF NOT EXISTS {name}_version_insert AFTER INSERT ON {name} '
+            f'BEGIN {bump} {stamp} END'
+        ))
+        # The stamping UPDATE changes version, which the WHEN clause skips, so the trigger does not recurse
+        connection.execute(text(
+            f'CREATE TRIGGER IF NOT EXISTS {name}_version_update AFTER UPDATE ON {name} '
+            f'WHEN NEW.version = OLD.version BEGIN {bump} {stamp} END'
+        ))
+        connection.execute(text(
+            f'CREATE TRIGGER IF NOT EXISTS {name}_version_delete AFTER DELETE ON {name} '
+            f'BEGIN {bump} INSERT INTO deleted_record (table_name, record_id, version) '
+            f"SELECT '{name}', OLD.id, version FROM change_counter WHERE name = '{name}'; END"
+        ))
+
+
+def current_versions(session, table_names):
+    """Latest change version of each table, 0 for tables never changed"""
+    versions = dict(session.execute(text('SELECT name, version FROM change_counter')).all())
+    return [versions.get(name, 0) for name in table_names]
+
+
+def deleted_since(session, table_name, since):
+    """Ids deleted from a table after version since"""
+    return [row[0] for row in session.execute(
+        text('SELECT record_id FROM deleted_record WHERE table_name = :name AND version > :since ORDER BY version'),
+        {'name': table_name, 'since': since}
+    )]
+
+
+def make_etag(versions, query_string=b''):
+    """ETag value naming the table versions a response was built from and its query parameters"""
+    query = hashlib.sha1(query_string).hexdigest()[:12]
+    return '.'.join(str(version) for version in versions) + f'-{query}'
@@ -0,0 +1,132 @@
+import numpy as np
+
+
+def plan_charging_stops(stations, total_distance, start_soc, ev_range, charge_time, avg_speed,
+                        reserve_soc=20, max_soc=90, soc_step=10, stop_overhead=5 / 60, road_legs=None):
+    """Choose where to stop and how far to charge so the trip takes the least total time.
+
+    stations are dicts with 'chainage' (km along the route), 'distance' (km off
+    the route) and 'charging_speed' (kW), e.g. from
+    RouteOptimizer.find_stations_along_route. charge_time(current, target, kW)
+    returns hours, state of charge values are percentages and avg_speed is in
+    km/h. road_legs(origins, destination), if given, returns arrays of the
+    road km and driving hours from the stations at positions origins in
+    stations to the one at destination, NaN where unknown; a station-to-station
+    leg shorter than leaving and rejoining the route is driven directly.
+
+    The search graph has one node per (station, departure charge) pair, with
+    departure charges on a soc_step grid up to max_soc, plus the origin and the
+    destination. An edge drives from one node to any later station or the
+    destination reachable without dropping below reserve_soc, including the
+    detours off and back onto the route, then charges up to the next node's
+    level. Stations are visited in chainage order, so the graph is a DAG and
+    its shortest path is found in a single pass over the stations, with each
+    station's incoming edges relaxed as one array operation. A departure charge
+    reached no sooner than a higher one at the same station is pruned.
+
+    Returns {'total_time': hours, 'stops': [...]} or None if the destination
+    cannot be reached.
+    """
+    per_km = 100 / ev_range
+    indices = np.array(sorted((i for i, s in enumerate(stations) if 0 <= s['chainage'] <= total_distance),
+                              key=lambda i: stations[i]['chainage']), dtype=np.int64)
+    stations = [stations[i] for i in indices]
+    count = len(stations) + 2
+    destination = count - 1
+
+    chainage = np.array([0.0] + [s['chainage'] for s in stations] + [total_distance], dtype=np.float64)
+    detour = np.array([0.0] + [s['distance'] for s in stations] + [0.0], dtype=np.float64)
+    hours_per_soc = np.array([0.0] + [charge_time(0, 100, s['charging_speed']) / 100 for s in stations] + [0.0])
+    # The leg from p to a later node n is (detour - chainage)[p] + (detour + chainage)[n] km, so a
+    # state's charge and time can be stored relative to the route start and shifted once per node
+    back, ahead = detour - chainage, detour + chainage
+    ahead_soc, ahead_time = ahead * per_km, ahead / avg_speed
+
+    # Departure charge levels: the grid at stations, only start_soc at the origin
+    grid = np.append(np.arange(soc_step, max_soc, soc_step, dtype=np.float64), max_soc)
+    grid = grid[grid > reserve_soc]
+    width = len(grid)
+    # Per (node, level) state: charge left and trip time if driven back to the start of the route,
+    # -inf charge for states not reached or pruned
+    charge = np.full((count, width), -np.inf)
+    elapsed = np.full((count, width), np.inf)
+    charge[0, 0], elapsed[0, 0] = start_soc, 0.0
+    parent = np.full((count, width), -1, dtype=np.intp)  # Flat index of the previous state
+    arrival_soc = np.zeros((count, width))
+    positions = np.arange(count * width)
+
+    # No node further back than a full usable battery can reach this one
+    reach = (max(start_soc, max_soc) - reserve_soc) / per_km
+    firsts = np.searchsorted(chainage, chainage - reach)
+
+    for node in range(1, count):
+        first = firsts[node]
+        if first == node:
+            continue
+        arrival = charge[first:node] - ahead_soc[node]
+        cost = elapsed[first:node] + ahead_time[node]
+        if road_legs is not None and 1 < node < destination:
+            # Earlier stations with a shorter direct road leg to this one use it instead
+            since = max(first, 1)
+            via_route = back[since:node] + ahead[node]
+            km, hours = road_legs(indices[since - 1:node - 1], indices[node - 1])
+            direct = km < via_route
+            arrival[since - first:] += np.where(direct, (via_route - km) * per_km, 0.0)[:, np.newaxis]
+            cost[since - first:] += np.where(direct, hours - via_route / avg_speed, 0.0)[:, np.newaxis]
+
+        # Every earlier state that reaches this node above the reserve
+        states = np.flatnonzero(arrival >= reserve_soc)
+        if not len(states):
+            continue
+        arrival = arrival.ravel()[states]
+        cost = cost.ravel()[states]
+        states += first * width
+
+        if node == destination:
+            choice = np.argmin(cost)
+            return {
+                'total_time': round(float(cost[choice]), 2),
+                'stops': collect_stops(stations, grid, parent, arrival_soc, states[choice], charge_time)
+            }
+
+        # Charging from arrival a up to level g costs (g - a) * rate, so for each
+        # level the best predecessor minimises cost - a * rate over all arrivals
+        # a <= g: a running minimum over the arrivals sorted by charge.
+        rate = hours_per_soc[node]
+        order = np.argsort(arrival)
+        arrival, states = arrival[order], states[order]
+        key = cost[order] - arrival * rate
+        running = np.minimum.accumulate(key)
+        running_at = np.maximum.accumulate(positions[:len(key)] * (key <= running))
+
+        upto = np.searchsorted(arrival, grid, side='right') - 1
+        choice = running_at[upto]
+        best = np.where(upto >= 0, running[upto] + grid * rate + stop_overhead, np.inf)
+        parent[node] = states[choice]
+        arrival_soc[node] = arrival[choice]
+
+        # Prune dominated states: a level is dropped when a higher one is reached no later, since
+        # whatever can follow it can follow the higher charge at no extra cost
+        keep = best < np.append(np.minimum.accumulate(best[:0:-1])[::-1], np.inf)
+        charge[node] = np.where(keep, grid - back[node] * per_km, -np.inf)
+        elapsed[node] = best + back[node] / avg_speed
+
+    return None
+
+
+def collect_stops(stations, grid, parent, arrival_soc, state, charge_time):
+    """Walk the parents back from the last stop's flat (node, level) state and summarise each charging stop"""
+    stops = []
+    node, level = divmod(int(state), len(grid))
+    while node > 0:
+        station = stations[node - 1]
+        arrival, departure = float(arrival_soc[node, level]), float(grid[level])
+        stops.append({
+            'station': station,
+            'arrival_soc': round(arrival, 1),
+            'departure_soc': departure,
+            'charging_time': charge_time(arrival, departure, station['charging_speed'])
+        })
+        node, level = divmod(int(parent[node, level]), len(grid))
+    stops.reverse()
+    return stops
@@ -0,0 +1,177 @@
+"""Live fleet state pushed to dashboards as Server-Sent Events.
+
+One thread per process watches the vehicle table's change version (see
+change_tracking), a single-row lookup. Only when the version moves does it
+load the vehicles stamped since the last version it saw and the ids deleted
+since, diff them against its state and serialise a single delta event with
+the changed vehicles and the new fleet counters. That event is handed to
+every connected dashboard's queue, so the cost of a change does not grow
+with the number of open pages. Because the triggers stamp every write, the
+version also picks up writes made by other worker processes and by the
+telemetry gateway. Writes in this process poke the thread so it checks at
+once. Each open stream holds its request for as long as the page is open, so
+the app is served by gevent workers (see the Procfile and render.yaml),
+where a waiting stream costs a greenlet rather than a thread.
+"""
+import json
+import os
+import queue
+import threading
+
+import numpy as np
+
+POLL_INTERVAL = 1.0  # Seconds between checks of the vehicle change version while dashboards are connected
+KEEPALIVE_INTERVAL = 15  # Seconds of silence before a comment line keeps proxies from closing the stream
+SUBSCRIBER_BACKLOG = 32  # Events queued for a slow client before it is sent a fresh snapshot instead
+BATTERY_LABELS = ['0-20%', '21-40%', '41-60%', '61-80%', '81-100%']
+STATUS_LABELS = ['Active', 'Charging', 'Inactive', 'Maintenance']
+
+
+def vehicle_status(battery_status, speed):
+    """Status shown for a vehicle in the fleet list"""
+    return 'Active' if speed > 0 else 'Charging' if battery_status < 20 else 'Inactive'
+
+
+def fleet_stats(battery, speed):
+    """Dashboard counters for arrays of battery levels and speeds"""
+    battery = np.asarray(battery, dtype=np.float64)
+    speed = np.asarray(speed, dtype=np.float64)
+    total = len(battery)
+    return {
+        'total_vehicles': total,
+        'avg_battery': int(round(battery.mean())) if total else 0,
+        'charging_vehicles': int((battery < 20).sum()),
+        'active_vehicles': int((speed > 0).sum()),
+        'status_labels': STATUS_LABELS,
+        'status_data': [int((speed > 0).sum()), int((battery < 20).sum()),
+                        int(((speed == 0) & (battery >= 20)).sum()), int((battery < 10).sum())],
+        'battery_labels': BATTERY_LABELS,
+        'battery_data': [int(((battery >= low) & (battery <= high)).sum())
+                         for low, high in ((0, 20), (21, 40), (41, 60), (61, 80), (81, 100))]
+    }
+
+
+def format_event(name, sequence, payload):
+    return f'id: {sequence}\nevent: {name}\ndata: {json.dumps(payload, separators=(",", ":"))}\n\n'
+
+
+class FleetStream:
+    """Fans vehicle changes out to every subscribed dashboard in this process.
+
+    load_changes(since) returns the current vehicle version, the
+    (id, name, battery_status, speed, location) rows changed after version
+    since, and the ids deleted after it; with since=0 the rows are the whole
+    fleet and nothing is deleted.
+    """
+
+    def __init__(self, load_changes, poll_interval=POLL_INTERVAL):
+        self.load_changes = load_changes
+        self.poll_interval = poll_interval
+        self.state = {}  # id -> (name, battery_status, speed, location)
+        self.version = 0
+        self.stats = fleet_stats([], [])
+        self.sequence = 0
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+        self.thread_pid = None
+
+    def start(self):
+        """Start the polling thread (again after a fork) if it is not running"""
+        with self.lock:
+            if self.thread is not None and self.thread_pid == os.getpid() and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self.run, name='fleet-stream', daemon=True)
+            self.thread_pid = os.getpid()
+            self.thread.start()
+
+    def poke(self):
+        """Check for changes now instead of at the next poll, e.g. right after a write in this process"""
+        self.wake.set()
+
+    def subscribe(self):
+        """Register a client; return its event queue and the snapshot event to send first"""
+        self.start()
+        self.refresh()
+        subscriber = queue.Queue(SUBSCRIBER_BACKLOG)
+        with self.lock:
+            self.subscribers.add(subscriber)
+            return subscriber, self.snapshot_event()
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def snapshot_event(self):
+        """Full state as an event; call with the lock held"""
+        vehicles = [{'id': vehicle_id, 'n': name, 'b': battery, 's': speed, 'l': location}
+                    for vehicle_id, (name, battery, speed, location) in sorted(self.state.items())]
+        return format_event('snapshot', self.sequence, {'vehicles': vehicles, 'stats': self.stats})
+
+    def run(self):
+        while True:
+            self.wake.wait(self.poll_interval)
+            self.wake.clear()
+            with self.lock:
+                listening = bool(self.subscribers)
+            if not listening:
+                continue
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Error refreshing fleet stream: {e}")
+
+    def refresh(self):
+        """Load vehicles changed since the last version seen, and publish one delta event if any differ"""
+        with self.refresh_lock:
+            with self.lock:
+                previous, since = self.state, self.version
+            version, rows, deleted = self.load_changes(since)
+            if version == since:
+                return False
+            if version < since:
+                # The counter went backwards, e.g. the database was recreated: start again from the whole fleet
+                version, rows, deleted = self.load_changes(0)
+                state = {}
+            else:
+                state = dict(previous)
+            for vehicle_id in deleted:
+                state.pop(vehicle_id, None)
+            changed = []
+            for row in rows:
+                vehicle_id, current = row[0], (row[1], row[2], row[3], row[4])
+                state[vehicle_id] = current
+                before = previous.get(vehicle_id)
+                if before == current:
+                    continue
+                # Only the fields that changed: n(ame), b(attery), s(peed), l(ocation)
+                delta = {'id': vehicle_id}
+                for key, old, new in zip('nbsl', before or (None,) * 4, current):
+                    if before is None or old != new:
+                        delta[key] = new
+                changed.append(delta)
+            removed = [vehicle_id for vehicle_id in previous if vehicle_id not in state]
+            if not changed and not removed:
+                with self.lock:
+                    self.state, self.version = state, version
+                return False
+
+            stats = fleet_stats([value[1] for value in state.values()], [value[2] for value in state.values()])
+            with self.lock:
+                self.state, self.stats, self.version = state, stats, version
+                self.sequence += 1
+                event = format_event('delta', self.sequence, {'vehicles': changed, 'removed': removed, 'stats': stats})
+                for subscriber in self.subscribers:
+                    try:
+                        subscriber.put_nowait(event)
+                    except queue.Full:
+                        # Too far behind for deltas to catch up: replace its backlog with a snapshot
+                        while not subscriber.empty():
+                            try:
+                                subscriber.get_nowait()
+                            except queue.Empty:
+                                break
+                        subscriber.put_nowait(self.snapshot_event())
+            return True
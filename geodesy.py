@@ -0,0 +1,109 @@
+import numpy as np
+
+EARTH_RADIUS_KM = 6371  # Earth's radius in kilometers
+DEFAULT_CHUNK_SIZE = 2048  # Rows per block in many-to-many computations
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Great circle distance in km between points given in degrees.
+
+    Accepts scalars or arrays and follows NumPy broadcasting, so the same
+    kernel serves one-to-one, one-to-many and element-wise comparisons.
+    """
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(v, dtype=np.float64))
+                              for v in (lat1, lon1, lat2, lon2))
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def distances_from_point(lat, lon, lats, lons):
+    """Distances in km from a single point to every point in lats/lons"""
+    return haversine(lat, lon, lats, lons)
+
+
+def iter_distance_chunks(lats1, lons1, lats2, lons2, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield (row offset, block) pairs of the lats1 x lats2 distance matrix.
+
+    Each block covers at most chunk_size rows, which bounds the size of the
+    temporaries regardless of how many points are on either side.
+    """
+    lats1 = np.asarray(lats1, dtype=np.float64)
+    lons1 = np.asarray(lons1, dtype=np.float64)
+    lats2 = np.asarray(lats2, dtype=np.float64)[np.newaxis, :]
+    lons2 = np.asarray(lons2, dtype=np.float64)[np.newaxis, :]
+
+    for start in range(0, len(lats1), chunk_size):
+        stop = start + chunk_size
+        block = haversine(lats1[start:stop, np.newaxis], lons1[start:stop, np.newaxis], lats2, lons2)
+        yield start, block
+
+
+def distance_matrix(lats1, lons1, lats2, lons2, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Full many-to-many distance matrix in km, computed in row chunks"""
+    result = np.empty((len(lats1), len(lats2)), dtype=np.float64)
+    for start, block in iter_distance_chunks(lats1, lons1, lats2, lons2, chunk_size):
+        result[start:start + len(block)] = block
+    return result
+
+
+def nearest(lats1, lons1, lats2, lons2, chunk_size=DEFAULT_CHUNK_SIZE):
+    """For each point in lats1/lons1 return (index, distance in km) of the closest point in lats2/lons2"""
+    indices = np.empty(len(lats1), dtype=np.intp)
+    distances = np.empty(len(lats1), dtype=np.float64)
+    if len(lats2) == 0:
+        indices.fill(-1)
+        distances.fill(np.inf)
+        return indices, distances
+
+    for start, block in iter_distance_chunks(lats1, lons1, lats2, lons2, chunk_size):
+        stop = start + len(block)
+        indices[start:stop] = block.argmin(axis=1)
+        distances[start:stop] = block[np.arange(len(block)), indices[start:stop]]
+    return indices, distances
+
+
+def segment_lengths(lats, lons):
+    """Length in km of each consecutive segment of a path"""
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    return haversine(lats[:-1], lons[:-1], lats[1:], lons[1:])
+
+
+def cumulative_distances(lats, lons):
+    """Distance in km along a path to each of its vertices, starting at 0"""
+    lengths = segment_lengths(lats, lons)
+    return np.concatenate(([0.0], np.cumsum(lengths)))
+
+
+def path_length(lats, lons):
+    """Total length in km of a path"""
+    if len(lats) < 2:
+        return 0.0
+    return float(segment_lengths(lats, lons).sum())
+
+
+def to_cartesian(lats, lons):
+    """Convert degrees to Earth-centred x, y, z coordinates in km"""
+    lats = np.radians(np.asarray(lats, dtype=np.float64))
+    lons = np.radians(np.asarray(lons, dtype=np.float64))
+    cos_lat = np.cos(lats)
+    return EARTH_RADIUS_KM * np.stack([cos_lat * np.cos(lons), cos_lat * np.sin(lons), np.sin(lats)], axis=-1)
+
+
+def point_segment_distances(points, seg_start, seg_end):
+    """Distance in km from each point to the matching segment, and the fraction along it of the closest point.
+
+    All arguments are (N, 3) arrays from to_cartesian. Distances are measured
+    in 3D and converted back to arc length, which is accurate for segments
+    much shorter than the Earth's radius.
+    """
+    direction = seg_end - seg_start
+    length_sq = np.einsum('ij,ij->i', direction, direction)
+    t = np.einsum('ij,ij->i', points - seg_start, direction) / np.where(length_sq > 0, length_sq, 1.0)
+    t = np.clip(t, 0, 1)
+    offset = points - (seg_start + t[:, np.newaxis] * direction)
+    chord = np.sqrt(np.einsum('ij,ij->i', offset, offset))
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.clip(chord / (2 * EARTH_RADIUS_KM), 0, 1)), t
@@ -0,0 +1,146 @@
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from geopy.adapters import RequestsAdapter
+
+DEFAULT_TIMEOUT = (3.05, 10)  # (connect, read) seconds
+LATENCY_SAMPLES = 512  # Recent requests kept per host for percentiles
+LOOKUP_WORKERS = 16  # Threads shared by concurrent lookups within a request
+
+
+class OutboundSession(requests.Session):
+    """requests.Session for all outbound calls: pooled keep-alive connections per host,
+    default connect/read timeouts, bounded retries with jittered backoff and
+    per-host latency metrics.
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, retries=2, pool_maxsize=16):
+        super().__init__()
+        self.timeout = timeout
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset({'GET', 'HEAD'}),
+            backoff_factor=0.3,
+            backoff_jitter=0.3,
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=pool_maxsize, max_retries=retry)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+        self.stats_lock = threading.Lock()
+        self.host_stats = {}
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        host = urlsplit(url).netloc
+        started = time.perf_counter()
+        try:
+            response = super().request(method, url, **kwargs)
+        except requests.RequestException:
+            self.record(host, time.perf_counter() - started, error=True)
+            raise
+        self.record(host, time.perf_counter() - started, error=response.status_code >= 500)
+        return response
+
+    def record(self, host, elapsed, error=False):
+        """Add one request to the host's latency metrics"""
+        with self.stats_lock:
+            stats = self.host_stats.get(host)
+            if stats is None:
+                stats = self.host_stats[host] = {
+                    'requests': 0, 'errors': 0, 'total_seconds': 0.0, 'max_seconds': 0.0,
+                    'recent': deque(maxlen=LATENCY_SAMPLES)
+                }
+            stats['requests'] += 1
+            stats['errors'] += int(error)
+            stats['total_seconds'] += elapsed
+            stats['max_seconds'] = max(stats['max_seconds'], elapsed)
+            stats['recent'].append(elapsed)
+
+    def latency_stats(self):
+        """Per-host request counts, error counts and latencies in milliseconds"""
+        with self.stats_lock:
+            result = {}
+            for host, stats in self.host_stats.items():
+                recent = sorted(stats['recent'])
+                result[host] = {
+                    'requests': stats['requests'],
+                    'errors': stats['errors'],
+                    'avg_ms': round(stats['total_seconds'] / stats['requests'] * 1000, 1),
+                    'p50_ms': round(recent[len(recent) // 2] * 1000, 1),
+                    'p95_ms': round(recent[min(len(recent) - 1, int(len(recent) * 0.95))] * 1000, 1),
+                    'max_ms': round(stats['max_seconds'] * 1000, 1)
+                }
+            return result
+
+
+session_lock = threading.Lock()
+shared_session = None
+shared_session_pid = None
+
+
+def get_session():
+    """Return the process-wide outbound session, creating it after start-up or a fork"""
+    global shared_session, shared_session_pid
+    with session_lock:
+        if shared_session is None or shared_session_pid != os.getpid():
+            shared_session = OutboundSession()
+            shared_session_pid = os.getpid()
+        return shared_session
+
+
+lookup_pool = None
+lookup_pool_pid = None
+
+
+def get_lookup_pool():
+    """Return the process-wide thread pool for concurrent outbound lookups"""
+    global lookup_pool, lookup_pool_pid
+    with session_lock:
+        if lookup_pool is None or lookup_pool_pid != os.getpid():
+            lookup_pool = ThreadPoolExecutor(max_workers=LOOKUP_WORKERS, thread_name_prefix='lookup')
+            lookup_pool_pid = os.getpid()
+        return lookup_pool
+
+
+def gather(*calls):
+    """Run independent zero-argument calls concurrently and return their results in order.
+
+    The first exception raised by any call is re-raised once all of them have
+    finished. Must not be called from inside a lookup pool thread.
+    """
+    futures = [get_lookup_pool().submit(call) for call in calls]
+    errors = [future.exception() for future in futures]
+    for error in errors:
+        if error is not None:
+            raise error
+    return [future.result() for future in futures]
+
+
+class GeopyAdapter(RequestsAdapter):
+    """geopy adapter that sends geocoder requests through the shared outbound session"""
+
+    def __init__(self, *, proxies, ssl_context):
+        super().__init__(proxies=proxies, ssl_context=ssl_context)
+        self.session.close()
+        self.session = get_session()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass  # The shared session outlives any one geocoder
+
+    def __del__(self):
+        pass
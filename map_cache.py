@@ -0,0 +1,62 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from retention import touch
+
+ROUTE_MAPS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'route_maps')
+
+# Striped locks so concurrent requests for the same map in this process render it once
+render_locks = [threading.Lock() for _ in range(64)]
+stats_lock = threading.Lock()
+map_stats = {'hits': 0, 'renders': 0}
+
+
+def map_key(spec):
+    """Content hash of everything that affects a rendered map"""
+    encoded = json.dumps(spec, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()[:32]
+
+
+def write_atomic(path, write):
+    """Call write(temp_path) and move the result into place, so readers never see a partial file"""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+    os.close(fd)
+    try:
+        write(temp_path)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def cached_map(spec, render, directory=ROUTE_MAPS_DIR):
+    """Return the file name of the map described by spec, rendering it only if it is not on disk yet.
+
+    spec must capture the geometry, markers and styling of the map, since
+    identical specs share one file. render() returns a folium.Map.
+    """
+    key = map_key(spec)
+    filename = f'route_{key}.html'
+    path = os.path.join(directory, filename)
+    with render_locks[int(key[:8], 16) % len(render_locks)]:
+        rendered = not os.path.exists(path)
+        if rendered:
+            write_atomic(path, render().save)
+        else:
+            touch(path)
+
+    with stats_lock:
+        map_stats['renders' if rendered else 'hits'] += 1
+    return filename
+
+
+def stats():
+    """Counts of maps served from disk and maps rendered by this process"""
+    with stats_lock:
+        return dict(map_stats)
@@ -0,0 +1,221 @@
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+import numpy as np
+
+OCCUPANCY_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'occupancy.db')
+REFRESH_INTERVAL = 1.0  # Seconds between reloads of the free-port snapshot, picking up other workers' changes
+DEFAULT_RESERVATION_TTL = 3600  # Seconds a reservation holds a port
+
+# Ports free at a station: its capacity less the ports in use and those held by unexpired reservations
+FREE_PORTS_SQL = (
+    's.capacity - s.occupied - COALESCE((SELECT SUM(r.ports) FROM reservation r '
+    'WHERE r.station_id = s.station_id AND r.expires_at > :now), 0)'
+)
+
+
+def read_only(counts):
+    """Read-only view of counts, for handing out while counts is still patched in place"""
+    view = counts.view()
+    view.setflags(write=False)
+    return view
+
+
+class OccupancyStore:
+    """Live free-port counts per charging station with atomic reservations.
+
+    Stations are addressed by their position in the station file. Counts and
+    reservations live in a SQLite database shared by every worker process on
+    the host. A reservation is a single conditional INSERT that only adds the
+    row while enough ports are free, and SQLite runs writes one at a time, so
+    two workers can never both take the last port. Expired reservations stop
+    counting as soon as they expire and are deleted later. Planners read a
+    read-only NumPy array of free ports. A change made here patches only its
+    station's slot, and a background thread, started with the store and again
+    in each forked child, reloads the whole array every REFRESH_INTERVAL to
+    pick up other workers' changes, so lookups on the hot path never take a
+    lock or query the database.
+    """
+
+    def __init__(self, station_ids, capacities, db_path=OCCUPANCY_DB_PATH):
+        self.station_ids = [str(station_id) for station_id in station_ids]
+        self.positions = {station_id: i for i, station_id in enumerate(self.station_ids)}
+        self.capacity = np.asarray(capacities, dtype=np.int32).copy()
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.connection = None
+        self.connection_pid = None
+        self.thread_lock = threading.Lock()
+        self.thread = None
+        self.thread_pid = None
+        self.counts = np.maximum(self.capacity, 0)  # Written under the lock; readers get self.free
+        self.free = read_only(self.counts)
+        with self.lock:
+            connection = self.connect()
+            with connection:
+                connection.executemany(
+                    'INSERT INTO station_occupancy (station_id, capacity, occupied) VALUES (?, ?, 0) '
+                    'ON CONFLICT (station_id) DO UPDATE SET capacity = excluded.capacity',
+                    zip(self.station_ids, self.capacity.tolist())
+                )
+        self.refresh()
+        self.start()
+        os.register_at_fork(after_in_child=self.after_fork)
+
+    def after_fork(self):
+        """In a forked child: drop locks another thread may have held at the fork, and restart the refresh thread"""
+        self.lock = threading.Lock()
+        self.thread_lock = threading.Lock()
+        self.start()
+
+    def connect(self):
+        """Open (or reopen after a fork) the SQLite connection for this process; call with the lock held"""
+        if self.connection is None or self.connection_pid != os.getpid():
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            self.connection = sqlite3.connect(self.db_path, timeout=10, check_same_thread=False)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            # Reservations are short-lived holds: a commit need not wait for the disk, only for the write lock
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS station_occupancy ('
+                'station_id TEXT PRIMARY KEY, capacity INTEGER NOT NULL, occupied INTEGER NOT NULL)'
+            )
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS reservation ('
+                'id TEXT PRIMARY KEY, station_id TEXT NOT NULL, ports INTEGER NOT NULL, expires_at REAL NOT NULL)'
+            )
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS ix_reservation_station ON reservation (station_id, expires_at)'
+            )
+            self.connection.commit()
+            self.connection_pid = os.getpid()
+        return self.connection
+
+    def start(self):
+        """Start the snapshot refresh thread (again after a fork) if it is not running"""
+        with self.thread_lock:
+            if self.thread is not None and self.thread_pid == os.getpid() and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self.run, name='occupancy-refresh', daemon=True)
+            self.thread_pid = os.getpid()
+            self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(REFRESH_INTERVAL)
+            try:
+                self.refresh()
+            except sqlite3.Error as e:
+                print(f"Error refreshing station occupancy: {e}")
+
+    def refresh(self):
+        """Reload the free-port snapshot from the database and delete expired reservations"""
+        now = time.time()
+        with self.lock:
+            connection = self.connect()
+            with connection:
+                connection.execute('DELETE FROM reservation WHERE expires_at <= ?', (now,))
+            rows = connection.execute(
+                f'SELECT s.station_id, {FREE_PORTS_SQL} FROM station_occupancy s', {'now': now}
+            ).fetchall()
+            counts = self.capacity.copy()
+            for station_id, ports in rows:
+                position = self.positions.get(station_id)
+                if position is not None:
+                    counts[position] = ports
+            self.counts = np.maximum(counts, 0)
+            self.free = read_only(self.counts)
+
+    def update(self, connection, position, now):
+        """Copy one station's free ports from the database into the snapshot; call with the lock held"""
+        ports = connection.execute(
+            f'SELECT {FREE_PORTS_SQL} FROM station_occupancy s WHERE s.station_id = :station_id',
+            {'station_id': self.station_ids[position], 'now': now}
+        ).fetchone()
+        if ports is not None:
+            self.counts[position] = max(0, ports[0])
+
+    def free_ports(self):
+        """Read-only array of free ports per station"""
+        return self.free
+
+    def free_at(self, position):
+        """Free ports at one station"""
+        return int(self.free[position])
+
+    def reserve(self, position, ports=1, ttl=DEFAULT_RESERVATION_TTL):
+        """Hold ports at a station if they are free; return a reservation id, or None if they are not"""
+        reservation_id = uuid.uuid4().hex
+        now = time.time()
+        with self.lock:
+            connection = self.connect()
+            with connection:
+                cursor = connection.execute(
+                    f'INSERT INTO reservation (id, station_id, ports, expires_at) '
+                    f'SELECT :id, s.station_id, :ports, :expires_at FROM station_occupancy s '
+                    f'WHERE s.station_id = :station_id AND {FREE_PORTS_SQL} >= :ports',
+                    {'id': reservation_id, 'station_id': self.station_ids[position], 'ports': int(ports),
+                     'expires_at': now + ttl, 'now': now}
+                )
+                self.update(connection, position, now)
+        return reservation_id if cursor.rowcount == 1 else None
+
+    def release(self, reservation_id):
+        """Give back the ports held by a reservation; return False if it does not exist"""
+        now = time.time()
+        with self.lock:
+            connection = self.connect()
+            with connection:
+                row = connection.execute(
+                    'SELECT station_id FROM reservation WHERE id = ? AND expires_at > ?', (reservation_id, now)
+                ).fetchone()
+                cursor = connection.execute('DELETE FROM reservation WHERE id = ?', (reservation_id,))
+                released = row is not None and cursor.rowcount == 1
+                if released and row[0] in self.positions:
+                    self.update(connection, self.positions[row[0]], now)
+        return released
+
+    def set_occupied(self, position, ports):
+        """Record how many ports are physically in use at a station, e.g. from its status feed"""
+        now = time.time()
+        with self.lock:
+            connection = self.connect()
+            with connection:
+                connection.execute(
+                    'UPDATE station_occupancy SET occupied = MAX(0, MIN(?, capacity)) WHERE station_id = ?',
+                    (int(ports), self.station_ids[position])
+                )
+                self.update(connection, position, now)
+
+    def snapshot(self):
+        """Per-station capacity, occupied, reserved and free counts, read from the database"""
+        now = time.time()
+        with self.lock:
+            rows = self.connect().execute(
+                'SELECT s.station_id, s.capacity, s.occupied, COALESCE(SUM(r.ports), 0) '
+                'FROM station_occupancy s LEFT JOIN reservation r '
+                'ON r.station_id = s.station_id AND r.expires_at > ? GROUP BY s.station_id', (now,)
+            ).fetchall()
+        counts = {row[0]: row[1:] for row in rows}
+        return [{
+            'station_id': station_id,
+            'capacity': int(counts[station_id][0]),
+            'occupied': int(counts[station_id][1]),
+            'reserved': int(counts[station_id][2]),
+            'free': max(0, int(counts[station_id][0] - counts[station_id][1] - counts[station_id][2]))
+        } for station_id in self.station_ids if station_id in counts]
+
+
+stores = {}
+stores_lock = threading.Lock()
+
+
+def occupancy_store(station_ids, capacities, db_path=OCCUPANCY_DB_PATH):
+    """Return the process-wide store backed by db_path, creating it on first use"""
+    with stores_lock:
+        if db_path not in stores:
+            stores[db_path] = OccupancyStore(station_ids, capacities, db_path)
+        return stores[db_path]
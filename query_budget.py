@@ -0,0 +1,65 @@
+"""Per-request SQL query counts, checked against a budget per endpoint.
+
+Every statement the app's engine executes while a request is being handled
+is counted in flask.g. The count is returned in the X-Query-Count header, and
+an endpoint that goes over its budget is logged, or fails the request when
+QUERY_BUDGET_STRICT is set (on by default under app.testing), so that a
+per-row lookup creeping back into a listing view shows up straight away.
+Statements run by background threads, such as the write-behind queue, are
+not part of any request and are not counted.
+"""
+import threading
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+QUERY_COUNT_HEADER = 'X-Query-Count'
+
+
+class QueryBudgetExceeded(RuntimeError):
+    pass
+
+
+class QueryBudget:
+    """Counts the queries of each request and enforces budgets given as {endpoint: max_queries}"""
+
+    def __init__(self, app, db, budgets):
+        self.app = app
+        self.budgets = dict(budgets)
+        self.lock = threading.Lock()
+        self.requests = {}  # endpoint -> [requests, queries, most queries in one request, over budget]
+        app.config.setdefault('QUERY_BUDGET_STRICT', app.testing)
+        with app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', self.count)
+        app.after_request(self.check)
+
+    def count(self, conn, cursor, statement, parameters, context, executemany):
+        if has_request_context():
+            g.query_count = g.get('query_count', 0) + 1
+
+    def check(self, response):
+        """Record the request's query count and enforce its endpoint's budget"""
+        queries = g.get('query_count', 0)
+        endpoint = request.endpoint
+        response.headers[QUERY_COUNT_HEADER] = str(queries)
+        budget = self.budgets.get(endpoint)
+        over = budget is not None and queries > budget
+        with self.lock:
+            totals = self.requests.setdefault(endpoint, [0, 0, 0, 0])
+            totals[0] += 1
+            totals[1] += queries
+            totals[2] = max(totals[2], queries)
+            totals[3] += over
+        if over:
+            message = f"{endpoint} ran {queries} queries, over its budget of {budget}"
+            if self.app.config['QUERY_BUDGET_STRICT']:
+                raise QueryBudgetExceeded(message)
+            print(f"Query budget exceeded: {message}")
+        return response
+
+    def stats(self):
+        """Requests, average and peak query counts and budget overruns per endpoint"""
+        with self.lock:
+            return {endpoint: {'requests': requests, 'avg_queries': round(queries / requests, 2),
+                               'max_queries': peak, 'budget': self.budgets.get(endpoint), 'over_budget': over}
+                    for endpoint, (requests, queries, peak, over) in self.requests.items()}
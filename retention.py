@@ -0,0 +1,166 @@
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: every process sweeps on its own
+    fcntl = None
+
+TEMP_FILE_GRACE = 3600  # Seconds before an abandoned atomic-write temp file is removed
+
+
+def touch(path):
+    """Record an access to a file, so LRU eviction keeps it longer"""
+    try:
+        os.utime(path, (time.time(), os.stat(path).st_mtime))
+    except OSError:
+        pass
+
+
+class RetentionPolicy:
+    """Age and size budget for the files with the given suffixes in one directory.
+
+    A file's last use is the later of its access and modification times. Files
+    unused for longer than max_age seconds are deleted, then the least recently
+    used ones go until the directory fits in max_bytes. on_evict, if given, is
+    called with the names of the deleted files.
+    """
+
+    def __init__(self, directory, max_age, max_bytes, suffixes, on_evict=None):
+        self.directory = directory
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.suffixes = tuple(suffixes)
+        self.on_evict = on_evict
+
+    def scan(self):
+        """Return (name, size, last use) for each managed file, and the abandoned temp files"""
+        entries, temp_files = [], []
+        try:
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if not entry.is_file(follow_symlinks=False):
+                        continue
+                    stat = entry.stat(follow_symlinks=False)
+                    if entry.name.startswith('.'):
+                        if entry.name.endswith('.tmp') and stat.st_mtime < time.time() - TEMP_FILE_GRACE:
+                            temp_files.append(entry.name)
+                    elif entry.name.endswith(self.suffixes):
+                        entries.append((entry.name, stat.st_size, max(stat.st_atime, stat.st_mtime)))
+        except FileNotFoundError:
+            pass
+        return entries, temp_files
+
+    def sweep(self):
+        """Delete expired and over-budget files; return (names deleted, bytes freed)"""
+        entries, temp_files = self.scan()
+        cutoff = time.time() - self.max_age
+        entries.sort(key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+
+        evicted, freed = [], 0
+        for name, size, last_use in entries:
+            if last_use >= cutoff and total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass  # Already removed by another process
+            except OSError as e:
+                print(f"Error evicting {name}: {e}")
+                continue
+            evicted.append(name)
+            total -= size
+            freed += size
+
+        for name in temp_files:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+        if evicted and self.on_evict:
+            self.on_evict(evicted)
+        return evicted, freed
+
+
+class RetentionManager:
+    """Runs retention policies on a background thread every interval seconds.
+
+    With several worker processes, a lock file ensures only one of them sweeps
+    at a time; the others skip that round.
+    """
+
+    def __init__(self, policies, interval=600, lock_path=None):
+        self.policies = policies
+        self.interval = interval
+        self.lock_path = lock_path
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.thread_pid = None
+        self.stats_lock = threading.Lock()
+        self.totals = {policy.directory: {'evicted': 0, 'bytes_freed': 0} for policy in policies}
+        self.last_sweep = None
+
+    def start(self):
+        """Start the background thread (again after a fork) if it is not running"""
+        if self.thread is not None and self.thread_pid == os.getpid() and self.thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name='retention', daemon=True)
+        self.thread_pid = os.getpid()
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"Error in retention sweep: {e}")
+
+    def sweep(self):
+        """Run every policy once, unless another process is already sweeping"""
+        lock_file = None
+        if fcntl is not None and self.lock_path:
+            os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+            lock_file = open(self.lock_path, 'a')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+
+        try:
+            for policy in self.policies:
+                evicted, freed = policy.sweep()
+                with self.stats_lock:
+                    self.totals[policy.directory]['evicted'] += len(evicted)
+                    self.totals[policy.directory]['bytes_freed'] += freed
+            with self.stats_lock:
+                self.last_sweep = time.time()
+            return True
+        finally:
+            if lock_file is not None:
+                lock_file.close()
+
+    def stats(self):
+        """Current usage and eviction totals for each managed directory"""
+        result = {}
+        for policy in self.policies:
+            entries, _ = policy.scan()
+            with self.stats_lock:
+                totals = dict(self.totals[policy.directory])
+            result[os.path.basename(policy.directory)] = {
+                'files': len(entries),
+                'bytes': sum(size for _, size, _ in entries),
+                'max_bytes': policy.max_bytes,
+                'max_age_seconds': policy.max_age,
+                **totals
+            }
+        with self.stats_lock:
+            last_sweep = self.last_sweep
+        return {'directories': result, 'last_sweep': last_sweep}
@@ -0,0 +1,250 @@
+"""Offline routing over a local road graph, as a stand-in for OSRM.
+
+A graph is a directory of .npy arrays in compressed sparse row form plus a
+meta.json, written by build_road_graph or from CSV files with
+
+    python road_graph.py nodes.csv edges.csv road_graph/
+
+nodes.csv has id, lat, lon columns. edges.csv has source and target node
+ids and optionally length_km, speed_kmh and oneway (1 for one-way roads,
+otherwise both directions are added). The arrays are memory-mapped
+read-only, so every worker process shares one copy in the page cache.
+"""
+import heapq
+import json
+import math
+import os
+import sys
+import threading
+
+import numpy as np
+import pandas as pd
+import polyline
+from sklearn.neighbors import KDTree
+import geodesy
+
+GRAPH_FORMAT_VERSION = 1
+DEFAULT_SPEED = 50  # km/h for edges without a speed
+MAX_SNAP_DISTANCE = 5  # km from a requested point to the nearest road node
+GRAPH_ARRAYS = ('lats', 'lons', 'offsets', 'targets', 'lengths', 'durations',
+                'reverse_offsets', 'reverse_sources', 'reverse_edges')
+
+
+def build_road_graph(path, lats, lons, sources, targets, lengths=None, speeds=None):
+    """Write a directed road graph to the directory at path.
+
+    Nodes are numbered by their position in lats/lons and sources/targets
+    are node numbers. lengths are in km, defaulting to the straight-line
+    distance, and speeds in km/h, defaulting to DEFAULT_SPEED.
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    sources = np.asarray(sources, dtype=np.int64)
+    targets = np.asarray(targets, dtype=np.int64)
+    if lengths is None:
+        lengths = geodesy.haversine(lats[sources], lons[sources], lats[targets], lons[targets])
+    lengths = np.asarray(lengths, dtype=np.float64)
+    speeds = np.full(len(sources), DEFAULT_SPEED, dtype=np.float64) if speeds is None else \
+        np.where(np.asarray(speeds, dtype=np.float64) > 0, speeds, DEFAULT_SPEED)
+
+    # Forward adjacency sorted by source, reverse adjacency sorted by target
+    order = np.argsort(sources, kind='stable')
+    sources, targets, lengths, speeds = sources[order], targets[order], lengths[order], speeds[order]
+    reverse_edges = np.argsort(targets, kind='stable')
+
+    arrays = {
+        'lats': lats,
+        'lons': lons,
+        'offsets': np.concatenate(([0], np.cumsum(np.bincount(sources, minlength=len(lats))))).astype(np.int64),
+        'targets': targets.astype(np.int32),
+        'lengths': lengths.astype(np.float32),
+        'durations': (lengths / speeds).astype(np.float32),
+        'reverse_offsets': np.concatenate(([0], np.cumsum(np.bincount(targets, minlength=len(lats))))).astype(np.int64),
+        'reverse_sources': sources[reverse_edges].astype(np.int32),
+        'reverse_edges': reverse_edges.astype(np.int64)
+    }
+
+    os.makedirs(path, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(path, f'{name}.npy'), array)
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({
+            'version': GRAPH_FORMAT_VERSION,
+            'nodes': len(lats),
+            'edges': len(targets),
+            'max_speed': float(speeds.max()) if len(speeds) else DEFAULT_SPEED
+        }, f)
+
+
+def build_from_csv(nodes_csv, edges_csv, path):
+    """Build a road graph directory from node and edge CSV files"""
+    nodes = pd.read_csv(nodes_csv)
+    edges = pd.read_csv(edges_csv)
+    index = pd.Series(np.arange(len(nodes)), index=nodes['id'])
+    sources = index.loc[edges['source']].to_numpy()
+    targets = index.loc[edges['target']].to_numpy()
+    lengths = edges['length_km'].to_numpy() if 'length_km' in edges else None
+    speeds = edges['speed_kmh'].fillna(0).to_numpy() if 'speed_kmh' in edges else None
+
+    # Two-way roads get an edge in each direction
+    two_way = ~edges['oneway'].fillna(0).astype(bool).to_numpy() if 'oneway' in edges else \
+        np.ones(len(edges), dtype=bool)
+    all_sources = np.concatenate([sources, targets[two_way]])
+    all_targets = np.concatenate([targets, sources[two_way]])
+    if lengths is not None:
+        lengths = np.concatenate([lengths, lengths[two_way]])
+    if speeds is not None:
+        speeds = np.concatenate([speeds, speeds[two_way]])
+
+    build_road_graph(path, nodes['lat'].to_numpy(), nodes['lon'].to_numpy(),
+                     all_sources, all_targets, lengths, speeds)
+
+
+class RoadGraph:
+    """Memory-mapped road graph answering fastest-route queries with bidirectional A*"""
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta.get('version') != GRAPH_FORMAT_VERSION:
+            raise ValueError(f"Unsupported road graph format in {path}")
+        for name in GRAPH_ARRAYS:
+            # A plain ndarray view still reads from the mapping, without np.memmap's per-index overhead
+            setattr(self, name, np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r').view(np.ndarray))
+        self.max_speed = self.meta['max_speed']
+        self.tree = None
+        self.tree_lock = threading.Lock()
+
+    def nearest_node(self, lat, lon):
+        """Return (node, distance in km) of the graph node closest to a point"""
+        with self.tree_lock:
+            if self.tree is None:
+                self.tree = KDTree(geodesy.to_cartesian(self.lats, self.lons))
+        distance, index = self.tree.query(geodesy.to_cartesian([lat], [lon]), k=1)
+        return int(index[0][0]), float(distance[0][0])
+
+    def shortest_path(self, source, target):
+        """Fastest path between two nodes as a list of nodes, or None if there is none.
+
+        Both searches use the average potential (h_target - h_source) / 2,
+        which gives them the same non-negative reduced edge costs, so the
+        usual bidirectional Dijkstra stopping rule applies to the reduced
+        graph.
+        """
+        if source == target:
+            return [source]
+        lats, lons = self.lats, self.lons
+        s_lat, s_lon = math.radians(lats[source]), math.radians(lons[source])
+        t_lat, t_lon = math.radians(lats[target]), math.radians(lons[target])
+        hours_per_radian = geodesy.EARTH_RADIUS_KM / self.max_speed
+        potentials = {}
+
+        def arc(lat1, lon1, lat2, lon2):
+            a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+            return 2 * math.asin(math.sqrt(min(a, 1.0)))
+
+        def potential(node):
+            # Scalar maths here: this runs once per node reached, where NumPy's per-call overhead dominates
+            value = potentials.get(node)
+            if value is None:
+                lat, lon = math.radians(lats[node]), math.radians(lons[node])
+                value = potentials[node] = (arc(lat, lon, t_lat, t_lon) - arc(lat, lon, s_lat, s_lon)) * hours_per_radian / 2
+            return value
+
+        offsets, targets, durations = self.offsets, self.targets, self.durations
+        reverse_offsets, reverse_sources, reverse_edges = self.reverse_offsets, self.reverse_sources, self.reverse_edges
+
+        def forward_edges(node):
+            start, end = offsets[node], offsets[node + 1]
+            return zip(targets[start:end].tolist(), durations[start:end].tolist())
+
+        def backward_edges(node):
+            start, end = reverse_offsets[node], reverse_offsets[node + 1]
+            return zip(reverse_sources[start:end].tolist(), durations[reverse_edges[start:end]].tolist())
+
+        # (distance, parent, heap, settled, edges, sign of the potential in reduced costs)
+        forward = ({source: 0.0}, {source: None}, [(0.0, source)], set(), forward_edges, 1)
+        backward = ({target: 0.0}, {target: None}, [(0.0, target)], set(), backward_edges, -1)
+        best, meeting = float('inf'), None
+
+        while forward[2] and backward[2]:
+            if forward[2][0][0] + backward[2][0][0] >= best:
+                break
+            search, other = (forward, backward) if len(forward[2]) <= len(backward[2]) else (backward, forward)
+            dist, parent, heap, settled, edges, sign = search
+            d, node = heapq.heappop(heap)
+            if node in settled:
+                continue
+            settled.add(node)
+            node_potential = potential(node)
+
+            for neighbour, cost in edges(node):
+                # Reduced cost w - p(u) + p(v) forwards, w + p(u) - p(v) backwards
+                nd = d + cost + sign * (potential(neighbour) - node_potential)
+                if nd < dist.get(neighbour, float('inf')):
+                    dist[neighbour] = nd
+                    parent[neighbour] = node
+                    heapq.heappush(heap, (nd, neighbour))
+                    if neighbour in other[0] and nd + other[0][neighbour] < best:
+                        best, meeting = nd + other[0][neighbour], neighbour
+
+        if meeting is None:
+            return None
+        path = []
+        node = meeting
+        while node is not None:
+            path.append(node)
+            node = forward[1][node]
+        path.reverse()
+        node = backward[1][meeting]
+        while node is not None:
+            path.append(node)
+            node = backward[1][node]
+        return path
+
+    def route(self, source_coords, dest_coords):
+        """Fastest route between two (lat, lon) points in the same form as get_route_from_osrm, or None"""
+        source, source_snap = self.nearest_node(source_coords[0], source_coords[1])
+        target, target_snap = self.nearest_node(dest_coords[0], dest_coords[1])
+        if source_snap > MAX_SNAP_DISTANCE or target_snap > MAX_SNAP_DISTANCE:
+            return None
+
+        path = self.shortest_path(source, target)
+        if path is None:
+            return None
+
+        # Cost of each hop: the fastest edge between the consecutive nodes
+        distance = duration = 0.0
+        for u, v in zip(path[:-1], path[1:]):
+            start, end = self.offsets[u], self.offsets[u + 1]
+            hops = np.flatnonzero(self.targets[start:end] == v) + start
+            hop = hops[np.argmin(self.durations[hops])]
+            distance += float(self.lengths[hop])
+            duration += float(self.durations[hop])
+
+        nodes = np.asarray(path)
+        return {
+            'distance': distance,  # km
+            'duration': duration,  # hours
+            'geometry': polyline.encode(list(zip(self.lats[nodes].tolist(), self.lons[nodes].tolist())))
+        }
+
+
+def from_environment():
+    """Load the road graph named by the ROAD_GRAPH_PATH environment variable, if it is set"""
+    path = os.environ.get('ROAD_GRAPH_PATH')
+    if not path:
+        return None
+    try:
+        return RoadGraph(path)
+    except (OSError, ValueError) as e:
+        print(f"Error loading road graph from {path}: {e}")
+        return None
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 4:
+        print("Usage: python road_graph.py nodes.csv edges.csv output_dir")
+        sys.exit(1)
+    build_from_csv(*sys.argv[1:])
+    print(f"Road graph written to {sys.argv[3]}")
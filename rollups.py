@@ -0,0 +1,92 @@
+"""Hourly and daily consumption totals per vehicle, kept up to date as metrics are inserted.
+
+A rollup row holds the sums for one vehicle over one hour or day bucket.
+Queries over a time range split it into whole days, the whole hours at its
+edges and any leftover minutes, so only those leftovers need raw rows.
+"""
+from datetime import timedelta
+
+from sqlalchemy import func, literal, select
+from sqlalchemy.dialects.sqlite import insert
+
+GRANULARITIES = ('hour', 'day')
+SUMMED = ('energy_used', 'cost', 'distance', 'efficiency_sum', 'metric_count', 'efficiency_count')
+
+
+def truncate(moment, granularity):
+    """Start of the hour or day bucket holding moment"""
+    if granularity == 'day':
+        return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def ceil(moment, granularity):
+    """Start of the first bucket beginning at or after moment"""
+    start = truncate(moment, granularity)
+    if start == moment:
+        return start
+    return start + (timedelta(days=1) if granularity == 'day' else timedelta(hours=1))
+
+
+def plan_range(start, end):
+    """Split [start, end) into (source, start, end) pieces read from 'day' rollups, 'hour' rollups or 'raw' rows"""
+    plan = []
+    first_hour, last_hour = ceil(start, 'hour'), truncate(end, 'hour')
+    if first_hour >= last_hour:
+        return [('raw', start, end)]
+    first_day, last_day = ceil(start, 'day'), truncate(end, 'day')
+    if first_day >= last_day:
+        first_day = last_day = last_hour
+    pieces = [('raw', start, first_hour), ('hour', first_hour, first_day), ('day', first_day, last_day),
+              ('hour', last_day, last_hour), ('raw', last_hour, end)]
+    for source, piece_start, piece_end in pieces:
+        if piece_start < piece_end:
+            plan.append((source, piece_start, piece_end))
+    return plan
+
+
+def rollup_deltas(metrics):
+    """Rollup rows adding up (vehicle_id, timestamp, energy_used, cost, distance, efficiency) tuples"""
+    deltas = {}
+    for vehicle_id, timestamp, energy_used, cost, distance, efficiency in metrics:
+        for granularity in GRANULARITIES:
+            key = (vehicle_id, granularity, truncate(timestamp, granularity))
+            row = deltas.get(key)
+            if row is None:
+                row = deltas[key] = {'vehicle_id': vehicle_id, 'granularity': granularity, 'bucket_start': key[2],
+                                     **{name: 0 for name in SUMMED}}
+            row['energy_used'] += energy_used or 0
+            row['cost'] += cost or 0
+            row['distance'] += distance or 0
+            row['metric_count'] += 1
+            if efficiency is not None:
+                row['efficiency_sum'] += efficiency
+                row['efficiency_count'] += 1
+    return list(deltas.values())
+
+
+def apply_deltas(connection, table, deltas):
+    """Add rollup rows into table with one executemany upsert"""
+    if not deltas:
+        return
+    statement = insert(table)
+    statement = statement.on_conflict_do_update(
+        index_elements=['vehicle_id', 'granularity', 'bucket_start'],
+        set_={name: table.c[name] + statement.excluded[name] for name in SUMMED}
+    )
+    connection.execute(statement, deltas)
+
+
+def rebuild(connection, table, metrics):
+    """Recompute every rollup row from the raw metrics table"""
+    connection.execute(table.delete())
+    for granularity, pattern in (('hour', '%Y-%m-%d %H:00:00.000000'), ('day', '%Y-%m-%d 00:00:00.000000')):
+        bucket = func.strftime(pattern, metrics.c.timestamp)
+        connection.execute(table.insert().from_select(
+            ['vehicle_id', 'granularity', 'bucket_start'] + list(SUMMED),
+            select(
+                metrics.c.vehicle_id, literal(granularity), bucket,
+                func.sum(metrics.c.energy_used), func.sum(metrics.c.cost), func.sum(metrics.c.distance),
+                func.coalesce(func.sum(metrics.c.efficiency), 0), func.count(), func.count(metrics.c.efficiency)
+            ).group_by(metrics.c.vehicle_id, bucket)
+        ))
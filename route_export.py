@@ -0,0 +1,39 @@
+import polyline
+
+ROUTE_FORMATS = ('html', 'geojson', 'polyline')
+POLYLINE_PRECISION = 5  # Decimal places in OSRM/Mapbox encoded polylines
+
+
+def route_geojson(geometry, markers):
+    """GeoJSON FeatureCollection with the route as a LineString and one Point per marker.
+
+    geometry is an encoded polyline and markers are dicts with 'lat', 'lon',
+    'kind' and any other properties to show in the popup.
+    """
+    coordinates = [[round(lon, POLYLINE_PRECISION), round(lat, POLYLINE_PRECISION)]
+                   for lat, lon in polyline.decode(geometry, POLYLINE_PRECISION)]
+    features = [{
+        'type': 'Feature',
+        'geometry': {'type': 'LineString', 'coordinates': coordinates},
+        'properties': {'kind': 'route'}
+    }]
+    for marker in markers:
+        properties = {key: value for key, value in marker.items() if key not in ('lat', 'lon')}
+        features.append({
+            'type': 'Feature',
+            'geometry': {'type': 'Point', 'coordinates': [marker['lon'], marker['lat']]},
+            'properties': properties
+        })
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def route_payload(geometry, markers, route_format):
+    """Compact route description for client-side rendering in route_map.html"""
+    if route_format == 'geojson':
+        return {'format': 'geojson', 'data': route_geojson(geometry, markers)}
+    return {
+        'format': 'polyline',
+        'geometry': geometry,
+        'precision': POLYLINE_PRECISION,
+        'markers': markers
+    }
@@ -0,0 +1,91 @@
+import numpy as np
+import polyline
+import geodesy
+
+EQUATOR_KM = 40075.016686  # Earth's circumference at the equator
+LEVEL_ZOOMS = (6, 9, 12)  # Web map zoom levels stored with each route
+PIXEL_TOLERANCE = 1.0  # Allowed deviation from the full geometry, in screen pixels
+MAP_ZOOM = 12  # Level drawn on route maps, which are zoomed in past their initial view
+CORRIDOR_ZOOM = 9  # Level used for station corridor searches tens of km wide
+
+
+def tolerance_km(zoom, lat=0.0, pixels=PIXEL_TOLERANCE):
+    """Ground distance in km covered by the given number of pixels at a web map zoom level and latitude"""
+    return pixels * EQUATOR_KM * np.cos(np.radians(lat)) / (256 * 2 ** zoom)
+
+
+def vertex_importance(lats, lons):
+    """Douglas-Peucker importance in km of each vertex of a path.
+
+    Simplifying with a tolerance t keeps exactly the vertices whose importance
+    exceeds t, the same result as running Douglas-Peucker with t, so a single
+    pass serves every level of detail. The recursion runs breadth first: all
+    intervals at one depth are split together with array operations.
+    """
+    count = len(lats)
+    importance = np.zeros(count)
+    if count == 0:
+        return importance
+    importance[[0, -1]] = np.inf
+    if count < 3:
+        return importance
+
+    xyz = geodesy.to_cartesian(lats, lons)
+    starts, ends, caps = np.array([0]), np.array([count - 1]), np.array([np.inf])
+    while True:
+        interior = ends - starts - 1
+        open_ = interior > 0
+        starts, ends, caps, interior = starts[open_], ends[open_], caps[open_], interior[open_]
+        if not len(starts):
+            return importance
+
+        # Flatten (interval, interior vertex) pairs
+        offsets = np.concatenate(([0], np.cumsum(interior)[:-1]))
+        interval = np.repeat(np.arange(len(starts)), interior)
+        vertex = np.arange(interior.sum()) - np.repeat(offsets - starts - 1, interior)
+        distances, _ = geodesy.point_segment_distances(xyz[vertex], xyz[starts[interval]], xyz[ends[interval]])
+
+        # The farthest vertex splits each interval; capping by the parent keeps levels nested
+        farthest = np.maximum.reduceat(distances, offsets)
+        is_farthest = np.flatnonzero(distances == np.repeat(farthest, interior))
+        is_farthest = is_farthest[np.unique(interval[is_farthest], return_index=True)[1]]
+        split = vertex[is_farthest]
+        importance[split] = np.minimum(farthest, caps)
+
+        starts = np.concatenate([starts, split])
+        ends = np.concatenate([split, ends])
+        caps = np.concatenate([importance[split], importance[split]])
+
+
+def simplify(lats, lons, tolerance, importance=None):
+    """Indices of the vertices kept when simplifying a path to within tolerance km"""
+    if importance is None:
+        importance = vertex_importance(lats, lons)
+    return np.flatnonzero(importance > tolerance)
+
+
+def geometry_levels(geometry, zooms=LEVEL_ZOOMS):
+    """Encoded polylines of a route simplified for each zoom level, keyed by the zoom as a string"""
+    points = np.asarray(polyline.decode(geometry), dtype=np.float64).reshape(-1, 2)
+    if len(points) < 3:
+        return {str(zoom): geometry for zoom in zooms}
+
+    importance = vertex_importance(points[:, 0], points[:, 1])
+    lat = float(np.abs(points[:, 0]).mean())
+    return {str(zoom): polyline.encode([tuple(point) for point in points[importance > tolerance_km(zoom, lat)]])
+            for zoom in zooms}
+
+
+def add_levels(route):
+    """Store simplified levels of detail alongside a route's full 'geometry'; None passes through"""
+    if route is not None and route.get('geometry'):
+        route['levels'] = geometry_levels(route['geometry'])
+    return route
+
+
+def level_geometry(route, zoom):
+    """A route's encoded geometry simplified for zoom, computed on the fly for routes stored without levels"""
+    levels = route.get('levels') or {}
+    if str(zoom) in levels:
+        return levels[str(zoom)]
+    return geometry_levels(route['geometry'], (zoom,))[str(zoom)]
@@ -1,35 +1,51 @@
 import pandas as pd
 import numpy as np
-from math import radians, sin, cos, sqrt, atan2
-import requests
 import folium
-from datetime import datetime
 import polyline
 import json
-import os
+from station_index import StationIndex
+import geodesy
+from charging_planner import plan_charging_stops
+from cache import cached_geocode, cached_route
+import road_graph
+from station_matrix import load_station_matrix
+from occupancy import occupancy_store
+from http_client import get_session, gather
+from map_cache import cached_map
+from route_geometry import add_levels, level_geometry, MAP_ZOOM, CORRIDOR_ZOOM
 
 class RouteOptimizer:
-    def __init__(self):
+    def __init__(self, router=None):
+        # Optional offline routing backend with a route(source_coords, dest_coords)
+        # method, e.g. road_graph.RoadGraph; OSRM is used when there is none
+        self.router = router if router is not None else road_graph.from_environment()
         self.charging_stations = pd.read_csv('charging_stations_india.csv')
+        self.station_index = StationIndex(self.charging_stations)
+        self.station_matrix = load_station_matrix('charging_stations_india.csv',
+                                                  self.router if isinstance(self.router, road_graph.RoadGraph) else None)
+        # 'Available Ports' is each station's port count; the store tracks how many are free now
+        self.occupancy = occupancy_store(self.charging_stations['Station ID'], self.charging_stations['Available Ports'])
         self.AVERAGE_EV_RANGE = 250  # km on full charge
         self.SAFETY_MARGIN = 0.2  # 20% battery reserve
+        self.CORRIDOR_WIDTH = 50  # km either side of the route searched for charging stations
+        self.AVERAGE_SPEED = 60  # km/h, used when the route has no duration
+        self.RESERVE_BATTERY = 10  # % never to drop below between charging stops
+        self.MAX_CHARGE = 90  # % to charge up to at a stop
+        self.RESERVATION_GRACE = 1800  # seconds a port is held past the planned departure from a stop
         self.MAPBOX_TOKEN = "YOUR_MAPBOX_TOKEN"  # Optional: Add your Mapbox token for better routing
 
     def haversine_distance(self, lat1, lon1, lat2, lon2):
         """Calculate distance between two points using Haversine formula"""
-        R = 6371  # Earth's radius in kilometers
-
-        lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
-        dlat = lat2 - lat1
-        dlon = lon2 - lon1
-
-        a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-        c = 2 * atan2(sqrt(a), sqrt(1-a))
-        distance = R * c
-
-        return distance
+        return float(geodesy.haversine(lat1, lon1, lat2, lon2))
 
     def get_coordinates(self, address):
+        """Get coordinates from address, served from the geocode cache when possible"""
+        result = cached_geocode('nominatim', address, lambda: self.fetch_coordinates(address))
+        if result:
+            return tuple(result)
+        return None, None, None
+
+    def fetch_coordinates(self, address):
         """Get coordinates from address using Nominatim API"""
         try:
             base_url = "https://nominatim.openstreetmap.org/search"
@@ -43,17 +59,29 @@ class RouteOptimizer:
                 'User-Agent': 'EV_Fleet_Monitor/1.0'
             }
             
-            response = requests.get(base_url, params=params, headers=headers)
+            response = get_session().get(base_url, params=params, headers=headers)
             data = response.json()
             
             if data:
                 return float(data[0]['lat']), float(data[0]['lon']), data[0].get('display_name', '')
-            return None, None, None
+            return None
         except Exception as e:
             print(f"Error getting coordinates: {e}")
-            return None, None, None
+            return None
+
+    def get_route(self, source_coords, dest_coords):
+        """Get route details from the offline router if one is configured, otherwise from OSRM"""
+        if self.router is not None:
+            return add_levels(self.router.route(source_coords[:2], dest_coords[:2]))
+        return self.get_route_from_osrm(source_coords, dest_coords)
 
     def get_route_from_osrm(self, source_coords, dest_coords):
+        """Get route details from OSRM, served from the route cache when possible"""
+        return cached_route('osrm', 'driving', [source_coords[:2], dest_coords[:2]],
+                            lambda: self.fetch_route_from_osrm(source_coords, dest_coords),
+                            options={'overview': 'full', 'geometries': 'polyline'})
+
+    def fetch_route_from_osrm(self, source_coords, dest_coords):
         """Get route details from OSRM"""
         try:
             base_url = "http://router.project-osrm.org/route/v1/driving"
@@ -64,16 +92,16 @@ class RouteOptimizer:
                 'steps': 'true'
             }
             
-            response = requests.get(url, params=params)
+            response = get_session().get(url, params=params)
             data = response.json()
             
             if data['code'] == 'Ok':
                 route = data['routes'][0]
-                return {
+                return add_levels({
                     'distance': route['distance'] / 1000,  # Convert to km
                     'duration': route['duration'] / 3600,  # Convert to hours
                     'geometry': route['geometry']
-                }
+                })
             return None
         except Exception as e:
             print(f"Error getting route: {e}")
@@ -81,24 +109,65 @@ class RouteOptimizer:
 
     def find_nearby_stations(self, lat, lon, max_distance=100):
         """Find charging stations within max_distance km"""
-        nearby = []
-        for _, station in self.charging_stations.iterrows():
-            distance = self.haversine_distance(lat, lon, 
-                                            station['Latitude'], 
-                                            station['Longitude'])
-            if distance <= max_distance:
-                nearby.append({
-                    'station_id': station['Station ID'],
-                    'name': station['Station Name'],
-                    'city': station['City'],
-                    'state': station['State'],
-                    'distance': round(distance, 2),
-                    'lat': station['Latitude'],
-                    'lon': station['Longitude'],
-                    'charging_speed': station['Charging Speed (kW)'],
-                    'available_ports': station['Available Ports']
-                })
-        return sorted(nearby, key=lambda x: x['distance'])
+        positions, distances = self.station_index.query_radius(lat, lon, max_distance)
+        return [self.station_details(pos, dist) for pos, dist in zip(positions, distances)]
+
+    def find_nearest_stations(self, lat, lon, k=5):
+        """Find the k charging stations closest to a point"""
+        positions, distances = self.station_index.query_nearest(lat, lon, k)
+        return [self.station_details(pos, dist) for pos, dist in zip(positions, distances)]
+
+    def available_stations(self):
+        """Boolean mask of the stations that are active and have a free port"""
+        return (self.station_index.stations['Status'] == 'Active').to_numpy() & (self.occupancy.free_ports() > 0)
+
+    def find_nearest_stations_bulk(self, lats, lons, k=5):
+        """k nearest available charging stations for each of many points, with a single index query"""
+        positions, distances = self.station_index.query_nearest_many(lats, lons, k, self.available_stations())
+        return [[self.station_details(pos, dist) for pos, dist in zip(row_positions, row_distances) if pos >= 0]
+                for row_positions, row_distances in zip(positions, distances)]
+
+    def find_stations_along_route(self, route_points, max_offset=None):
+        """Find charging stations within max_offset km of the route, ordered along it.
+
+        'distance' is the perpendicular distance from the route and 'chainage'
+        the distance along the route to the closest point.
+        """
+        if max_offset is None:
+            max_offset = self.CORRIDOR_WIDTH
+        route = np.asarray(route_points, dtype=np.float64).reshape(-1, 2)
+        positions, offsets, chainages = self.station_index.query_corridor(route[:, 0], route[:, 1], max_offset)
+
+        stations = []
+        for pos, offset, chainage in zip(positions, offsets, chainages):
+            station = self.station_details(pos, offset)
+            station['chainage'] = round(float(chainage), 2)
+            stations.append(station)
+        return stations
+
+    def station_details(self, position, distance):
+        """Build the station dict returned by the station lookups"""
+        station = self.station_index.records[position]
+        return {
+            'station_id': station['Station ID'],
+            'name': station['Station Name'],
+            'city': station['City'],
+            'state': station['State'],
+            'distance': round(float(distance), 2),
+            'lat': station['Latitude'],
+            'lon': station['Longitude'],
+            'charging_speed': station['Charging Speed (kW)'],
+            'available_ports': self.occupancy.free_at(position)
+        }
+
+    def road_legs(self, stations):
+        """Station-to-station leg lookup for plan_charging_stops, served from the station matrix"""
+        if self.station_matrix is None:
+            return None
+        positions = np.array([self.station_matrix.positions.get(str(station['station_id']), -1)
+                              for station in stations], dtype=np.int64)
+        return lambda origins, destination: self.station_matrix.lookup_many(positions[origins],
+                                                                             positions[destination])
 
     def estimate_charging_time(self, current_battery, target_battery, charging_speed):
         """Estimate charging time in hours"""
@@ -106,11 +175,49 @@ class RouteOptimizer:
         energy_needed = (target_battery - current_battery) / 100 * battery_capacity
         return round(energy_needed / charging_speed, 2)
 
-    def optimize_route(self, source_address, dest_address, battery_percentage):
-        """Optimize route with charging stations"""
-        # Get coordinates
-        source_coords = self.get_coordinates(source_address)
-        dest_coords = self.get_coordinates(dest_address)
+    def plan_charging_stops(self, stations, total_distance, duration, battery_percentage):
+        """Plan charging stops along the route that minimise total trip time (driving plus charging)"""
+        avg_speed = total_distance / duration if duration > 0 else self.AVERAGE_SPEED
+        plan = plan_charging_stops(stations, total_distance, battery_percentage, self.AVERAGE_EV_RANGE,
+                                   self.estimate_charging_time, avg_speed,
+                                   reserve_soc=self.RESERVE_BATTERY, max_soc=self.MAX_CHARGE,
+                                   road_legs=self.road_legs(stations))
+        if plan is None:
+            return None
+
+        charging_stops = []
+        for stop in plan['stops']:
+            station = dict(stop['station'])
+            station['arrival_battery'] = stop['arrival_soc']
+            station['target_battery'] = stop['departure_soc']
+            station['charging_time'] = stop['charging_time']
+            charging_stops.append(station)
+        return {'total_time': plan['total_time'], 'charging_stops': charging_stops}
+
+    def reserve_stops(self, charging_stops, avg_speed):
+        """Hold a port at every stop until shortly after the planned departure.
+
+        Returns None once all are held, or the station_id of a stop whose last
+        port was taken first, in which case nothing stays reserved.
+        """
+        held = []
+        for stop in charging_stops:
+            position = self.occupancy.positions[str(stop['station_id'])]
+            ttl = (stop['chainage'] / avg_speed + stop['charging_time']) * 3600 + self.RESERVATION_GRACE
+            reservation_id = self.occupancy.reserve(position, ttl=ttl)
+            if reservation_id is None:
+                for earlier in held:
+                    self.occupancy.release(earlier)
+                return stop['station_id']
+            held.append(reservation_id)
+            stop['reservation_id'] = reservation_id
+        return None
+
+    def optimize_route(self, source_address, dest_address, battery_percentage, reserve=False):
+        """Optimize route with charging stations; with reserve=True a port is held at each stop"""
+        # Get coordinates; the two lookups are independent
+        source_coords, dest_coords = gather(lambda: self.get_coordinates(source_address),
+                                            lambda: self.get_coordinates(dest_address))
         
         if not source_coords[0] or not dest_coords[0]:
             return {
@@ -119,8 +226,8 @@ class RouteOptimizer:
             }
 
         # Get route details
-        route_details = self.get_route_from_osrm((source_coords[0], source_coords[1]), 
-                                               (dest_coords[0], dest_coords[1]))
+        route_details = self.get_route((source_coords[0], source_coords[1]), 
+                                       (dest_coords[0], dest_coords[1]))
         
         if not route_details:
             return {
@@ -128,6 +235,75 @@ class RouteOptimizer:
                 'message': 'Could not calculate route'
             }
 
+        result = self.plan_route(source_coords, dest_coords, route_details, battery_percentage, reserve=reserve)
+        if result['status'] == 'success':
+            result['route'] = self.create_route_map(source_coords, dest_coords, 
+                                                  level_geometry(route_details, MAP_ZOOM), result.get('charging_stops'))
+        return result
+
+    def optimize_routes(self, trips):
+        """Plan many trips at once without rendering maps.
+
+        trips is a list of dicts with 'source', 'destination',
+        'battery_percentage' and optionally 'reserve', to hold a port at each
+        of the trip's charging stops. Each distinct address is geocoded once and each
+        distinct leg routed once, with the lookups run on http_client's shared
+        lookup pool, so concurrent batches share its concurrency cap. Returns
+        one result per trip, in order; a failed trip gets an error result
+        without affecting the others.
+        """
+        addresses = {trip.get('source') for trip in trips} | {trip.get('destination') for trip in trips}
+        addresses = [address for address in addresses if address]
+        coordinates = dict(zip(addresses, gather(*[lambda address=address: self.get_coordinates(address)
+                                                   for address in addresses])))
+        locate = lambda address: coordinates.get(address, (None, None, None))
+
+        legs = set()
+        for trip in trips:
+            source_coords = locate(trip.get('source'))
+            dest_coords = locate(trip.get('destination'))
+            if source_coords[0] and dest_coords[0]:
+                legs.add((source_coords[:2], dest_coords[:2]))
+        legs = list(legs)
+        routes = dict(zip(legs, gather(*[lambda leg=leg: self.get_route(*leg) for leg in legs])))
+
+        results = []
+        for index, trip in enumerate(trips):
+            try:
+                source_coords = locate(trip.get('source'))
+                dest_coords = locate(trip.get('destination'))
+                if not source_coords[0] or not dest_coords[0]:
+                    result = {
+                        'status': 'error',
+                        'message': 'Could not find coordinates for provided addresses'
+                    }
+                elif not routes.get((source_coords[:2], dest_coords[:2])):
+                    result = {
+                        'status': 'error',
+                        'message': 'Could not calculate route'
+                    }
+                else:
+                    result = self.plan_route(source_coords, dest_coords,
+                                             routes[(source_coords[:2], dest_coords[:2])],
+                                             float(trip.get('battery_percentage', 100)),
+                                             reserve=bool(trip.get('reserve')))
+            except Exception as e:
+                print(f"Error planning trip {index}: {e}")
+                result = {'status': 'error', 'message': str(e)}
+
+            result['trip'] = index
+            if 'id' in trip:
+                result['id'] = trip['id']
+            results.append(result)
+        return results
+
+    def plan_route(self, source_coords, dest_coords, route_details, battery_percentage, reserve=False):
+        """Plan charging for a route that has already been geocoded and routed.
+
+        With reserve=True a port is held at each charging stop, its
+        reservation_id included in the stop and all of them listed under
+        'reservations', to be released with OccupancyStore.release.
+        """
         total_distance = route_details['distance']
         available_range = (battery_percentage / 100) * self.AVERAGE_EV_RANGE
 
@@ -139,41 +315,46 @@ class RouteOptimizer:
                 'source_address': source_coords[2],
                 'dest_address': dest_coords[2],
                 'distance': round(total_distance, 2),
-                'duration': round(route_details['duration'], 2),
-                'route': self.create_route_map(source_coords, dest_coords, 
-                                            route_details['geometry'])
+                'duration': round(route_details['duration'], 2)
             }
 
-        # Find charging stations along route
-        decoded_polyline = polyline.decode(route_details['geometry'])
-        route_points = [(p[0], p[1]) for p in decoded_polyline]
-        
-        # Sample points along route for finding charging stations
-        num_samples = min(5, len(route_points))
-        sample_indices = np.linspace(0, len(route_points)-1, num_samples).astype(int)
-        
-        all_charging_stops = []
-        for idx in sample_indices:
-            lat, lon = route_points[idx]
-            stops = self.find_nearby_stations(lat, lon)
-            all_charging_stops.extend(stops)
-        
-        # Remove duplicates and sort by distance from route
-        unique_stops = {stop['station_id']: stop for stop in all_charging_stops}
-        charging_stops = sorted(unique_stops.values(), 
-                              key=lambda x: x['distance'])[:3]  # Top 3 closest stations
+        # Find charging stations along the whole route corridor, which is far wider
+        # than the error of the simplified geometry
+        route_points = polyline.decode(level_geometry(route_details, CORRIDOR_ZOOM))
+        corridor_stops = [stop for stop in self.find_stations_along_route(route_points)
+                          if stop['available_ports'] > 0]
 
-        if not charging_stops:
+        if not corridor_stops:
             return {
                 'status': 'warning',
                 'message': 'No charging stations found along route',
                 'distance': round(total_distance, 2)
             }
 
-        # Calculate charging details for each stop
-        for stop in charging_stops:
-            stop['charging_time'] = self.estimate_charging_time(
-                battery_percentage, 90, stop['charging_speed'])
+        # Pick the stops and charge levels that minimise total trip time. When
+        # reserving, a stop whose last port went to a concurrent request is
+        # dropped and the trip planned again.
+        avg_speed = total_distance / route_details['duration'] if route_details['duration'] > 0 else self.AVERAGE_SPEED
+        fully_booked = set()
+        for attempt in range(3):
+            candidates = [stop for stop in corridor_stops if stop['station_id'] not in fully_booked]
+            plan = self.plan_charging_stops(candidates, total_distance,
+                                            route_details['duration'], battery_percentage)
+            if plan is None or not reserve:
+                break
+            station_id = self.reserve_stops(plan['charging_stops'], avg_speed)
+            if station_id is None:
+                break
+            fully_booked.add(station_id)
+            plan = None
+        if plan is None:
+            return {
+                'status': 'warning',
+                'message': 'Charging stations along route are fully booked' if fully_booked else
+                           'Destination is out of range of the charging stations along route',
+                'distance': round(total_distance, 2)
+            }
+        charging_stops = plan['charging_stops']
 
         return {
             'status': 'success',
@@ -182,65 +363,73 @@ class RouteOptimizer:
             'dest_address': dest_coords[2],
             'distance': round(total_distance, 2),
             'duration': round(route_details['duration'], 2),
+            'total_time': plan['total_time'],
             'charging_stops': charging_stops,
-            'route': self.create_route_map(source_coords, dest_coords, 
-                                         route_details['geometry'], charging_stops)
+            'reservations': [stop['reservation_id'] for stop in charging_stops if 'reservation_id' in stop]
         }
 
     def create_route_map(self, source, dest, route_geometry, charging_stops=None):
-        """Create an HTML map with the route"""
-        # Create map centered between source and dest
-        center_lat = (source[0] + dest[0]) / 2
-        center_lon = (source[1] + dest[1]) / 2
-        m = folium.Map(location=[center_lat, center_lon], zoom_start=5)
-
-        # Add source marker
-        folium.Marker(
-            [source[0], source[1]],
-            popup=f'Start: {source[2]}',
-            icon=folium.Icon(color='green', icon='info-sign')
-        ).add_to(m)
-
-        # Add destination marker
-        folium.Marker(
-            [dest[0], dest[1]],
-            popup=f'Destination: {dest[2]}',
-            icon=folium.Icon(color='red', icon='info-sign')
-        ).add_to(m)
-
-        # Add charging stops if any
-        if charging_stops:
-            for stop in charging_stops:
-                folium.Marker(
-                    [stop['lat'], stop['lon']],
-                    popup=f"""
-                    <b>{stop['name']}</b><br>
-                    City: {stop['city']}, {stop['state']}<br>
-                    Distance from route: {stop['distance']} km<br>
-                    Charging Speed: {stop['charging_speed']} kW<br>
-                    Available Ports: {stop['available_ports']}<br>
-                    Est. Charging Time: {stop['charging_time']} hours
-                    """,
-                    icon=folium.Icon(color='blue', icon='plug', prefix='fa')
-                ).add_to(m)
-
-        # Draw route line
-        route_coords = polyline.decode(route_geometry)
-        folium.PolyLine(
-            route_coords,
-            weight=2,
-            color='blue',
-            opacity=0.8
-        ).add_to(m)
-
-        # Save map
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        map_filename = f'route_{timestamp}.html'
-        map_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'route_maps', map_filename)
-        os.makedirs(os.path.dirname(map_path), exist_ok=True)
-        m.save(map_path)
-        
-        return f'static/route_maps/{map_filename}'
+        """Create an HTML map with the route, reusing an identical earlier map when there is one"""
+        style = {'zoom_start': 5, 'line_weight': 2, 'line_color': 'blue', 'line_opacity': 0.8}
+        stop_fields = ('lat', 'lon', 'name', 'city', 'state', 'distance', 'charging_speed',
+                       'available_ports', 'arrival_battery', 'target_battery', 'charging_time')
+        spec = {
+            'renderer': 'route_model',
+            'style': style,
+            'source': list(source[:3]),
+            'dest': list(dest[:3]),
+            'geometry': route_geometry,
+            'stops': [[stop[field] for field in stop_fields] for stop in charging_stops or []]
+        }
+
+        def render():
+            # Create map centered between source and dest
+            center_lat = (source[0] + dest[0]) / 2
+            center_lon = (source[1] + dest[1]) / 2
+            m = folium.Map(location=[center_lat, center_lon], zoom_start=style['zoom_start'])
+
+            # Add source marker
+            folium.Marker(
+                [source[0], source[1]],
+                popup=f'Start: {source[2]}',
+                icon=folium.Icon(color='green', icon='info-sign')
+            ).add_to(m)
+
+            # Add destination marker
+            folium.Marker(
+                [dest[0], dest[1]],
+                popup=f'Destination: {dest[2]}',
+                icon=folium.Icon(color='red', icon='info-sign')
+            ).add_to(m)
+
+            # Add charging stops if any
+            if charging_stops:
+                for stop in charging_stops:
+                    folium.Marker(
+                        [stop['lat'], stop['lon']],
+                        popup=f"""
+                        <b>{stop['name']}</b><br>
+                        City: {stop['city']}, {stop['state']}<br>
+                        Distance from route: {stop['distance']} km<br>
+                        Charging Speed: {stop['charging_speed']} kW<br>
+                        Available Ports: {stop['available_ports']}<br>
+                        Charge: {stop['arrival_battery']}% to {stop['target_battery']}%<br>
+                        Est. Charging Time: {stop['charging_time']} hours
+                        """,
+                        icon=folium.Icon(color='blue', icon='plug', prefix='fa')
+                    ).add_to(m)
+
+            # Draw route line
+            route_coords = polyline.decode(route_geometry)
+            folium.PolyLine(
+                route_coords,
+                weight=style['line_weight'],
+                color=style['line_color'],
+                opacity=style['line_opacity']
+            ).add_to(m)
+            return m
+
+        return f'static/route_maps/{cached_map(spec, render)}'
 
 # Initialize the optimizer
 optimizer = RouteOptimizer()
\ No newline at end of file
@@ -1,11 +1,12 @@
-import requests
-import json
-import math
+import numpy as np
 import folium
-import os
-import time
-from datetime import datetime
 from typing import Dict, List, Tuple, Any
+import geodesy
+from cache import cached_geocode, cached_route
+from http_client import get_session, gather
+from map_cache import cached_map
+from route_geometry import add_levels, level_geometry, MAP_ZOOM
+import polyline
 
 class RouteOptimizer:
     def __init__(self):
@@ -23,6 +24,10 @@ class RouteOptimizer:
         ]
 
     def geocode_location(self, location: str) -> Tuple[float, float]:
+        """Convert location string to coordinates, served from the geocode cache when possible"""
+        return tuple(cached_geocode('mapbox', location, lambda: self.fetch_location(location)))
+
+    def fetch_location(self, location: str) -> Tuple[float, float]:
         """Convert location string to coordinates using Mapbox Geocoding API"""
         try:
             url = f'https://api.mapbox.com/geocoding/v5/mapbox.places/{location}.json'
@@ -31,7 +36,7 @@ class RouteOptimizer:
                 'limit': 1,
                 'country': 'IN'
             }
-            response = requests.get(url, params=params)
+            response = get_session().get(url, params=params)
             response.raise_for_status()
             
             data = response.json()
@@ -43,117 +48,148 @@ class RouteOptimizer:
         except Exception as e:
             raise Exception(f"Error geocoding location '{location}': {str(e)}")
 
+    def reverse_geocode(self, coord: Tuple[float, float], fallback: str) -> str:
+        """Get the place name for (longitude, latitude) coordinates, or fallback if there is none"""
+        data = get_session().get(f'https://api.mapbox.com/geocoding/v5/mapbox.places/{coord[0]},{coord[1]}.json',
+                                 params={'access_token': self.mapbox_token}).json()
+        return data['features'][0]['place_name'] if data['features'] else fallback
+
     def calculate_distance(self, coord1: Tuple[float, float], coord2: Tuple[float, float]) -> float:
         """Calculate distance between two coordinates using Haversine formula"""
         lon1, lat1 = coord1
         lon2, lat2 = coord2
-        
-        R = 6371  # Earth's radius in kilometers
-        
-        lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
-        dlat = lat2 - lat1
-        dlon = lon2 - lon1
-        
-        a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
-        c = 2 * math.asin(math.sqrt(a))
-        return R * c
+        return float(geodesy.haversine(lat1, lon1, lat2, lon2))
 
     def find_nearest_charging_stations(self, route_coordinates: List[List[float]], battery_percentage: float) -> List[Dict]:
         """Find charging stations near the route based on battery percentage"""
         charging_stops = []
         max_distance = 300 * (battery_percentage / 100)  # Assume 300km is max range at 100% battery
+        if len(route_coordinates) < 2 or not self.charging_stations:
+            return charging_stops
+
+        # Route coordinates are [lon, lat]
+        route = np.asarray(route_coordinates, dtype=np.float64)
+        route_lons, route_lats = route[:, 0], route[:, 1]
+        station_lats = np.array([station['latitude'] for station in self.charging_stations])
+        station_lons = np.array([station['longitude'] for station in self.charging_stations])
+
+        # Distance along the route to every point and nearest station to every point
+        chainage = geodesy.cumulative_distances(route_lats, route_lons)
+        nearest_idx, nearest_dist = geodesy.nearest(route_lats, route_lons, station_lats, station_lons)
+
+        # Only points with a station within 50km of the route can become stops
+        candidates = np.flatnonzero(nearest_dist <= 50)
+        threshold = max_distance * 0.8  # Look for charging station when battery is at 20%
+
+        last_stop = 0
+        while True:
+            # First candidate past the last stop where the battery threshold is reached
+            earliest = max(np.searchsorted(chainage, chainage[last_stop] + threshold), last_stop + 1)
+            pos = np.searchsorted(candidates, earliest)
+            if pos >= len(candidates):
+                break
+
+            i = candidates[pos]
+            station = self.charging_stations[nearest_idx[i]]
+            charging_stops.append({
+                'name': station['name'],
+                'latitude': station['latitude'],
+                'longitude': station['longitude'],
+                'distance': float(nearest_dist[i])
+            })
+            last_stop = i
+
+        return charging_stops
+
+    def get_directions(self, source_coord: Tuple[float, float], dest_coord: Tuple[float, float]) -> Dict[str, Any]:
+        """Get a driving route between two (lon, lat) points, served from the route cache when possible"""
+        return cached_route('mapbox', 'driving',
+                            [(source_coord[1], source_coord[0]), (dest_coord[1], dest_coord[0])],
+                            lambda: self.fetch_directions(source_coord, dest_coord),
+                            options={'overview': 'full'})
+
+    def fetch_directions(self, source_coord: Tuple[float, float], dest_coord: Tuple[float, float]) -> Dict[str, Any]:
+        """Get a driving route from Mapbox Directions API with the geometry as an encoded polyline"""
+        coords = f"{source_coord[0]},{source_coord[1]};{dest_coord[0]},{dest_coord[1]}"
+        url = f'https://api.mapbox.com/directions/v5/mapbox/driving/{coords}'
+        params = {
+            'access_token': self.mapbox_token,
+            'geometries': 'geojson',
+            'overview': 'full'
+        }
         
-        current_distance = 0
-        last_charging_point = route_coordinates[0]
+        response = get_session().get(url, params=params)
+        response.raise_for_status()
         
-        for i in range(1, len(route_coordinates)):
-            segment_distance = self.calculate_distance(
-                (route_coordinates[i-1][0], route_coordinates[i-1][1]),
-                (route_coordinates[i][0], route_coordinates[i][1])
-            )
-            current_distance += segment_distance
-            
-            if current_distance >= max_distance * 0.8:  # Look for charging station when battery is at 20%
-                # Find nearest charging station to current point
-                min_distance = float('inf')
-                nearest_station = None
-                
-                for station in self.charging_stations:
-                    station_coord = (station['longitude'], station['latitude'])
-                    distance = self.calculate_distance(
-                        (route_coordinates[i][0], route_coordinates[i][1]),
-                        station_coord
-                    )
-                    if distance < min_distance:
-                        min_distance = distance
-                        nearest_station = station
-                
-                if nearest_station and min_distance <= 50:  # Only add if station is within 50km of route
-                    charging_stops.append({
-                        'name': nearest_station['name'],
-                        'latitude': nearest_station['latitude'],
-                        'longitude': nearest_station['longitude'],
-                        'distance': min_distance
-                    })
-                    last_charging_point = (nearest_station['longitude'], nearest_station['latitude'])
-                    current_distance = 0
+        data = response.json()
+        if not data['routes']:
+            raise ValueError("No route found between the specified locations")
         
-        return charging_stops
+        route = data['routes'][0]
+        return add_levels({
+            'distance': route['distance'],  # meters
+            'duration': route['duration'],  # seconds
+            'geometry': polyline.encode([(lat, lon) for lon, lat in route['geometry']['coordinates']])
+        })
 
     def create_route_map(self, route_coords, charging_stations=None):
-        """Create a Folium map with the route and charging stations."""
+        """Create a Folium map with the route and charging stations, reusing an identical earlier map."""
         try:
-            # Get the center point of the route
-            center_lat = sum(coord[0] for coord in route_coords) / len(route_coords)
-            center_lon = sum(coord[1] for coord in route_coords) / len(route_coords)
-
-            # Create the map centered on the route
-            m = folium.Map(location=[center_lat, center_lon], zoom_start=6)
-
-            # Add the route line
-            folium.PolyLine(
-                locations=route_coords,
-                weight=4,
-                color='#3388ff',
-                opacity=0.8
-            ).add_to(m)
-
-            # Add markers for start and end points
-            folium.Marker(
-                location=route_coords[0],
-                popup='<div style="font-size: 14px;"><strong>Start Location</strong></div>',
-                icon=folium.Icon(color='green', icon='flag', prefix='fa')
-            ).add_to(m)
-            
-            folium.Marker(
-                location=route_coords[-1],
-                popup='<div style="font-size: 14px;"><strong>Destination</strong></div>',
-                icon=folium.Icon(color='red', icon='flag-checkered', prefix='fa')
-            ).add_to(m)
-
-            # Add charging station markers if available
-            if charging_stations:
-                for station in charging_stations:
-                    popup_html = f"""
-                    <div style="font-size: 14px; line-height: 1.5;">
-                        <strong>{station['name']}</strong><br>
-                        Distance from route: {station['distance']:.2f} km
-                    </div>
-                    """
-                    folium.Marker(
-                        location=[station['latitude'], station['longitude']],
-                        popup=folium.Popup(popup_html, max_width=300),
-                        icon=folium.Icon(color='blue', icon='plug', prefix='fa')
-                    ).add_to(m)
-
-            # Save the map
-            current_time = datetime.now().strftime("%Y%m%d_%H%M%S")
-            map_filename = f'route_{current_time}.html'
-            map_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'route_maps', map_filename)
-            os.makedirs(os.path.dirname(map_path), exist_ok=True)
-            m.save(map_path)
-            
-            return f'static/route_maps/{map_filename}'  # Return the relative path as it was before
+            style = {'zoom_start': 6, 'line_weight': 4, 'line_color': '#3388ff', 'line_opacity': 0.8}
+            spec = {
+                'renderer': 'route_optimizer',
+                'style': style,
+                'geometry': polyline.encode([tuple(coord) for coord in route_coords]),
+                'stations': [[station['name'], station['latitude'], station['longitude'], round(station['distance'], 2)]
+                             for station in charging_stations or []]
+            }
+
+            def render():
+                # Get the center point of the route
+                center_lat = sum(coord[0] for coord in route_coords) / len(route_coords)
+                center_lon = sum(coord[1] for coord in route_coords) / len(route_coords)
+
+                # Create the map centered on the route
+                m = folium.Map(location=[center_lat, center_lon], zoom_start=style['zoom_start'])
+
+                # Add the route line
+                folium.PolyLine(
+                    locations=route_coords,
+                    weight=style['line_weight'],
+                    color=style['line_color'],
+                    opacity=style['line_opacity']
+                ).add_to(m)
+
+                # Add markers for start and end points
+                folium.Marker(
+                    location=route_coords[0],
+                    popup='<div style="font-size: 14px;"><strong>Start Location</strong></div>',
+                    icon=folium.Icon(color='green', icon='flag', prefix='fa')
+                ).add_to(m)
+                
+                folium.Marker(
+                    location=route_coords[-1],
+                    popup='<div style="font-size: 14px;"><strong>Destination</strong></div>',
+                    icon=folium.Icon(color='red', icon='flag-checkered', prefix='fa')
+                ).add_to(m)
+
+                # Add charging station markers if available
+                if charging_stations:
+                    for station in charging_stations:
+                        popup_html = f"""
+                        <div style="font-size: 14px; line-height: 1.5;">
+                            <strong>{station['name']}</strong><br>
+                            Distance from route: {station['distance']:.2f} km
+                        </div>
+                        """
+                        folium.Marker(
+                            location=[station['latitude'], station['longitude']],
+                            popup=folium.Popup(popup_html, max_width=300),
+                            icon=folium.Icon(color='blue', icon='plug', prefix='fa')
+                        ).add_to(m)
+                return m
+
+            return f'static/route_maps/{cached_map(spec, render)}'  # Return the relative path as it was before
             
         except Exception as e:
             print(f"Error creating route map: {str(e)}")
@@ -162,28 +198,18 @@ class RouteOptimizer:
     def optimize_route(self, source: str, destination: str, battery_percentage: float) -> Dict[str, Any]:
         """Get optimized route with charging stations"""
         try:
-            # Convert locations to coordinates
-            source_coord = self.geocode_location(source)
-            dest_coord = self.geocode_location(destination)
-            
-            # Get route from Mapbox Directions API
-            coords = f"{source_coord[0]},{source_coord[1]};{dest_coord[0]},{dest_coord[1]}"
-            url = f'https://api.mapbox.com/directions/v5/mapbox/driving/{coords}'
-            params = {
-                'access_token': self.mapbox_token,
-                'geometries': 'geojson',
-                'overview': 'full'
-            }
+            # Convert locations to coordinates; the two lookups are independent
+            source_coord, dest_coord = gather(lambda: self.geocode_location(source),
+                                              lambda: self.geocode_location(destination))
             
-            response = requests.get(url, params=params)
-            response.raise_for_status()
-            
-            data = response.json()
-            if not data['routes']:
-                raise ValueError("No route found between the specified locations")
-            
-            route = data['routes'][0]
-            route_coordinates = route['geometry']['coordinates']
+            # Get route from Mapbox Directions API and the addresses for source and
+            # destination together, since all three only need the coordinates
+            route, source_address, dest_address = gather(
+                lambda: self.get_directions(source_coord, dest_coord),
+                lambda: self.reverse_geocode(source_coord, source),
+                lambda: self.reverse_geocode(dest_coord, destination)
+            )
+            route_coordinates = [[lon, lat] for lat, lon in polyline.decode(route['geometry'])]
             
             # Find charging stations along the route
             charging_stops = self.find_nearest_charging_stations(route_coordinates, battery_percentage)
@@ -192,18 +218,9 @@ class RouteOptimizer:
             total_distance = route['distance'] / 1000  # Convert to kilometers
             duration = route['duration'] / 3600  # Convert to hours
 
-            # Get addresses for source and destination
-            source_data = requests.get(f'https://api.mapbox.com/geocoding/v5/mapbox.places/{source_coord[0]},{source_coord[1]}.json',
-                                     params={'access_token': self.mapbox_token}).json()
-            dest_data = requests.get(f'https://api.mapbox.com/geocoding/v5/mapbox.places/{dest_coord[0]},{dest_coord[1]}.json',
-                                   params={'access_token': self.mapbox_token}).json()
-
-            source_address = source_data['features'][0]['place_name'] if source_data['features'] else source
-            dest_address = dest_data['features'][0]['place_name'] if dest_data['features'] else destination
-
-            # Create and save the route map
+            # Create and save the route map from the geometry simplified for display
             route_map_filename = self.create_route_map(
-                [[coord[1], coord[0]] for coord in route_coordinates],  # Convert to [lat, lon] format
+                [list(point) for point in polyline.decode(level_geometry(route, MAP_ZOOM))],  # [lat, lon] format
                 charging_stops
             )
 
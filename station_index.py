@@ -0,0 +1,190 @@
+import numpy as np
+from sklearn.neighbors import BallTree
+import geodesy
+from geodesy import EARTH_RADIUS_KM
+
+SUBSAMPLE = 8  # Corridor sections between probes are split this many ways before single segments are tried
+
+
+def narrow(station, first, last, probes, points, route_xyz, chainage, max_chord):
+    """Split (station, first vertex, last vertex) ranges at probes, keeping the pieces that may hold a closest point.
+
+    probes is a sorted array of vertex indices that includes every range
+    end. A piece between probes i and i + 1 is kept if no point on it is
+    provably farther from the station (points, Earth-centred) than the
+    nearest probe seen or max_chord, using straight-line distances and
+    route lengths between probes as bounds. Pieces keep the input order.
+    """
+    begin, end = np.searchsorted(probes, first), np.searchsorted(probes, last)
+    counts = end - begin
+    pair = np.repeat(np.arange(len(station)), counts)
+    piece = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts - begin, counts)
+    piece_station, start, stop = station[pair], probes[piece], probes[piece + 1]
+
+    offsets = points[piece_station] - route_xyz[start]
+    to_start = np.sqrt(np.einsum('ij,ij->i', offsets, offsets))
+    offsets = points[piece_station] - route_xyz[stop]
+    to_stop = np.sqrt(np.einsum('ij,ij->i', offsets, offsets))
+    closest = np.full(len(points), max_chord)
+    np.minimum.at(closest, piece_station, np.minimum(to_start, to_stop))
+    bound = (to_start + to_stop - (chainage[stop] - chainage[start])) / 2
+    keep = np.flatnonzero(bound <= closest[piece_station] + 1e-9)
+    return piece_station[keep], start[keep], stop[keep]
+
+
+class StationIndex:
+    """Ball tree over charging station coordinates for radius and k-nearest lookups"""
+
+    def __init__(self, stations, lat_col='Latitude', lon_col='Longitude'):
+        self.stations = stations.reset_index(drop=True)
+        self.records = self.stations.to_dict('records')
+
+        # BallTree with the haversine metric expects [lat, lon] in radians
+        coords = self.stations[[lat_col, lon_col]].to_numpy(dtype=np.float64)
+        self.radians = np.radians(coords)
+        self.xyz = geodesy.to_cartesian(coords[:, 0], coords[:, 1])
+        self.tree = BallTree(self.radians, metric='haversine') if len(coords) else None
+
+    def __len__(self):
+        return len(self.records)
+
+    def query_radius(self, lat, lon, max_distance):
+        """Return (positions, distances in km) of stations within max_distance km, nearest first"""
+        if self.tree is None:
+            return np.empty(0, dtype=np.intp), np.empty(0)
+
+        point = np.radians([[lat, lon]])
+        indices, distances = self.tree.query_radius(point, r=max_distance / EARTH_RADIUS_KM,
+                                                    return_distance=True, sort_results=True)
+        return indices[0], distances[0] * EARTH_RADIUS_KM
+
+    def query_nearest(self, lat, lon, k=5):
+        """Return (positions, distances in km) of the k nearest stations, nearest first"""
+        if self.tree is None:
+            return np.empty(0, dtype=np.intp), np.empty(0)
+
+        k = min(k, len(self.records))
+        distances, indices = self.tree.query(np.radians([[lat, lon]]), k=k)
+        return indices[0], distances[0] * EARTH_RADIUS_KM
+
+    def query_nearest_many(self, lats, lons, k=5, eligible=None):
+        """k nearest stations for every point in one query.
+
+        eligible is an optional boolean mask over the stations; only those
+        stations are returned. Returns (positions, distances in km) arrays of
+        shape (len(lats), k), nearest first, padded with -1 and inf when fewer
+        than k stations are eligible.
+        """
+        points = np.radians(np.column_stack([np.asarray(lats, dtype=np.float64),
+                                             np.asarray(lons, dtype=np.float64)]))
+        positions = np.full((len(points), k), -1, dtype=np.intp)
+        distances = np.full((len(points), k), np.inf)
+
+        tree, candidates = self.tree, None
+        if eligible is not None and not np.all(eligible):
+            candidates = np.flatnonzero(eligible)
+            tree = BallTree(self.radians[candidates], metric='haversine') if len(candidates) else None
+        if tree is None or not len(points):
+            return positions, distances
+
+        found = min(k, tree.data.shape[0])
+        dist, idx = tree.query(points, k=found)
+        positions[:, :found] = idx if candidates is None else candidates[idx]
+        distances[:, :found] = dist * EARTH_RADIUS_KM
+        return positions, distances
+
+    def query_corridor(self, route_lats, route_lons, max_offset, sample_step=2):
+        """Find every station within max_offset km of any segment of a route.
+
+        Returns (positions, offsets in km, chainages in km) ordered along the
+        route, where the chainage is the distance along the route to the point
+        closest to the station.
+        """
+        lats = np.asarray(route_lats, dtype=np.float64)
+        lons = np.asarray(route_lons, dtype=np.float64)
+        empty = np.empty(0, dtype=np.intp), np.empty(0), np.empty(0)
+        if self.tree is None or len(lats) == 0:
+            return empty
+        if len(lats) == 1:
+            positions, offsets = self.query_radius(lats[0], lons[0], max_offset)
+            return positions, offsets, np.zeros(len(positions))
+
+        chainage = geodesy.cumulative_distances(lats, lons)
+
+        # Probe the tree from vertices roughly sample_step km apart along the route.
+        # Any point of the route lies within max_gap / 2 of a probe, so a probe
+        # radius of max_offset + max_gap / 2 cannot miss a station in the corridor.
+        bucket = np.floor(chainage / sample_step).astype(np.int64)
+        samples = np.flatnonzero(np.diff(bucket, prepend=-1))
+        if samples[-1] != len(lats) - 1:
+            samples = np.append(samples, len(lats) - 1)
+        max_gap = np.diff(chainage[samples]).max()
+        radius = (max_offset + max_gap / 2) / EARTH_RADIUS_KM
+
+        hits, hit_distances = self.tree.query_radius(
+            np.radians(np.column_stack([lats[samples], lons[samples]])), r=radius, return_distance=True)
+        counts = np.fromiter((len(h) for h in hits), dtype=np.intp, count=len(hits))
+        if not counts.sum():
+            return empty
+        hit_sample = np.repeat(np.arange(len(samples)), counts)
+        hit_distance = np.concatenate(hit_distances) * EARTH_RADIUS_KM
+        candidates, group = np.unique(np.concatenate(hits), return_inverse=True)
+
+        # A station's nearest probe is a route vertex, so the route comes at least that
+        # close. Every point of the section between probes k and k + 1 is within gap_k
+        # along the route of both, so no point there is nearer than
+        # (d_k + d_k+1 - gap_k) / 2, where a probe that missed the station counts as
+        # radius away. Only sections next to a probe that caught the station and whose
+        # bound beats the nearest probe (and max_offset) are measured segment by segment.
+        nearest = np.full(len(candidates), np.inf)
+        np.minimum.at(nearest, group, hit_distance)
+        probe_key = group * len(samples) + hit_sample
+        order = np.argsort(probe_key)
+        probe_key, probe_distance = probe_key[order], hit_distance[order]
+
+        def probe_distances(keys):
+            found = np.minimum(np.searchsorted(probe_key, keys), len(probe_key) - 1)
+            return np.where(probe_key[found] == keys, probe_distance[found], radius * EARTH_RADIUS_KM)
+
+        section_key = np.unique(np.concatenate([probe_key[hit_sample[order] < len(samples) - 1],
+                                                probe_key[hit_sample[order] > 0] - 1]))
+        section_station, section = np.divmod(section_key, len(samples))
+        gaps = np.diff(chainage[samples])
+        bound = (probe_distances(section_key) + probe_distances(section_key + 1) - gaps[section]) / 2
+        # Slack for segments being measured as straight chords rather than arcs
+        slack = np.diff(chainage).max() ** 2 / (8 * EARTH_RADIUS_KM) + 1e-9
+        keep = bound <= np.minimum(nearest, max_offset)[section_station] + slack
+        section_station, section = section_station[keep], section[keep]
+        if not len(section):
+            return empty
+
+        # Narrow the sections down to single segments in two more rounds of the same
+        # bound: first between vertices about sample_step / SUBSAMPLE km apart, then
+        # between consecutive vertices. Segment j runs from vertex j to j + 1.
+        route_xyz = geodesy.to_cartesian(lats, lons)
+        points = self.xyz[candidates]
+        max_chord = 2 * EARTH_RADIUS_KM * np.sin(max_offset / (2 * EARTH_RADIUS_KM))
+        bucket = np.floor(chainage * SUBSAMPLE / sample_step).astype(np.int64)
+        pairs = section_station, samples[section], samples[section + 1]
+        for probes in (np.union1d(samples, np.flatnonzero(np.diff(bucket, prepend=-1))), np.arange(len(lats))):
+            pairs = narrow(*pairs, probes, points, route_xyz, chainage, max_chord)
+        if not len(pairs[0]):
+            return empty
+        kept, pair_station = np.unique(pairs[0], return_inverse=True)
+        candidates, segment = candidates[kept], pairs[1]
+        seg_counts = np.bincount(pair_station, minlength=len(candidates))
+        starts = np.concatenate(([0], np.cumsum(seg_counts)[:-1]))
+
+        distances, t = geodesy.point_segment_distances(
+            self.xyz[candidates[pair_station]], route_xyz[segment], route_xyz[segment + 1])
+
+        # Closest segment for each candidate
+        best = np.minimum.reduceat(distances, starts)
+        is_best = np.flatnonzero(distances == np.repeat(best, seg_counts))
+        is_best = is_best[np.unique(pair_station[is_best], return_index=True)[1]]
+
+        seg = segment[is_best]
+        along = chainage[seg] + t[is_best] * (chainage[seg + 1] - chainage[seg])
+        inside = best <= max_offset
+        order = np.argsort(along[inside], kind='stable')
+        return candidates[inside][order], best[inside][order], along[inside][order]
@@ -0,0 +1,208 @@
+"""Precomputed station-to-station road distances and driving times.
+
+Build once per station file, e.g. after updating the CSVs or the road graph:
+
+    python station_matrix.py charging_stations_india.csv charging_stations_karnataka.csv
+
+Each file gets a directory under instance/station_matrix holding float32
+arrays of the k nearest stations to every station, or all of them when the
+file is small. Rows list neighbours in ascending station order, so a lookup
+is a row index plus a binary search over at most k entries. Workers
+memory-map the arrays read-only and share one copy in the page cache.
+"""
+import json
+import os
+import shutil
+import sys
+
+import numpy as np
+import pandas as pd
+from sklearn.neighbors import BallTree
+import geodesy
+import road_graph
+
+MATRIX_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'station_matrix')
+MATRIX_FORMAT_VERSION = 1
+DEFAULT_NEIGHBOURS = 64  # Neighbours kept per station once the file is too large for a full matrix
+ROAD_DETOUR_FACTOR = 1.3  # Road distance over great-circle distance when there is no road graph
+AVERAGE_SPEED = 60  # km/h for durations estimated without a road graph
+ROAD_SEARCH_FACTOR = 3  # Road searches stop at this multiple of the farthest neighbour's great-circle distance
+SEARCH_BLOCK_BYTES = 256 * 1024 * 1024  # Scratch memory for the rows of one block of road searches
+
+
+def matrix_path(csv_path):
+    """Directory holding the matrix for a station CSV"""
+    return os.path.join(MATRIX_DIR, os.path.splitext(os.path.basename(csv_path))[0])
+
+
+def nearest_neighbours(lats, lons, k):
+    """(N, k) positions of each station's k nearest other stations, in ascending position order"""
+    count = len(lats)
+    if k >= count - 1:
+        full = np.tile(np.arange(count), (count, 1))
+        return full[~np.eye(count, dtype=bool)].reshape(count, count - 1)
+    tree = BallTree(np.radians(np.column_stack([lats, lons])), metric='haversine')
+    _, indices = tree.query(np.radians(np.column_stack([lats, lons])), k=k + 1)
+    return np.sort(indices[:, 1:], axis=1)
+
+
+def road_costs(graph, lats, lons, neighbours):
+    """Road distances (km) and fastest driving times (hours) from the road graph, inf where unreachable"""
+    from scipy.sparse import csr_matrix
+    from scipy.sparse.csgraph import dijkstra
+
+    nodes = np.array([graph.nearest_node(lat, lon)[0] for lat, lon in zip(lats, lons)])
+    shape = (len(graph.lats), len(graph.lats))
+    # Searches stop past the farthest neighbour, and dijkstra returns a dense row per source over
+    # the whole graph, so sources go in blocks sized to keep those rows within SEARCH_BLOCK_BYTES
+    radius = geodesy.haversine(lats[:, np.newaxis], lons[:, np.newaxis], lats[neighbours], lons[neighbours]).max(axis=1)
+    lengths, durations = np.asarray(graph.lengths, dtype=np.float64), np.asarray(graph.durations, dtype=np.float64)
+    slowest = float((lengths / np.where(durations > 0, durations, np.inf)).min()) if len(lengths) else 0.0
+    block = max(1, SEARCH_BLOCK_BYTES // (8 * max(shape[0], 1)))
+
+    out = {'distances': np.empty(neighbours.shape), 'durations': np.empty(neighbours.shape)}
+    for name, weights in (('distances', lengths), ('durations', durations)):
+        adjacency = csr_matrix((weights, graph.targets, graph.offsets), shape=shape)
+        for start in range(0, len(nodes), block):
+            end = min(start + block, len(nodes))
+            limit = radius[start:end].max() * ROAD_SEARCH_FACTOR
+            if name == 'durations':
+                limit = limit / slowest if slowest > 0 else np.inf
+            rows = dijkstra(adjacency, indices=nodes[start:end], limit=limit)
+            # Keep only the columns of each source's neighbouring stations
+            out[name][start:end] = rows[np.arange(end - start)[:, np.newaxis], nodes[neighbours[start:end]]]
+            del rows
+    return out['distances'], out['durations']
+
+
+def build_station_matrix(csv_path, k=DEFAULT_NEIGHBOURS, graph=None, output=None):
+    """Compute and write the distance/duration matrix for the stations in csv_path"""
+    stations = pd.read_csv(csv_path)
+    lats = stations['Latitude'].to_numpy(dtype=np.float64)
+    lons = stations['Longitude'].to_numpy(dtype=np.float64)
+    neighbours = nearest_neighbours(lats, lons, k)
+
+    if graph is not None:
+        distances, durations = road_costs(graph, lats, lons, neighbours)
+    else:
+        distances = geodesy.haversine(lats[:, np.newaxis], lons[:, np.newaxis],
+                                      lats[neighbours], lons[neighbours]) * ROAD_DETOUR_FACTOR
+        durations = distances / AVERAGE_SPEED
+
+    # Write to a scratch directory and swap it in, so readers never see a half-built matrix
+    output = output or matrix_path(csv_path)
+    scratch = f'{output}.building-{os.getpid()}'
+    os.makedirs(scratch, exist_ok=True)
+    np.save(os.path.join(scratch, 'neighbours.npy'), neighbours.astype(np.int32))
+    np.save(os.path.join(scratch, 'distances.npy'), distances.astype(np.float32))
+    np.save(os.path.join(scratch, 'durations.npy'), durations.astype(np.float32))
+    with open(os.path.join(scratch, 'meta.json'), 'w') as f:
+        json.dump({
+            'version': MATRIX_FORMAT_VERSION,
+            'source': os.path.basename(csv_path),
+            'station_ids': stations['Station ID'].astype(str).tolist(),
+            'full': bool(neighbours.shape[1] == len(stations) - 1),
+            'method': 'road_graph' if graph is not None else 'great_circle'
+        }, f)
+
+    if os.path.exists(output):
+        retired = f'{output}.old-{os.getpid()}'
+        os.replace(output, retired)
+        os.replace(scratch, output)
+        shutil.rmtree(retired, ignore_errors=True)
+    else:
+        os.replace(scratch, output)
+    return output
+
+
+class StationMatrix:
+    """Read-only, memory-mapped view of a built station matrix"""
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta.get('version') != MATRIX_FORMAT_VERSION:
+            raise ValueError(f"Unsupported station matrix format in {path}")
+        self.neighbours = np.load(os.path.join(path, 'neighbours.npy'), mmap_mode='r').view(np.ndarray)
+        self.distances = np.load(os.path.join(path, 'distances.npy'), mmap_mode='r').view(np.ndarray)
+        self.durations = np.load(os.path.join(path, 'durations.npy'), mmap_mode='r').view(np.ndarray)
+        self.positions = {station_id: i for i, station_id in enumerate(self.meta['station_ids'])}
+
+    def __len__(self):
+        return len(self.neighbours)
+
+    def column(self, origin, destination):
+        """Column of destination in origin's row, or None if it is not one of origin's neighbours"""
+        if self.meta['full']:
+            # Rows skip the diagonal
+            return destination - (destination > origin) if destination != origin else None
+        row = self.neighbours[origin]
+        column = int(np.searchsorted(row, destination))
+        return column if column < len(row) and row[column] == destination else None
+
+    def lookup(self, origin, destination):
+        """(road km, driving hours) between stations at the given CSV positions, or None if not stored"""
+        if origin == destination:
+            return 0.0, 0.0
+        column = self.column(origin, destination)
+        if column is None or not np.isfinite(self.distances[origin, column]):
+            return None
+        return float(self.distances[origin, column]), float(self.durations[origin, column])
+
+    def lookup_many(self, origins, destination):
+        """Road km and driving hours from each of origins to destination (CSV positions), NaN where not stored.
+
+        Positions of -1 stand for stations missing from the matrix.
+        """
+        origins = np.asarray(origins, dtype=np.int64)
+        distances, durations = np.full(len(origins), np.nan), np.full(len(origins), np.nan)
+        known = (origins >= 0) & (origins != destination)
+        if destination < 0 or not known.any():
+            return distances, durations
+        rows = origins[known]
+        if self.meta['full']:
+            columns = destination - (destination > rows)
+            found = np.ones(len(rows), dtype=bool)
+        else:
+            matches = self.neighbours[rows] == destination
+            columns, found = matches.argmax(axis=1), matches.any(axis=1)
+        positions = np.flatnonzero(known)[found]
+        distances[positions] = self.distances[rows[found], columns[found]]
+        durations[positions] = self.durations[rows[found], columns[found]]
+        distances[np.isinf(distances)] = np.nan
+        durations[np.isnan(distances)] = np.nan
+        return distances, durations
+
+    def lookup_ids(self, origin_id, destination_id):
+        """Same as lookup, with stations given by Station ID"""
+        origin, destination = self.positions.get(str(origin_id)), self.positions.get(str(destination_id))
+        if origin is None or destination is None:
+            return None
+        return self.lookup(origin, destination)
+
+
+def load_station_matrix(csv_path, graph=None):
+    """Open the matrix built for csv_path, or return None if it has not been built.
+
+    A matrix built for a different list of stations is rebuilt first, with
+    costs from graph if given.
+    """
+    path = matrix_path(csv_path)
+    if not os.path.exists(os.path.join(path, 'meta.json')):
+        return None
+    try:
+        matrix = StationMatrix(path)
+        station_ids = pd.read_csv(csv_path, usecols=['Station ID'])['Station ID'].astype(str).tolist()
+        if matrix.meta['station_ids'] != station_ids:
+            print(f"Station matrix in {path} is out of date with {csv_path}, rebuilding")
+            matrix = StationMatrix(build_station_matrix(csv_path, graph=graph))
+        return matrix
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Error loading station matrix from {path}: {e}")
+        return None
+
+
+if __name__ == '__main__':
+    graph = road_graph.from_environment()
+    for csv_path in sys.argv[1:] or ['charging_stations_india.csv', 'charging_stations_karnataka.csv']:
+        print(f"Station matrix for {csv_path} written to {build_station_matrix(csv_path, graph=graph)}")
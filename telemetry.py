@@ -0,0 +1,178 @@
+"""Bulk vehicle telemetry: batch parsing, vectorized validation and one-statement updates.
+
+A batch is either NDJSON, one object per line:
+
+    {"vehicle_id": 3, "battery_status": 72, "speed": 41.5, "lat": 12.97, "lon": 77.59, "timestamp": 1717000000}
+
+or a binary body of packed little-endian TELEMETRY_FRAME records. Every
+field but vehicle_id is optional: a missing value (NaN, or 255 for the
+binary battery) leaves the vehicle's current value alone. location may be
+given as text in NDJSON; otherwise a lat/lon fix is stored as "lat, lon".
+"""
+import json
+import time
+
+import numpy as np
+from sqlalchemy import text
+
+# vehicle_id, timestamp (Unix seconds, 0 for arrival time), battery % (255 if unknown), speed km/h, lat, lon
+TELEMETRY_FRAME = np.dtype([
+    ('vehicle_id', '<u4'),
+    ('timestamp', '<u4'),
+    ('battery_status', 'u1'),
+    ('speed', '<f4'),
+    ('lat', '<f4'),
+    ('lon', '<f4')
+])
+MISSING_BATTERY = 255
+MAX_SPEED = 300  # km/h; faster readings are treated as sensor faults
+MAX_CLOCK_SKEW = 300  # Seconds a frame's timestamp may run ahead of the server clock
+MAX_TELEMETRY_FRAMES = 50000  # Frames accepted in one batch
+MAX_REPORTED_ERRORS = 20  # Rejected frames described individually in the response
+FIELDS = ('vehicle_id', 'timestamp', 'battery_status', 'speed', 'lat', 'lon')
+
+UPDATE_VEHICLE_SQL = text(
+    'UPDATE vehicle SET '
+    'battery_status = COALESCE(:battery_status, battery_status), '
+    'speed = COALESCE(:speed, speed), '
+    'location = COALESCE(:location, location) '
+    'WHERE id = :id'
+)
+
+
+def empty_batch(count=0):
+    """Column arrays for count frames, every value missing"""
+    batch = {field: np.full(count, np.nan) for field in FIELDS}
+    batch['location'] = np.full(count, None, dtype=object)
+    return batch
+
+
+def parse_ndjson(body):
+    """Column arrays from NDJSON, plus the indices of lines that are not telemetry objects"""
+    lines = [line for line in body.splitlines() if line.strip()]
+    batch = empty_batch(len(lines))
+    malformed = []
+    for i, line in enumerate(lines):
+        try:
+            frame = json.loads(line)
+            values = [float(frame[field]) if frame.get(field) is not None else np.nan for field in FIELDS]
+            location = frame.get('location')
+            if location is not None and not isinstance(location, str):
+                raise ValueError('location must be a string')
+        except (ValueError, TypeError, AttributeError, KeyError):
+            malformed.append(i)
+            continue
+        for field, value in zip(FIELDS, values):
+            batch[field][i] = value
+        batch['location'][i] = location[:200] if location else None
+    return batch, malformed
+
+
+def parse_binary(body):
+    """Column arrays from packed TELEMETRY_FRAME records; raises ValueError if the body is truncated"""
+    if len(body) % TELEMETRY_FRAME.itemsize:
+        raise ValueError(f"Binary telemetry must be a whole number of {TELEMETRY_FRAME.itemsize}-byte frames")
+    frames = np.frombuffer(body, dtype=TELEMETRY_FRAME)
+    batch = empty_batch(len(frames))
+    for field in FIELDS:
+        batch[field] = frames[field].astype(np.float64)
+    batch['timestamp'][frames['timestamp'] == 0] = np.nan
+    batch['battery_status'][frames['battery_status'] == MISSING_BATTERY] = np.nan
+    return batch
+
+
+def validate(batch, known_ids, now=None):
+    """Reason each frame is rejected, or None for valid frames, checked over whole columns at once"""
+    now = time.time() if now is None else now
+    vehicle_id, battery, speed = batch['vehicle_id'], batch['battery_status'], batch['speed']
+    lat, lon, timestamp = batch['lat'], batch['lon'], batch['timestamp']
+    has_fix = ~np.isnan(lat) & ~np.isnan(lon)
+
+    # Each frame reports the first check it fails
+    checks = [
+        ('vehicle_id is required', np.isnan(vehicle_id)),
+        ('unknown vehicle', ~np.isin(vehicle_id, np.asarray(list(known_ids), dtype=np.float64))),
+        ('battery_status out of range', ~np.isnan(battery) & ~((battery >= 0) & (battery <= 100))),
+        ('speed out of range', ~np.isnan(speed) & ~((speed >= 0) & (speed <= MAX_SPEED))),
+        ('lat and lon must be given together', np.isnan(lat) != np.isnan(lon)),
+        ('coordinates out of range', has_fix & ((np.abs(lat) > 90) | (np.abs(lon) > 180))),
+        ('timestamp is in the future', timestamp > now + MAX_CLOCK_SKEW)
+    ]
+    reasons = np.full(len(vehicle_id), None, dtype=object)
+    for reason, failed in checks:
+        reasons[failed & np.equal(reasons, None)] = reason
+    return reasons
+
+
+def latest_per_vehicle(batch, frames):
+    """Indices of the newest of the given frames for each vehicle; frames without a timestamp count as received last"""
+    frames = np.flatnonzero(frames)
+    if not len(frames):
+        return frames
+    timestamps = np.nan_to_num(batch['timestamp'][frames], nan=np.inf)
+    # Sort by vehicle, then time, then arrival order, and keep the last frame of each vehicle
+    ordered = frames[np.lexsort((frames, timestamps, batch['vehicle_id'][frames]))]
+    vehicles = batch['vehicle_id'][ordered]
+    return ordered[np.append(vehicles[1:] != vehicles[:-1], True)]
+
+
+def vehicle_updates(batch, valid):
+    """UPDATE_VEHICLE_SQL parameters merging each vehicle's valid frames, newest value per field"""
+    text_location = np.not_equal(batch['location'], None)
+    has_location = text_location | ~np.isnan(batch['lat'])
+
+    def location(row):
+        # Formatted only for the rows that end up in the update
+        return batch['location'][row] if text_location[row] else f"{batch['lat'][row]:.5f}, {batch['lon'][row]:.5f}"
+
+    updates = {}
+    columns = (
+        ('battery_status', lambda row: int(round(batch['battery_status'][row])), ~np.isnan(batch['battery_status'])),
+        ('speed', lambda row: float(batch['speed'][row]), ~np.isnan(batch['speed'])),
+        ('location', location, has_location)
+    )
+    for row in latest_per_vehicle(batch, valid):
+        updates[int(batch['vehicle_id'][row])] = {'id': int(batch['vehicle_id'][row]),
+                                                  'battery_status': None, 'speed': None, 'location': None}
+    for column, value, present in columns:
+        for row in latest_per_vehicle(batch, valid & present):
+            updates[int(batch['vehicle_id'][row])][column] = value(row)
+    return list(updates.values())
+
+
+def ingest(connection, batch, known_ids, malformed=()):
+    """Validate a batch and apply it with a single executemany UPDATE; return the accepted frames and the report.
+
+    connection is a SQLAlchemy session or connection; the caller commits,
+    and only then passes the accepted frames, every valid one and not only
+    the newest per vehicle, to append_history, so the history never holds
+    readings whose update was rolled back.
+    """
+    reasons = validate(batch, known_ids)
+    reasons[list(malformed)] = 'malformed frame'
+    valid = np.equal(reasons, None)
+    updates = vehicle_updates(batch, valid)
+    if updates:
+        connection.execute(UPDATE_VEHICLE_SQL, updates)
+    accepted = {name: values[valid] for name, values in batch.items()}
+
+    rejected = np.flatnonzero(~valid)
+    reason_counts = {}
+    for reason in reasons[rejected]:
+        reason_counts[reason] = reason_counts.get(reason, 0) + 1
+    return accepted, {
+        'received': len(reasons),
+        'accepted': int(valid.sum()),
+        'rejected': len(rejected),
+        'vehicles_updated': len(updates),
+        'rejection_reasons': reason_counts,
+        'errors': [{'frame': int(i), 'error': reasons[i]} for i in rejected[:MAX_REPORTED_ERRORS]]
+    }
+
+
+def append_history(history, accepted):
+    """Append frames returned by ingest to the history store, stamping those without a timestamp with now"""
+    if len(accepted['vehicle_id']):
+        timestamps = accepted['timestamp']
+        history.append(accepted['vehicle_id'], np.where(np.isnan(timestamps), time.time(), timestamps),
+                       accepted['lat'], accepted['lon'], accepted['speed'], accepted['battery_status'])
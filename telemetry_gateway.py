@@ -0,0 +1,249 @@
+"""Standalone telemetry gateway: vehicles stream readings over TCP or UDP, the gateway writes them in batches.
+
+Run it next to the web app:
+
+    python telemetry_gateway.py serve [port]
+    python telemetry_gateway.py simulate [port] [readings_per_second]
+
+It writes to the same database as the web app: the one named by
+DATABASE_URL, or instance/users.db when that is not set.
+
+Each reading is one line of comma-separated fields, any of which after the
+first may be left empty:
+
+    vehicle_id,battery_status,speed,lat,lon,timestamp
+
+The same port accepts TCP streams and UDP datagrams, each holding one or
+more lines. The event loop only finds line boundaries and buffers bytes.
+Every WINDOW seconds the buffered lines are parsed in one pass by pandas'
+C parser. The batch is then validated and coalesced per vehicle by the
+telemetry module, written to the web app's database with one executemany
+UPDATE, and once that has committed, appended to the telemetry history.
+Parsing and writing run on a worker thread. While a write is in progress the next window keeps filling.
+If more than MAX_BUFFERED readings are waiting, TCP clients are paused and
+UDP datagrams are dropped.
+"""
+import asyncio
+import io
+import os
+import random
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine, make_url, text
+import telemetry
+from telemetry_store import TelemetryStore
+
+INSTANCE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance')
+DATABASE_URL = os.environ.get('DATABASE_URL', 'sqlite:///users.db')  # The web app's setting and default
+GATEWAY_HOST = os.environ.get('TELEMETRY_GATEWAY_HOST', '127.0.0.1')
+GATEWAY_PORT = 7070
+WINDOW = 0.5  # Seconds of readings coalesced into one database write
+MAX_BUFFERED = 500000  # Readings waiting to be written before clients are slowed down
+MAX_LINE = 256  # Bytes; a TCP client sending a longer line without a newline is disconnected
+KNOWN_IDS_REFRESH = 30  # Seconds between reloads of the vehicle ids
+STATS_INTERVAL = 10  # Seconds between throughput reports
+LINE_FIELDS = ['vehicle_id', 'battery_status', 'speed', 'lat', 'lon', 'timestamp']
+
+
+def parse_lines(data, count):
+    """Telemetry batch from count newline-terminated lines, plus the positions of malformed lines"""
+    options = dict(header=None, names=LINE_FIELDS, on_bad_lines='skip', skip_blank_lines=False, engine='c')
+    try:
+        frame = pd.read_csv(io.BytesIO(data), dtype=np.float64, **options)
+    except ValueError:
+        # Some field is not a number: parse as text and let those fields become NaN, i.e. missing,
+        # or rejected by validation for vehicle_id
+        frame = pd.read_csv(io.BytesIO(data), dtype=str, **options).apply(pd.to_numeric, errors='coerce')
+    batch = telemetry.empty_batch(len(frame))
+    for field in LINE_FIELDS:
+        batch[field] = frame[field].to_numpy(dtype=np.float64)
+    batch['timestamp'][batch['timestamp'] <= 0] = np.nan
+    skipped = count - len(frame)  # Lines with too many fields, dropped by the parser; reported as malformed
+    if skipped > 0:
+        batch = {name: np.concatenate([values, telemetry.empty_batch(skipped)[name]]) for name, values in batch.items()}
+    return batch, list(range(len(frame), len(frame) + max(skipped, 0)))
+
+
+def database_url(url=DATABASE_URL):
+    """URL of the web app's database, with relative SQLite paths under instance/ as Flask-SQLAlchemy places them"""
+    url = make_url(url)
+    if url.get_backend_name() == 'sqlite' and url.database not in (None, '', ':memory:') \
+            and not os.path.isabs(url.database):
+        url = url.set(database=os.path.join(INSTANCE_PATH, url.database))
+    return url
+
+
+def connect(url=DATABASE_URL):
+    url = database_url(url)
+    return create_engine(url, connect_args={'timeout': 10} if url.get_backend_name() == 'sqlite' else {})
+
+
+class TelemetryGateway:
+    """Buffers readings from every connection and writes them to the database once per window"""
+
+    def __init__(self, database_url=DATABASE_URL, history=None, window=WINDOW):
+        self.engine = connect(database_url)
+        self.history = history if history is not None else TelemetryStore()
+        self.window = window
+        self.chunks = []
+        self.buffered = 0
+        self.known_ids = set()
+        self.known_ids_loaded = 0.0
+        self.paused = set()
+        self.totals = {'received': 0, 'accepted': 0, 'rejected': 0, 'dropped': 0, 'vehicles_updated': 0,
+                       'batches': 0, 'write_time': 0.0}
+
+    def add(self, data, transport=None):
+        """Buffer complete lines; with transport set (TCP), pause it while the buffer is full"""
+        count = data.count(b'\n')
+        if not count:
+            return
+        if self.buffered >= MAX_BUFFERED:
+            if transport is None:
+                self.totals['dropped'] += count
+                return
+            transport.pause_reading()
+            self.paused.add(transport)
+        self.chunks.append(data)
+        self.buffered += count
+
+    def load_known_ids(self, connection):
+        if time.monotonic() - self.known_ids_loaded > KNOWN_IDS_REFRESH:
+            self.known_ids = {row[0] for row in connection.execute(text('SELECT id FROM vehicle'))}
+            self.known_ids_loaded = time.monotonic()
+
+    def write(self, data, count):
+        """Parse and apply one window of lines; runs on a worker thread"""
+        batch, malformed = parse_lines(data, count)
+        with self.engine.begin() as connection:
+            self.load_known_ids(connection)
+            accepted, report = telemetry.ingest(connection, batch, self.known_ids, malformed)
+        telemetry.append_history(self.history, accepted)
+        return report
+
+    async def run_writer(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.window)
+            if not self.chunks:
+                continue
+            data, count = b''.join(self.chunks), self.buffered
+            self.chunks, self.buffered = [], 0
+            for transport in self.paused:
+                if not transport.is_closing():
+                    transport.resume_reading()
+            self.paused.clear()
+
+            started = time.monotonic()
+            try:
+                report = await loop.run_in_executor(None, self.write, data, count)
+            except Exception as e:
+                print(f"Error writing telemetry batch of {count} readings: {e}")
+                self.totals['rejected'] += count
+                continue
+            for key in ('received', 'accepted', 'rejected', 'vehicles_updated'):
+                self.totals[key] += report[key]
+            self.totals['batches'] += 1
+            self.totals['write_time'] += time.monotonic() - started
+
+    async def report_stats(self):
+        previous = dict(self.totals)
+        while True:
+            await asyncio.sleep(STATS_INTERVAL)
+            totals = dict(self.totals)
+            batches = totals['batches'] - previous['batches']
+            print(f"Telemetry gateway: {(totals['received'] - previous['received']) / STATS_INTERVAL:.0f} readings/s, "
+                  f"{totals['accepted'] - previous['accepted']} accepted, "
+                  f"{totals['rejected'] - previous['rejected']} rejected, "
+                  f"{totals['dropped'] - previous['dropped']} dropped, "
+                  f"{totals['vehicles_updated'] - previous['vehicles_updated']} vehicle updates in {batches} batches, "
+                  f"avg write {(totals['write_time'] - previous['write_time']) * 1000 / batches if batches else 0:.1f} ms")
+            previous = totals
+
+    async def serve(self, host=GATEWAY_HOST, port=GATEWAY_PORT):
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(lambda: LineProtocol(self), host, port)
+        await loop.create_datagram_endpoint(lambda: DatagramProtocol(self), local_addr=(host, port))
+        print(f"Telemetry gateway listening on {host}:{port} (TCP and UDP)")
+        asyncio.ensure_future(self.report_stats())
+        async with server:
+            await asyncio.gather(server.serve_forever(), self.run_writer())
+
+
+class LineProtocol(asyncio.Protocol):
+    """A TCP connection streaming newline-terminated readings"""
+
+    def __init__(self, gateway):
+        self.gateway = gateway
+        self.partial = b''
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        data = self.partial + data
+        end = data.rfind(b'\n') + 1
+        self.partial = data[end:]
+        if len(self.partial) > MAX_LINE:
+            self.transport.close()
+            return
+        if end:
+            self.gateway.add(data[:end], self.transport)
+
+    def connection_lost(self, exc):
+        self.gateway.paused.discard(self.transport)
+
+
+class DatagramProtocol(asyncio.DatagramProtocol):
+    """UDP datagrams of one or more readings each"""
+
+    def __init__(self, gateway):
+        self.gateway = gateway
+
+    def datagram_received(self, data, addr):
+        self.gateway.add(data if data.endswith(b'\n') else data + b'\n')
+
+
+async def simulate(host=GATEWAY_HOST, port=GATEWAY_PORT, rate=20000, vehicle_ids=None):
+    """Stream random readings for the registered vehicles to a gateway at rate readings per second"""
+    if vehicle_ids is None:
+        engine = connect()
+        with engine.connect() as connection:
+            vehicle_ids = [row[0] for row in connection.execute(text('SELECT id FROM vehicle'))]
+    state = {vehicle_id: [random.randint(20, 100), 0.0, 12.97 + random.uniform(-0.2, 0.2),
+                          77.59 + random.uniform(-0.2, 0.2)] for vehicle_id in vehicle_ids}
+    _, writer = await asyncio.open_connection(host, port)
+    tick = 0.1
+    while True:
+        lines = []
+        for _ in range(max(int(rate * tick), 1)):
+            vehicle_id = random.choice(vehicle_ids)
+            reading = state[vehicle_id]
+            reading[1] = max(0.0, min(120.0, reading[1] + random.uniform(-5, 5)))
+            reading[2] += random.uniform(-1e-4, 1e-4)
+            reading[3] += random.uniform(-1e-4, 1e-4)
+            if random.random() < 0.001:
+                reading[0] = reading[0] - 1 if reading[0] > 5 else 100  # Drain, then recharge
+            lines.append(f'{vehicle_id},{reading[0]},{reading[1]:.1f},{reading[2]:.6f},{reading[3]:.6f},{time.time():.3f}\n')
+        writer.write(''.join(lines).encode())
+        await writer.drain()
+        await asyncio.sleep(tick)
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'serve'
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else GATEWAY_PORT
+    try:
+        if command == 'serve':
+            asyncio.run(TelemetryGateway().serve(GATEWAY_HOST, port))
+        elif command == 'simulate':
+            asyncio.run(simulate(GATEWAY_HOST, port, int(sys.argv[3]) if len(sys.argv) > 3 else 20000))
+        else:
+            print("Usage: python telemetry_gateway.py serve [port] | simulate [port] [readings_per_second]")
+            sys.exit(1)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,214 @@
+"""Append-only history of vehicle telemetry, stored column by column.
+
+Readings are partitioned by vehicle and UTC day under instance/telemetry:
+
+    instance/telemetry/<vehicle_id>/<YYYY-MM-DD>/<segment>.<column>
+
+Each writer process appends to its own segment, one raw little-endian file
+per column in the compact dtypes of COLUMNS. A time-range scan opens only
+the day directories inside the range and memory-maps their columns, so
+dashboards and reports read history as NumPy arrays without touching the
+ORM or the SQLite database.
+"""
+import os
+import threading
+from datetime import datetime, timezone
+
+import numpy as np
+import geodesy
+from telemetry import MISSING_BATTERY
+
+TELEMETRY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'telemetry')
+DAY_SECONDS = 86400
+MAX_CHECKED_PARTITIONS = 100000  # Partitions remembered as checked before the set is cleared
+# Column name -> on-disk dtype; time is milliseconds since the partition's UTC midnight
+COLUMNS = {
+    'time': np.dtype('<u4'),
+    'lat': np.dtype('<f4'),
+    'lon': np.dtype('<f4'),
+    'speed': np.dtype('<f4'),
+    'battery_status': np.dtype('u1')
+}
+
+
+def day_name(day):
+    """Partition directory name of a day number (days since the Unix epoch)"""
+    return datetime.fromtimestamp(int(day) * DAY_SECONDS, tz=timezone.utc).strftime('%Y-%m-%d')
+
+
+def day_number(name):
+    """Day number of a partition directory name, or None for anything else"""
+    try:
+        return int(datetime.strptime(name, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp()) // DAY_SECONDS
+    except ValueError:
+        return None
+
+
+class TelemetryStore:
+    """Column files of timestamped position, speed and state-of-charge readings per vehicle and day"""
+
+    def __init__(self, root=TELEMETRY_DIR):
+        self.root = root
+        self.lock = threading.Lock()
+        self.checked = set()  # Partitions whose segment for this process has been repaired
+
+    def segment(self):
+        """Segment name this process appends to, so workers never interleave writes in one file"""
+        return f'p{os.getpid()}'
+
+    def append(self, vehicle_ids, timestamps, lats, lons, speeds, batteries):
+        """Append readings given as equal-length arrays; NaN marks a missing value, as does 255 for battery.
+
+        Returns the number of readings written.
+        """
+        vehicle_ids = np.asarray(vehicle_ids, dtype=np.int64)
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        if not len(vehicle_ids):
+            return 0
+        columns = {
+            'lat': np.asarray(lats, dtype=np.float32),
+            'lon': np.asarray(lons, dtype=np.float32),
+            'speed': np.asarray(speeds, dtype=np.float32),
+            'battery_status': np.where(np.isnan(np.asarray(batteries, dtype=np.float64)), MISSING_BATTERY,
+                                       np.clip(np.nan_to_num(batteries), 0, 100)).astype(np.uint8)
+        }
+        days = np.floor(timestamps / DAY_SECONDS).astype(np.int64)
+        columns['time'] = np.round((timestamps - days * DAY_SECONDS) * 1000).astype(np.uint32)
+
+        # One write per column per (vehicle, day) partition
+        order = np.lexsort((timestamps, days, vehicle_ids))
+        keys = np.column_stack([vehicle_ids[order], days[order]])
+        starts = np.flatnonzero(np.append(True, np.any(keys[1:] != keys[:-1], axis=1)))
+        ends = np.append(starts[1:], len(order))
+        segment = self.segment()
+        with self.lock:
+            if len(self.checked) > MAX_CHECKED_PARTITIONS:
+                self.checked.clear()
+            for start, end in zip(starts, ends):
+                rows = order[start:end]
+                directory = os.path.join(self.root, str(int(vehicle_ids[rows[0]])), day_name(days[rows[0]]))
+                os.makedirs(directory, exist_ok=True)
+                if directory not in self.checked:
+                    # The segment may have been left torn by an earlier process with the same pid
+                    self.repair(directory, segment)
+                    self.checked.add(directory)
+                try:
+                    for name, dtype in COLUMNS.items():
+                        with open(os.path.join(directory, f'{segment}.{name}'), 'ab') as f:
+                            f.write(columns[name][rows].astype(dtype).tobytes())
+                except Exception:
+                    self.checked.discard(directory)
+                    raise
+        return len(order)
+
+    def repair(self, directory, segment):
+        """Cut a segment's column files back to the rows all of them hold, e.g. after a crash mid-append.
+
+        Appending after a torn write would otherwise pair later rows with the
+        wrong ones for good. Returns that row count.
+        """
+        paths = {name: os.path.join(directory, f'{segment}.{name}') for name in COLUMNS}
+        sizes = {name: os.path.getsize(path) if os.path.exists(path) else 0 for name, path in paths.items()}
+        count = min(sizes[name] // COLUMNS[name].itemsize for name in COLUMNS)
+        for name, path in paths.items():
+            if sizes[name] > count * COLUMNS[name].itemsize:
+                with open(path, 'r+b') as f:
+                    f.truncate(count * COLUMNS[name].itemsize)
+        return count
+
+    def partitions(self, vehicle_id, start=None, end=None):
+        """(day number, directory) of a vehicle's partitions overlapping [start, end] Unix seconds, in day order"""
+        vehicle_dir = os.path.join(self.root, str(int(vehicle_id)))
+        try:
+            names = os.listdir(vehicle_dir)
+        except FileNotFoundError:
+            return []
+        first = -np.inf if start is None else start // DAY_SECONDS
+        last = np.inf if end is None else end // DAY_SECONDS
+        days = [(day_number(name), name) for name in names]
+        return sorted((day, os.path.join(vehicle_dir, name)) for day, name in days
+                      if day is not None and first <= day <= last)
+
+    def read_partition(self, directory, columns):
+        """Memory-mapped columns of every segment in a partition, concatenated"""
+        segments = sorted({name.rsplit('.', 1)[0] for name in os.listdir(directory) if '.' in name})
+        parts = {name: [] for name in columns}
+        for segment in segments:
+            paths = {name: os.path.join(directory, f'{segment}.{name}') for name in COLUMNS}
+            try:
+                # A writer may be mid-append, so use the rows every column has
+                count = min(os.path.getsize(path) // COLUMNS[name].itemsize for name, path in paths.items())
+            except FileNotFoundError:
+                continue
+            if count == 0:
+                continue
+            for name in columns:
+                parts[name].append(np.memmap(paths[name], dtype=COLUMNS[name], mode='r', shape=(count,)))
+        return {name: np.concatenate(arrays) if arrays else np.empty(0, dtype=COLUMNS[name])
+                for name, arrays in parts.items()}
+
+    def scan(self, vehicle_id, start=None, end=None, columns=None):
+        """A vehicle's readings with start <= timestamp <= end (Unix seconds), sorted by time.
+
+        Returns a dict of arrays: 'timestamp' (float64 seconds) plus the
+        requested columns in their stored dtypes (all of them by default).
+        """
+        columns = [name for name in (columns or COLUMNS) if name != 'time']
+        result = {'timestamp': [], **{name: [] for name in columns}}
+        for day, directory in self.partitions(vehicle_id, start, end):
+            data = self.read_partition(directory, ['time'] + columns)
+            timestamps = day * DAY_SECONDS + data['time'] / 1000.0
+            mask = np.ones(len(timestamps), dtype=bool)
+            if start is not None:
+                mask &= timestamps >= start
+            if end is not None:
+                mask &= timestamps <= end
+            order = np.argsort(timestamps[mask], kind='stable')
+            result['timestamp'].append(timestamps[mask][order])
+            for name in columns:
+                result[name].append(np.asarray(data[name][mask])[order])
+        return {name: np.concatenate(arrays) if arrays else
+                np.empty(0, dtype=np.float64 if name == 'timestamp' else COLUMNS[name])
+                for name, arrays in result.items()}
+
+    def summary(self, vehicle_id, start=None, end=None):
+        """Reading count, speed, state of charge and distance travelled over a time range"""
+        return summarize(self.scan(vehicle_id, start, end))
+
+    def stats(self):
+        """Vehicles, partitions and bytes held by the store"""
+        vehicles = partitions = size = 0
+        for vehicle_dir, dirs, files in os.walk(self.root):
+            if os.path.dirname(vehicle_dir) == self.root:
+                vehicles += 1
+            elif files:
+                partitions += 1
+            size += sum(os.path.getsize(os.path.join(vehicle_dir, name)) for name in files)
+        return {'vehicles': vehicles, 'partitions': partitions, 'bytes': size}
+
+
+def summarize(data):
+    """Reading count, speed, state of charge and distance travelled of a scan result"""
+    speed = data['speed'][~np.isnan(data['speed'])]
+    battery = data['battery_status'][data['battery_status'] != MISSING_BATTERY]
+    fixes = ~np.isnan(data['lat']) & ~np.isnan(data['lon'])
+    return {
+        'readings': int(len(data['timestamp'])),
+        'first': float(data['timestamp'][0]) if len(data['timestamp']) else None,
+        'last': float(data['timestamp'][-1]) if len(data['timestamp']) else None,
+        'avg_speed': round(float(speed.mean()), 2) if len(speed) else None,
+        'max_speed': round(float(speed.max()), 2) if len(speed) else None,
+        'min_battery': int(battery.min()) if len(battery) else None,
+        'max_battery': int(battery.max()) if len(battery) else None,
+        'distance_km': round(float(geodesy.path_length(data['lat'][fixes].astype(np.float64),
+                                                        data['lon'][fixes].astype(np.float64))), 3)
+    }
+
+
+def downsample(data, max_points):
+    """Every n-th reading of a scan result so that at most max_points remain"""
+    count = len(data['timestamp'])
+    if max_points <= 0 or count <= max_points:
+        return data
+    keep = np.linspace(0, count - 1, max_points).round().astype(np.int64)
+    return {name: values[keep] for name, values in data.items()}
@@ -0,0 +1,41 @@
+import random
+import time
+
+from charging_planner import plan_charging_stops
+
+PLANNING_BUDGET = 0.05  # Seconds for a long intercity trip with hundreds of candidate stations
+
+
+def charge_time(current, target, charging_speed):
+    return round((target - current) / 100 * 75 / charging_speed, 2)
+
+
+def corridor_stations(count, length, seed=0):
+    rng = random.Random(seed)
+    return [{'station_id': i, 'chainage': rng.uniform(0, length), 'distance': rng.uniform(0, 50),
+             'charging_speed': rng.choice([7.4, 22, 50, 60, 120, 150])} for i in range(count)]
+
+
+def test_stops_stay_above_reserve():
+    stations = corridor_stations(100, 1500)
+    plan = plan_charging_stops(stations, 1500, 80, 250, charge_time, 60, reserve_soc=10, max_soc=90)
+    assert plan is not None and plan['stops']
+    chainages = [stop['station']['chainage'] for stop in plan['stops']]
+    assert chainages == sorted(chainages)
+    for stop in plan['stops']:
+        assert 10 <= stop['arrival_soc'] <= stop['departure_soc'] <= 90
+
+
+def test_unreachable_destination():
+    assert plan_charging_stops([], 1500, 80, 250, charge_time, 60, reserve_soc=10) is None
+
+
+def test_planning_time_with_500_stations():
+    stations = corridor_stations(500, 1500)
+    timings = []
+    for _ in range(5):
+        started = time.perf_counter()
+        plan = plan_charging_stops(stations, 1500, 80, 250, charge_time, 60, reserve_soc=10, max_soc=90)
+        timings.append(time.perf_counter() - started)
+    assert plan is not None
+    assert min(timings) < PLANNING_BUDGET
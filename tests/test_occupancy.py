@@ -0,0 +1,30 @@
+import multiprocessing
+
+from occupancy import OccupancyStore
+
+
+def reserve_all(db_path, attempts):
+    store = OccupancyStore(['CS001', 'CS002'], [3, 1], db_path)
+    return [store.reserve(0) for _ in range(attempts)]
+
+
+def test_workers_never_share_the_last_port(tmp_path):
+    db_path = str(tmp_path / 'occupancy.db')
+    OccupancyStore(['CS001', 'CS002'], [3, 1], db_path)
+    with multiprocessing.get_context('spawn').Pool(4) as pool:
+        results = pool.starmap(reserve_all, [(db_path, 5)] * 4)
+    granted = [reservation_id for batch in results for reservation_id in batch if reservation_id]
+    assert len(granted) == 3
+
+    store = OccupancyStore(['CS001', 'CS002'], [3, 1], db_path)
+    assert store.free_at(0) == 0
+    assert store.release(granted[0]) and not store.release(granted[0])
+    assert store.free_at(0) == 1
+
+
+def test_occupied_ports_are_not_reservable(tmp_path):
+    store = OccupancyStore(['CS001'], [2], str(tmp_path / 'occupancy.db'))
+    store.set_occupied(0, 1)
+    assert store.reserve(0) is not None
+    assert store.reserve(0) is None
+    assert store.snapshot() == [{'station_id': 'CS001', 'capacity': 2, 'occupied': 1, 'reserved': 1, 'free': 0}]
@@ -0,0 +1,83 @@
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+SMALL_FLEET = 5
+LARGE_FLEET = 200
+ROWS_PER_VEHICLE = 4
+
+
+@pytest.fixture(scope='module')
+def fleet_app(tmp_path_factory):
+    # The app binds its database when imported, so point it at an empty one first
+    os.environ['DATABASE_URL'] = 'sqlite:///' + str(tmp_path_factory.mktemp('db') / 'users.db')
+    import app as fleet
+    fleet.app.config['QUERY_BUDGET_STRICT'] = True
+    with fleet.app.app_context():
+        fleet.db.create_all()
+    fleet.ensure_change_tracking()
+    yield fleet
+    fleet.write_behind.flush()
+    os.environ.pop('DATABASE_URL')
+
+
+def add_vehicles(fleet, count):
+    """Add count vehicles, each with a few driver behaviors, maintenance alerts and consumption metrics"""
+    now = datetime.now()
+    with fleet.app.app_context():
+        start = fleet.Vehicle.query.count()
+        vehicles = [fleet.Vehicle(vehicle_name=f'EV-{start + i}', vehicle_number=f'KA01{start + i:06d}',
+                                  owner_name='Owner', battery_status=(start + i) % 100,
+                                  location='Bangalore', speed=float(i % 3) * 20)
+                    for i in range(count)]
+        fleet.db.session.add_all(vehicles)
+        fleet.db.session.flush()
+        for vehicle in vehicles:
+            for j in range(ROWS_PER_VEHICLE):
+                timestamp = now - timedelta(hours=j + 1)
+                fleet.db.session.add_all([
+                    fleet.DriverBehavior(vehicle_id=vehicle.id, timestamp=timestamp, speed=40.0,
+                                         harsh_braking=bool(j % 2), rapid_acceleration=False,
+                                         idle_time=j, score=80),
+                    fleet.MaintenanceAlert(vehicle_id=vehicle.id, alert_type='Battery',
+                                           description='Battery check due', timestamp=timestamp,
+                                           priority='Medium', status='Open'),
+                    fleet.ConsumptionMetric(vehicle_id=vehicle.id, timestamp=timestamp, energy_used=5.0,
+                                            cost=40.0, distance=30.0, efficiency=5.0 / 30.0)
+                ])
+        fleet.db.session.commit()
+
+
+def query_counts(fleet):
+    """X-Query-Count of one request to each budgeted endpoint, plus the ?since= listings"""
+    client = fleet.app.test_client()
+    with client.session_transaction() as session:
+        session['logged_in'] = True
+    paths = {
+        'index': '/',
+        'consumption_metrics': '/consumption_metrics',
+        'get_driver_behavior': '/api/driver_behavior',
+        'get_maintenance_alerts': '/api/maintenance_alerts',
+        'get_driver_behavior?since': '/api/driver_behavior?since=0',
+        'get_maintenance_alerts?since': '/api/maintenance_alerts?since=0'
+    }
+    counts = {}
+    for name, path in paths.items():
+        response = client.get(path)
+        assert response.status_code == 200, name
+        counts[name] = int(response.headers['X-Query-Count'])
+    return counts
+
+
+def test_budgeted_endpoints_stay_within_budget_and_flat(fleet_app):
+    add_vehicles(fleet_app, SMALL_FLEET)
+    small = query_counts(fleet_app)
+    add_vehicles(fleet_app, LARGE_FLEET - SMALL_FLEET)
+    large = query_counts(fleet_app)
+
+    assert set(fleet_app.QUERY_BUDGETS) <= {name.split('?')[0] for name in large}
+    for name, queries in large.items():
+        assert queries <= fleet_app.QUERY_BUDGETS[name.split('?')[0]], name
+        # The same number of queries whether 5 or 200 vehicles are listed
+        assert queries == small[name], name
@@ -0,0 +1,54 @@
+import time
+
+import numpy as np
+import pandas as pd
+
+import geodesy
+from station_index import StationIndex
+
+CORRIDOR_BUDGET = 0.2  # Seconds for a full-resolution intercity route against a national station list
+
+
+def winding_route(rng, count, length_km):
+    heading = np.cumsum(rng.normal(0, 0.05, count)) + rng.uniform(0, 2 * np.pi)
+    step = length_km / count / 111.0
+    return 20 + np.cumsum(step * np.cos(heading)), 78 + np.cumsum(step * np.sin(heading))
+
+
+def random_stations(rng, count, lat_range, lon_range):
+    return pd.DataFrame({'Latitude': rng.uniform(*lat_range, count), 'Longitude': rng.uniform(*lon_range, count)})
+
+
+def test_corridor_matches_checking_every_segment():
+    rng = np.random.default_rng(3)
+    stations = random_stations(rng, 1500, (15, 25), (73, 83))
+    index = StationIndex(stations)
+    lats, lons = winding_route(rng, 1500, 600)
+
+    positions, offsets, chainages = index.query_corridor(lats, lons, 30)
+
+    route_xyz = geodesy.to_cartesian(lats, lons)
+    segments = len(lats) - 1
+    distances, _ = geodesy.point_segment_distances(
+        np.repeat(index.xyz, segments, axis=0), np.tile(route_xyz[:-1], (len(stations), 1)),
+        np.tile(route_xyz[1:], (len(stations), 1)))
+    best = distances.reshape(len(stations), segments).min(axis=1)
+    expected = np.flatnonzero(best <= 30)
+
+    assert len(expected)
+    assert np.array_equal(np.sort(positions), expected)
+    assert np.allclose(offsets, best[positions])
+    assert np.all(np.diff(chainages) >= 0)
+
+
+def test_corridor_time_on_a_full_resolution_route():
+    rng = np.random.default_rng(0)
+    index = StationIndex(random_stations(rng, 30000, (8, 32), (68, 92)))
+    lats, lons = winding_route(rng, 50000, 2000)
+    timings = []
+    for _ in range(3):
+        started = time.perf_counter()
+        positions, _, _ = index.query_corridor(lats, lons, 50)
+        timings.append(time.perf_counter() - started)
+    assert len(positions)
+    assert min(timings) < CORRIDOR_BUDGET
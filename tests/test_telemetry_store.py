@@ -0,0 +1,37 @@
+import os
+
+import numpy as np
+
+from telemetry_store import COLUMNS, TelemetryStore
+
+DAY = 19000 * 86400
+
+
+def append_readings(store, count, offset=0):
+    times = DAY + 60 + offset + np.arange(count, dtype=np.float64)
+    return store.append(np.full(count, 7), times, np.full(count, 12.9), np.full(count, 77.5),
+                        np.arange(count, dtype=np.float64) + offset, np.full(count, 80.0))
+
+
+def test_scan_returns_appended_readings(tmp_path):
+    store = TelemetryStore(str(tmp_path))
+    append_readings(store, 5)
+    data = store.scan(7)
+    assert len(data['timestamp']) == 5
+    assert data['speed'].tolist() == [0, 1, 2, 3, 4]
+
+
+def test_torn_segment_is_repaired_before_appending(tmp_path):
+    store = TelemetryStore(str(tmp_path))
+    append_readings(store, 3)
+    directory = store.partitions(7)[0][1]
+    # A crash after writing only some columns of a second append
+    for name in ('time', 'lat'):
+        with open(os.path.join(directory, f'{store.segment()}.{name}'), 'ab') as f:
+            f.write(np.zeros(2, dtype=COLUMNS[name]).tobytes())
+
+    restarted = TelemetryStore(str(tmp_path))
+    append_readings(restarted, 2, offset=100)
+    data = restarted.scan(7)
+    assert data['speed'].tolist() == [0, 1, 2, 100, 101]
+    assert (data['timestamp'] - DAY).tolist() == [60, 61, 62, 160, 161]
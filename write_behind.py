@@ -0,0 +1,143 @@
+import atexit
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+MAX_BATCH = 256  # Operations committed together
+MAX_DELAY = 0.05  # Seconds the writer waits for more operations before committing
+MAX_PENDING = 10000  # Queued operations before submitters are made to wait
+SUBMIT_TIMEOUT = 1.0  # Seconds a submitter waits for room before queue.Full is raised
+DURABLE_TIMEOUT = 10.0  # Seconds a durable submit waits for its commit
+
+
+class WriteBehindQueue:
+    """Database writes run by one background thread and committed in groups.
+
+    Requests submit operations, which are callables using db.session, and
+    return without waiting for SQLite's write lock. The writer thread takes up
+    to max_batch operations, waiting at most max_delay after the first, runs
+    them inside one app context and commits them together. If a group fails,
+    its operations are retried one commit each, so one bad operation fails
+    alone. When max_pending operations are waiting, submit blocks for up to
+    SUBMIT_TIMEOUT and then raises queue.Full. A durable submit returns only
+    after its commit, with the operation's return value.
+    """
+
+    def __init__(self, app, db, max_batch=MAX_BATCH, max_delay=MAX_DELAY, max_pending=MAX_PENDING):
+        self.app = app
+        self.db = db
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.queue = None
+        self.writer = None
+        self.writer_pid = None
+        self.start_lock = threading.Lock()
+        self.stats_lock = threading.Lock()
+        self.totals = {'operations': 0, 'batches': 0, 'failed': 0, 'rejected': 0, 'commit_time': 0.0}
+        atexit.register(self.close)
+
+    def start(self):
+        """Start the writer thread (again after a fork) if it is not running"""
+        with self.start_lock:
+            if self.writer is not None and self.writer_pid == os.getpid() and self.writer.is_alive():
+                return
+            if self.writer_pid != os.getpid():
+                self.queue = queue.Queue(self.max_pending)
+            self.writer = threading.Thread(target=self.run, name='write-behind', daemon=True)
+            self.writer_pid = os.getpid()
+            self.writer.start()
+
+    def submit(self, operation, durable=False, timeout=DURABLE_TIMEOUT):
+        """Queue operation; return a Future, or with durable=True wait for the commit and return its result"""
+        self.start()
+        future = Future()
+        try:
+            self.queue.put((operation, future), timeout=SUBMIT_TIMEOUT)
+        except queue.Full:
+            with self.stats_lock:
+                self.totals['rejected'] += 1
+            raise
+        return future.result(timeout) if durable else future
+
+    def flush(self, timeout=DURABLE_TIMEOUT):
+        """Wait until everything queued so far has been committed"""
+        if self.writer is not None and self.writer_pid == os.getpid() and self.writer.is_alive():
+            self.submit(lambda: None, durable=True, timeout=timeout)
+
+    def close(self):
+        try:
+            self.flush()
+        except Exception as e:
+            print(f"Error flushing write-behind queue: {e}")
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            # Everything already waiting joins this commit
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self.commit(batch)
+
+    def commit(self, batch):
+        """Run a group of operations and commit them together, falling back to one commit each on failure"""
+        started = time.monotonic()
+        with self.app.app_context():
+            try:
+                results = [operation() for operation, _ in batch]
+                self.db.session.commit()
+            except Exception:
+                self.db.session.rollback()
+                results = None
+
+            failed = 0
+            if results is not None:
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+            else:
+                for operation, future in batch:
+                    try:
+                        result = operation()
+                        self.db.session.commit()
+                        future.set_result(result)
+                    except Exception as e:
+                        self.db.session.rollback()
+                        print(f"Error in write-behind operation: {e}")
+                        future.set_exception(e)
+                        failed += 1
+
+        with self.stats_lock:
+            self.totals['operations'] += len(batch)
+            self.totals['batches'] += 1
+            self.totals['failed'] += failed
+            self.totals['commit_time'] += time.monotonic() - started
+
+    def stats(self):
+        """Queue depth and group commit totals for this process"""
+        with self.stats_lock:
+            totals = dict(self.totals)
+        batches = totals['batches']
+        return {
+            'pending': self.queue.qsize() if self.queue is not None and self.writer_pid == os.getpid() else 0,
+            'max_pending': self.max_pending,
+            'operations': totals['operations'],
+            'batches': batches,
+            'failed': totals['failed'],
+            'rejected': totals['rejected'],
+            'avg_batch_size': round(totals['operations'] / batches, 1) if batches else 0,
+            'avg_commit_ms': round(totals['commit_time'] * 1000 / batches, 2) if batches else 0
+        }